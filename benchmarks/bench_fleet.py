@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark evaluating group memberships for the whole fleet.
+
+Times building a FleetMembership once and applying it to every device. Results are
+appended to benchmarks/results/fleet.json.
+
+Usage: python benchmarks/bench_fleet.py [--devices 100000] [--groups 200]
+"""
+
+import time
+import random
+import logging
+import argparse
+
+from results_store import save_result
+from munki_manifest_generator.device import Device
+from munki_manifest_generator.manifest import Manifest
+from munki_manifest_generator.logger import logger
+from munki_manifest_generator.fleet import FleetMembership
+
+
+def build_fleet(devices: int, groups: int) -> tuple:
+    """Returns synthetic devices, a group config, current manifests and membership responses."""
+    random.seed(0)
+    device_list = [
+        Device.from_graph(
+            {
+                "serialNumber": "C02%09d" % i,
+                "azureADDeviceId": "%08d-2222-2222-2222-222222222222" % i,
+                "userPrincipalName": "user%d@example.com" % i,
+                "enrolledDateTime": "2023-01-01T10:00:00Z",
+            }
+        )
+        for i in range(devices)
+    ]
+    group_list = [
+        {
+            "id": "%08d-3333-3333-3333-333333333333" % i,
+            "name": "group-%d" % i,
+            "catalog": "catalog-%d" % (i % 10) if i % 3 else None,
+            "type": "device" if i % 2 else "user",
+        }
+        for i in range(groups)
+    ]
+    # Most group manifests exist
+    current_manifests = ["site_default"] + [group["name"] for group in group_list[: groups * 9 // 10]]
+
+    device_responses = []
+    user_responses = []
+    for device in device_list:
+        device_responses.append(
+            {
+                "deviceId": device.azure_ad_device_id,
+                "value": [
+                    {"id": group["id"], "displayName": group["name"]} for group in random.sample(group_list, 5)
+                ],
+            }
+        )
+        user_responses.append(
+            {
+                "userPrincipalName": device.user_principal_name,
+                "value": [
+                    {"id": group["id"], "displayName": group["name"]} for group in random.sample(group_list, 5)
+                ],
+            }
+        )
+
+    return device_list, group_list, current_manifests, device_responses, user_responses
+
+
+def new_manifest(device) -> Manifest:
+    return Manifest(
+        catalogs=["Production"],
+        included_manifests=["site_default"],
+        display_name=device.serial_number,
+        serialnumber=device.serial_number,
+        user=device.user_principal_name,
+    )
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--devices", help="Number of synthetic devices", default=100000, type=int)
+    argparser.add_argument("--groups", help="Number of groups in the config", default=200, type=int)
+    args = argparser.parse_args()
+
+    # Applying the fleet logs every included manifest, keep the output to the result
+    logger.setLevel(logging.WARNING)
+
+    devices, groups, current_manifests, device_responses, user_responses = build_fleet(args.devices, args.groups)
+
+    start = time.perf_counter()
+    fleet = FleetMembership(devices, groups, current_manifests, device_responses, user_responses)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for device in devices:
+        manifest = new_manifest(device)
+        fleet.apply(device, manifest)
+        fleet.catalogs(device)
+    apply_seconds = time.perf_counter() - start
+
+    save_result(
+        "fleet",
+        {
+            "devices": args.devices,
+            "groups": args.groups,
+            "fleet_build_seconds": round(build_seconds, 2),
+            "fleet_apply_seconds": round(apply_seconds, 2),
+        },
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks of the pure-Python hot paths on synthetic data.
+
+Covers resolving duplicate devices and extracting serial numbers, filtering UPNs
+with random identifiers, evaluating group manifests and catalogs with a
+FleetMembership, diffing device manifests, resolving device and user group
+memberships, the response handling of batch_request and manifest serialization.
+Nothing is sent over the network, the Graph batch endpoint is replaced by a
+function that answers every sub-request.
+
+Results are appended to benchmarks/results/hot_paths.json with the seconds per
+benchmark for each size.
+
+Usage: python benchmarks/bench_hot_paths.py [--sizes 100,1000,10000,100000] [--repeat 3]
+"""
+
+import json
+import time
+import logging
+import argparse
+
+from results_store import save_result
+from munki_manifest_generator.device import Device
+from munki_manifest_generator.manifest import Manifest
+from munki_manifest_generator.logger import logger
+from munki_manifest_generator.main import contains_random_uuid, resolve_memberships
+from munki_manifest_generator.fleet import FleetMembership
+from munki_manifest_generator.manifest_diff import diff_manifest
+from munki_manifest_generator.graph import concurrent_batch
+from munki_manifest_generator.graph.get_devices import latest_enrolled_devices
+from munki_manifest_generator.manifest_encoding import dumps_manifest, loads_manifest, set_manifest_format
+
+GROUPS = [
+    {
+        "id": "%08d-3333-3333-3333-333333333333" % i,
+        "name": "group-%d" % i,
+        "catalog": "catalog-%d" % (i % 10) if i % 3 else None,
+        "type": "device" if i % 2 else "user",
+    }
+    for i in range(50)
+]
+CURRENT_MANIFESTS = ["site_default"] + [group["name"] for group in GROUPS]
+
+
+def graph_device(i: int) -> dict:
+    """Returns a synthetic managed device, every tenth serial number is enrolled twice."""
+    return {
+        "id": "%08d-0000-0000-0000-000000000000" % i,
+        "serialNumber": "C02%09d" % (i - i % 10 if i % 10 == 1 else i),
+        "azureADDeviceId": "%08d-2222-2222-2222-222222222222" % i,
+        "userPrincipalName": "user%d@example.com" % i if i % 4 else "a1b2c3d4e%d@example.com" % i,
+        "enrolledDateTime": "2023-01-%02dT10:00:00Z" % (i % 28 + 1),
+    }
+
+
+def device_manifest(i: int) -> Manifest:
+    return Manifest(
+        catalogs=["Production", "catalog-%d" % (i % 10), "retired"],
+        included_manifests=["site_default", "group-%d" % (i % 50), "group-%d" % ((i + 7) % 50)],
+        display_name="Mac-%d" % i,
+        serialnumber="C02%09d" % i,
+        user="user%d@example.com" % i,
+    )
+
+
+def membership_responses(size: int) -> tuple:
+    """Returns device and user membership responses with five groups each."""
+    device_responses = []
+    user_responses = []
+    for i in range(size):
+        groups = [GROUPS[(i * 7 + j * 11) % len(GROUPS)] for j in range(5)]
+        value = [{"id": group["id"], "displayName": group["name"]} for group in groups]
+        device_responses.append({"deviceId": "%08d-2222-2222-2222-222222222222" % i, "value": value})
+        user_responses.append({"userPrincipalName": "user%d@example.com" % i, "value": value})
+
+    return device_responses, user_responses
+
+
+def fake_batch_post(endpoint: str, token: dict, jdata: str) -> dict:
+    """Answers every sub-request of a batch with a group membership."""
+    requests = json.loads(jdata)["requests"]
+    return {
+        "responses": [
+            {
+                "id": request["id"],
+                "status": 200,
+                "headers": {},
+                "body": {"value": [{"id": GROUPS[0]["id"], "displayName": GROUPS[0]["name"]}]},
+            }
+            for request in requests
+        ]
+    }
+
+
+def timed(run, repeat: int) -> float:
+    """Returns the best time of run in seconds, run is called with a fresh setup each time."""
+    best = None
+    for _ in range(repeat):
+        elapsed = run()
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 4)
+
+
+def bench_latest_enrolled(size: int) -> float:
+    graph_devices = [graph_device(i) for i in range(size)]
+    start = time.perf_counter()
+    devices = latest_enrolled_devices([Device.from_graph(d) for d in graph_devices])
+    [d.serial_number for d in devices if d.serial_number is not None]
+    return time.perf_counter() - start
+
+
+def bench_random_uuid(size: int) -> float:
+    upns = [graph_device(i)["userPrincipalName"] for i in range(size)]
+    start = time.perf_counter()
+    [upn for upn in upns if not contains_random_uuid(upn)]
+    return time.perf_counter() - start
+
+
+def bench_fleet_membership(size: int) -> float:
+    devices = [Device.from_graph(graph_device(i)) for i in range(size)]
+    device_responses, user_responses = membership_responses(size)
+    manifests = [device_manifest(i) for i in range(size)]
+    start = time.perf_counter()
+    fleet = FleetMembership(devices, GROUPS, CURRENT_MANIFESTS, device_responses, user_responses)
+    for device, manifest in zip(devices, manifests):
+        fleet.apply(device, manifest)
+        fleet.catalogs(device)
+    return time.perf_counter() - start
+
+
+def bench_diff_manifest(size: int) -> float:
+    manifests = [device_manifest(i).to_dict() for i in range(size)]
+    existing = set(CURRENT_MANIFESTS)
+    group_catalogs = [(group["name"], group["catalog"]) for group in GROUPS if group["catalog"] is not None]
+    start = time.perf_counter()
+    for i, manifest in enumerate(manifests):
+        desired = ["group-%d" % (i % 50), "group-%d" % ((i + 3) % 50)]
+        diff_manifest(manifest, desired, desired, existing, group_catalogs, "Production", manifest["user"])
+    return time.perf_counter() - start
+
+
+def bench_resolve_memberships(size: int) -> float:
+    device_ids = ["%08d-2222-2222-2222-222222222222" % i for i in range(size)]
+    user_ids = {"user%d@example.com" % i: "%08d-5555-5555-5555-555555555555" % i for i in range(size)}
+    query = "(%s)" % " OR ".join('"displayName:%s"' % group["name"] for group in GROUPS)
+    post = concurrent_batch.make_api_request_Post
+    concurrent_batch.make_api_request_Post = fake_batch_post
+    try:
+        start = time.perf_counter()
+        resolve_memberships(device_ids, "device", GROUPS, {}, "search", query)
+        resolve_memberships(list(user_ids), "user", GROUPS, {}, "search", query, user_ids=user_ids)
+        return time.perf_counter() - start
+    finally:
+        concurrent_batch.make_api_request_Post = post
+
+
+def bench_batch_request(size: int) -> float:
+    data = [
+        {"value": [{"id": "%08d-4444-4444-4444-444444444444" % i, "deviceId": "device-%d" % i}]} for i in range(size)
+    ]
+    post = concurrent_batch.make_api_request_Post
+    concurrent_batch.make_api_request_Post = fake_batch_post
+    try:
+        start = time.perf_counter()
+        concurrent_batch.batch_request(data, "devices/", "/transitiveMemberOf", "device", {})
+        return time.perf_counter() - start
+    finally:
+        concurrent_batch.make_api_request_Post = post
+
+
+def bench_plist(size: int, manifest_format: str) -> float:
+    manifests = [device_manifest(i).to_dict() for i in range(size)]
+    set_manifest_format(manifest_format)
+    start = time.perf_counter()
+    for manifest in manifests:
+        loads_manifest(dumps_manifest(manifest))
+    set_manifest_format("xml")
+    return time.perf_counter() - start
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--sizes", help="Comma separated sizes", default="100,1000,10000,100000")
+    argparser.add_argument("--repeat", help="Number of runs, the best time is kept", default=3, type=int)
+    args = argparser.parse_args()
+
+    # The hot paths log every change, keep the output to the result
+    logger.setLevel(logging.WARNING)
+
+    benchmarks = {
+        "latest_enrolled_devices": bench_latest_enrolled,
+        "contains_random_uuid": bench_random_uuid,
+        "fleet_membership": bench_fleet_membership,
+        "diff_manifest": bench_diff_manifest,
+        "resolve_memberships": bench_resolve_memberships,
+        "batch_request": bench_batch_request,
+        "plist_xml": lambda size: bench_plist(size, "xml"),
+        "plist_binary": lambda size: bench_plist(size, "binary"),
+    }
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    seconds = {name: {} for name in benchmarks}
+    for size in sizes:
+        for name, bench in benchmarks.items():
+            seconds[name][str(size)] = timed(lambda: bench(size), args.repeat)
+
+    save_result("hot_paths", {"sizes": sizes, "repeat": args.repeat, "seconds": seconds})
+
+
+if __name__ == "__main__":
+    main()
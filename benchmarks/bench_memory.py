@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the memory used to hold devices and manifests.
+
+Compares full Graph device dicts with compact Device records, and measures the
+memory of Manifest objects for the whole fleet. Results are appended to
+benchmarks/results/memory.json.
+
+Usage: python benchmarks/bench_memory.py [--devices 100000]
+"""
+
+import gc
+import argparse
+import tracemalloc
+
+from results_store import save_result
+from munki_manifest_generator.device import Device
+from munki_manifest_generator.manifest import Manifest
+
+
+def graph_device(i: int) -> dict:
+    """Returns a synthetic managed device with a realistic number of fields."""
+    device = {
+        "id": "%08d-0000-0000-0000-000000000000" % i,
+        "userId": "%08d-1111-1111-1111-111111111111" % i,
+        "deviceName": "Mac-%d" % i,
+        "managedDeviceOwnerType": "company",
+        "enrolledDateTime": "2023-01-%02dT10:00:00Z" % (i % 28 + 1),
+        "lastSyncDateTime": "2023-06-01T10:00:00Z",
+        "operatingSystem": "macOS",
+        "complianceState": "compliant",
+        "osVersion": "13.4.1 (22F82)",
+        "azureADRegistered": True,
+        "deviceEnrollmentType": "appleBulkWithUser",
+        "azureADDeviceId": "%08d-2222-2222-2222-222222222222" % i,
+        "deviceRegistrationState": "registered",
+        "isSupervised": True,
+        "emailAddress": "user%d@example.com" % i,
+        "model": "MacBook Pro",
+        "manufacturer": "Apple",
+        "serialNumber": "C02%09d" % i,
+        "userPrincipalName": "user%d@example.com" % i,
+        "userDisplayName": "User %d" % i,
+        "totalStorageSpaceInBytes": 494384795648,
+        "freeStorageSpaceInBytes": 254384795648,
+        "managedDeviceName": "user%d_MacOS_1/1/2023_10:00 AM" % i,
+        "wiFiMacAddress": "a1b2c3d4e5f6",
+        "physicalMemoryInBytes": 0,
+    }
+    return device
+
+
+def measure(build) -> float:
+    """Returns the memory in MB held by the objects returned by build."""
+    gc.collect()
+    tracemalloc.start()
+    objects = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return round(current / 1024 / 1024, 2)
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--devices", help="Number of synthetic devices", default=100000, type=int)
+    args = argparser.parse_args()
+
+    graph_devices = [graph_device(i) for i in range(args.devices)]
+
+    save_result(
+        "memory",
+        {
+            "devices": args.devices,
+            "graph_dicts_mb": measure(lambda: [dict(d) for d in graph_devices]),
+            "device_records_mb": measure(lambda: [Device.from_graph(d) for d in graph_devices]),
+            "manifests_mb": measure(
+                lambda: [
+                    Manifest(
+                        catalogs=["Production"],
+                        included_manifests=["site_default"],
+                        display_name=d["serialNumber"],
+                        serialnumber=d["serialNumber"],
+                        user=d["userPrincipalName"],
+                    )
+                    for d in graph_devices
+                ]
+            ),
+        },
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the command line start up time.
+
+Measures the import time of munki_manifest_generator.main, the wall time of
+`--version` and which heavy dependencies are loaded on import. Results are
+appended to benchmarks/results/startup.json so regressions show up over time.
+
+Usage: python benchmarks/bench_startup.py [--repeat 10]
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+from results_store import ROOT, save_result
+
+HEAVY_MODULES = ["msal", "azure.storage.blob", "requests", "retrying"]
+
+
+def run_python(args: list) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable] + args, cwd=ROOT, env=env, capture_output=True, text=True)
+
+
+def import_time_us() -> int:
+    """Returns the cumulative import time of munki_manifest_generator.main in microseconds."""
+    result = run_python(["-X", "importtime", "-c", "import munki_manifest_generator.main"])
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| munki_manifest_generator\.main$", line)
+        if match:
+            return int(match.group(1))
+    raise Exception("Import time for munki_manifest_generator.main not found")
+
+
+def version_wall_time() -> float:
+    """Returns the wall time of `--version` in seconds."""
+    start = time.perf_counter()
+    run_python(["-m", "munki_manifest_generator.main", "--version"])
+    return time.perf_counter() - start
+
+
+def loaded_heavy_modules() -> list:
+    """Returns the heavy dependencies loaded by importing munki_manifest_generator.main."""
+    code = "import sys, munki_manifest_generator.main; print(','.join(m for m in %r if m in sys.modules))"
+    result = run_python(["-c", code % HEAVY_MODULES])
+    return [m for m in result.stdout.strip().split(",") if m]
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--repeat", help="Number of runs per measurement", default=10, type=int)
+    args = argparser.parse_args()
+
+    import_times = [import_time_us() for _ in range(args.repeat)]
+    version_times = [version_wall_time() for _ in range(args.repeat)]
+
+    save_result(
+        "startup",
+        {
+            "import_time_ms": round(statistics.median(import_times) / 1000, 2),
+            "version_wall_time_ms": round(statistics.median(version_times) * 1000, 2),
+            "heavy_modules_on_import": loaded_heavy_modules(),
+        },
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+"""
+Helpers shared by the benchmarks to store results so regressions show up over time.
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# Make the package importable when running a benchmark from a checkout
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def save_result(name: str, result: dict) -> dict:
+    """Append the result to benchmarks/results/<name>.json with the commit and Python version."""
+    git = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+    result = dict(
+        {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git.stdout.strip(),
+            "python": sys.version.split()[0],
+        },
+        **result,
+    )
+
+    path = os.path.join(RESULTS_DIR, name + ".json")
+    history = []
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            history = json.load(f)
+    history.append(result)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(history, f, indent=2)
+
+    print(json.dumps(result, indent=2))
+    return result
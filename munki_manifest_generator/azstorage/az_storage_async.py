@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+This module contains an async client for Azure Blob Storage, used to keep many blob operations in flight from
+one thread.
+"""
+
+import asyncio
+
+from munki_manifest_generator.logger import logger
+from munki_manifest_generator.tracing import span
+
+# Default number of blob operations in flight
+MAX_CONCURRENCY = 100
+
+
+class AsyncBlobStorage:
+    """
+    Lists, downloads, uploads and deletes manifests with one shared aio client.
+
+    The client and its event loop are kept for the whole run, a semaphore bounds the operations in flight.
+    Coroutines are run from synchronous code with run().
+    """
+
+    def __init__(self, connection_string: str, container_name: str, max_concurrency: int = MAX_CONCURRENCY):
+        self.connection_string = connection_string
+        self.container_name = container_name
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self._session = None
+        self._service_client = None
+        self._container_client = None
+        self._semaphore = None
+
+    def run(self, coro):
+        """Run a coroutine on the storage event loop and return its result."""
+        return self.loop.run_until_complete(coro)
+
+    async def container_client(self):
+        """Create the shared service and container clients on first use, inside the event loop."""
+        if self._container_client is None:
+            # Imported on first use, aiohttp is only required for the async backend
+            try:
+                import aiohttp
+                from azure.core.pipeline.transport import AioHttpTransport
+                from azure.storage.blob.aio import BlobServiceClient
+            except ImportError:
+                raise Exception("The async storage backend requires aiohttp, install it with: pip install aiohttp")
+
+            # Size the connection pool to the number of operations in flight
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+            self._service_client = BlobServiceClient.from_connection_string(
+                self.connection_string,
+                transport=AioHttpTransport(session=self._session, session_owner=False),
+            )
+            self._container_client = self._service_client.get_container_client(self.container_name)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        return self._container_client
+
+    async def list_manifests(self) -> list:
+        """Returns a list of the blob names in the manifests folder."""
+        CURRENT_MANIFESTS = []
+        try:
+            container_client = await self.container_client()
+            async for blob in container_client.list_blobs(name_starts_with="manifests/"):
+                CURRENT_MANIFESTS.append(blob.name.rsplit("/", 1)[1])
+
+        except Exception as ex:
+            logger.error("Error: " + str(ex))
+
+        return CURRENT_MANIFESTS
+
+    async def download(self, file_name: str) -> tuple:
+        """Returns the content and etag of the manifest, or None if it could not be downloaded."""
+        try:
+            container_client = await self.container_client()
+            async with self._semaphore:
+                with span("storage.get", **{"manifest.name": file_name}):
+                    blob_data = await container_client.download_blob("manifests/" + file_name)
+                    return await blob_data.readall(), blob_data.properties.etag
+
+        except Exception as ex:
+            logger.error("Error: " + str(ex))
+
+    async def upload(self, file_name: str, data: bytes, etag: str = None, tags: dict = None) -> bool:
+        """
+        Upload a manifest, returns False if it failed.
+
+        With an etag, the manifest is only written if it was not changed since it was read.
+        """
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceModifiedError
+
+        conditions = {"etag": etag, "match_condition": MatchConditions.IfNotModified} if etag is not None else {}
+        try:
+            container_client = await self.container_client()
+            async with self._semaphore:
+                with span("storage.put", **{"manifest.name": file_name, "manifest.bytes": len(data)}):
+                    await container_client.upload_blob(
+                        "manifests/" + file_name, data, overwrite=True, tags=tags, **conditions
+                    )
+            return True
+
+        except ResourceModifiedError:
+            logger.error(f"Error: Manifest {file_name} was changed after it was read")
+            return False
+
+        except Exception as ex:
+            logger.error("Error: " + str(ex))
+            return False
+
+    async def delete(self, file_name: str) -> None:
+        try:
+            container_client = await self.container_client()
+            async with self._semaphore:
+                await container_client.delete_blob("manifests/" + file_name)
+
+        except Exception as ex:
+            logger.error("Error: " + str(ex))
+
+    async def delete_many(self, file_names: list) -> None:
+        await asyncio.gather(*[self.delete(file_name) for file_name in file_names])
+
+    async def aclose(self) -> None:
+        if self._service_client is not None:
+            await self._service_client.close()
+            await self._session.close()
+            self._service_client = None
+            self._container_client = None
+
+    def close(self) -> None:
+        """Close the client and the event loop."""
+        if not self.loop.is_closed():
+            self.run(self.aclose())
+            self.loop.close()
@@ -4,30 +4,32 @@
 This module is used to create clients for Azure Storage.
 """
 
-from azure.storage.blob import BlobServiceClient, ContainerClient
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
 from munki_manifest_generator.logger import logger
 
+if TYPE_CHECKING:
+    from azure.storage.blob import BlobServiceClient, ContainerClient
 
-def az_container_client(connection_string: str, container_name: str) -> ContainerClient:
-    """Create a container client to get the list of files in the container."""
-    try:
-        blob_source_service_client = BlobServiceClient.from_connection_string(connection_string)
-        container_client = blob_source_service_client.get_container_client(container_name)
 
-        return container_client
+@lru_cache(maxsize=None)
+def az_service_client(connection_string: str) -> "BlobServiceClient":
+    """Create a service client for the connection string, shared so its connection pool is reused."""
+    # Imported on first use to keep the command line start up fast
+    from azure.storage.blob import BlobServiceClient
 
-    except Exception as ex:
-        logger.error("Error: " + str(ex))
+    return BlobServiceClient.from_connection_string(connection_string)
 
 
-def az_blob_client(connection_string: str, container_name: str, file_name: str) -> BlobServiceClient:
-    """Create a blob client to get the file from the container."""
+def az_container_client(connection_string: str, container_name: str) -> "ContainerClient":
+    """Create a container client to get the list of files in the container."""
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-
-        blob_client = blob_service_client.get_blob_client(container=container_name + "/manifests", blob=file_name)
+        blob_source_service_client = az_service_client(connection_string)
+        container_client = blob_source_service_client.get_container_client(container_name)
 
-        return blob_client
+        return container_client
 
     except Exception as ex:
         logger.error("Error: " + str(ex))
+
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+"""
+This module records Graph and storage traffic of a run to an archive and replays it, so a run can be reproduced offline.
+"""
+
+import re
+import gzip
+import json
+import time
+import plistlib
+import threading
+import urllib.parse
+
+from munki_manifest_generator.device import Device
+from munki_manifest_generator.logger import logger
+from munki_manifest_generator.storage.memory_backend import MemoryBackend
+from munki_manifest_generator.storage.storage_backend import StorageBackend
+
+# The archive being recorded or replayed, set by start_recording and start_replay
+ARCHIVE = None
+# Azure AD device id of devices that are not registered
+EMPTY_OBJECT_ID = "00000000-0000-0000-0000-000000000000"
+# Fields of a user object that are used, the object id and the UPN to map memberships back to the UPN
+USER_FIELDS = ("id", "userPrincipalName", "accountEnabled")
+
+
+def get_archive():
+    return ARCHIVE
+
+
+def request_key(method: str, url: str, body=None) -> str:
+    """Returns the key a request is recorded under."""
+    return "%s %s %s" % (method, url, json.dumps(body, sort_keys=True) if body is not None else "")
+
+
+class TrafficArchive:
+    """
+    Graph responses and manifests recorded during a run.
+
+    $batch requests are recorded per sub-request, as the grouping of sub-requests into batches and their ids
+    change between runs. Every response to a request is kept in order, so throttled responses are replayed
+    before the response that succeeded.
+    """
+
+    def __init__(self, path: str, replay: bool = False, latency=None):
+        self.path = path
+        self.replaying = replay
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.manifest_list = []
+        self.manifests = {}
+        self.positions = {}
+        # Seconds each storage operation took, by operation and manifest name
+        self.storage_times = {}
+        self.storage_means = {}
+        # Serial numbers, UPNs and object ids seen in recorded devices, replaced when the archive is saved
+        self.serial_numbers = set()
+        self.upns = set()
+        self.object_ids = set()
+        # Manifests that are not for a device keep their names
+        self.keep_manifests = {"site_default"}
+
+        if replay:
+            with gzip.open(path, "rt") as f:
+                data = json.load(f)
+            self.requests = data["requests"]
+            self.manifest_list = data["manifest_list"]
+            self.manifests = data["manifests"]
+            self.storage_times = data.get("storage_times", {})
+            # Operations that were not recorded, such as writes of a run that changed more, take the mean time
+            totals = {}
+            for key, elapsed in self.storage_times.items():
+                total = totals.setdefault(key.split(" ", 1)[0], [0, 0])
+                total[0] += elapsed
+                total[1] += 1
+            self.storage_means = {operation: total / count for operation, (total, count) in totals.items()}
+            logger.info(f"Replaying {len(self.requests)} requests and {len(self.manifests)} manifests from {path}")
+
+    def wait(self, elapsed: float) -> None:
+        """Inject latency for a replayed request, the recorded time or a fixed number of seconds."""
+        if self.latency == "recorded":
+            time.sleep(elapsed)
+        elif self.latency:
+            time.sleep(float(self.latency))
+
+    def record(self, key: str, response, elapsed: float) -> None:
+        # Keep a copy, paged responses are extended after they are returned
+        response = json.loads(json.dumps(response))
+        with self.lock:
+            self.requests.setdefault(key, []).append({"response": response, "elapsed": elapsed})
+
+            # Batch sub-responses have the response in the body
+            body = response.get("body", response) if isinstance(response, dict) else None
+            values = body.get("value") if isinstance(body, dict) else None
+            for i, val in enumerate(values if isinstance(values, list) else []):
+                if isinstance(val, dict):
+                    if val.get("serialNumber"):
+                        # Keep only the fields of a managed device that are used, not names or email addresses
+                        device = Device.from_graph(val).to_dict()
+                        # Devices of group members are filtered by operating system
+                        if "operatingSystem" in val:
+                            device["operatingSystem"] = val["operatingSystem"]
+                        values[i] = val = device
+                        self.serial_numbers.add(val["serialNumber"])
+                        self.object_ids.update(
+                            value for value in (val["azureADDeviceId"], val["userId"]) if value is not None
+                        )
+                    elif val.get("userPrincipalName"):
+                        # Users looked up by UPN, keep only the fields that are used, not names or email addresses
+                        values[i] = val = {key: val[key] for key in USER_FIELDS if key in val}
+                        if val.get("id"):
+                            self.object_ids.add(val["id"])
+                    if val.get("userPrincipalName"):
+                        self.upns.add(val["userPrincipalName"])
+
+    def replay(self, key: str):
+        """Returns the next recorded response and its elapsed time, or None if the request was not recorded."""
+        with self.lock:
+            entries = self.requests.get(key)
+            if not entries:
+                logger.warning(f"Request not found in archive: {key}")
+                return None, 0
+            position = self.positions.get(key, 0)
+            # Repeat the last response once all responses have been replayed
+            self.positions[key] = min(position + 1, len(entries) - 1)
+            entry = entries[position]
+
+        # Return a copy, paged responses are extended by the caller
+        return json.loads(json.dumps(entry["response"])), entry["elapsed"]
+
+    def record_get(self, endpoint: str, q_param: dict, response: dict, elapsed: float) -> None:
+        self.record(request_key("GET", endpoint, q_param), response, elapsed)
+
+    def replay_get(self, endpoint: str, q_param: dict) -> dict:
+        response, elapsed = self.replay(request_key("GET", endpoint, q_param))
+        self.wait(elapsed)
+        return response if response is not None else {"value": []}
+
+    def record_post(self, endpoint: str, jdata: str, response: dict, elapsed: float) -> None:
+        data = json.loads(jdata) if jdata else None
+        # Record each sub-request of a batch with its own response
+        if isinstance(data, dict) and "requests" in data and isinstance(response, dict):
+            responses = {r.get("id"): r for r in response.get("responses", [])}
+            for req in data["requests"]:
+                sub_response = responses.get(req["id"])
+                if sub_response is not None:
+                    sub_response = {key: val for key, val in sub_response.items() if key != "id"}
+                    self.record(request_key(req["method"], req["url"], req.get("body")), sub_response, elapsed)
+        else:
+            self.record(request_key("POST", endpoint, data), response, elapsed)
+
+    def replay_post(self, endpoint: str, jdata: str) -> dict:
+        data = json.loads(jdata) if jdata else None
+        if isinstance(data, dict) and "requests" in data:
+            responses = []
+            batch_elapsed = 0
+            for req in data["requests"]:
+                sub_response, elapsed = self.replay(request_key(req["method"], req["url"], req.get("body")))
+                if sub_response is None:
+                    sub_response = {"status": 404, "headers": {}, "body": {"error": {"message": "Not in archive"}}}
+                responses.append(dict(sub_response, id=req["id"]))
+                batch_elapsed = max(batch_elapsed, elapsed)
+            self.wait(batch_elapsed)
+            return {"responses": responses}
+
+        response, elapsed = self.replay(request_key("POST", endpoint, data))
+        self.wait(elapsed)
+        return response
+
+    def record_manifest_list(self, names: list) -> None:
+        self.manifest_list = list(names)
+
+    def record_storage(self, operation: str, name: str, elapsed: float) -> None:
+        # Keep the time of the first operation on a manifest, the one that is replayed for it
+        with self.lock:
+            self.storage_times.setdefault(f"{operation} {name}".rstrip(), elapsed)
+
+    def storage_time(self, operation: str, name: str = "") -> float:
+        """Returns the recorded seconds of a storage operation, or the mean of the operation if not recorded."""
+        return self.storage_times.get(f"{operation} {name}".rstrip(), self.storage_means.get(operation, 0))
+
+    def record_manifest(self, name: str, data: bytes) -> None:
+        plist_data = plistlib.loads(data)
+        with self.lock:
+            # Keep the manifest as it was before the run changed it
+            if name in self.manifests:
+                return
+            # Stored as XML so serial numbers and UPNs in the manifest can be anonymized
+            self.manifests[name] = plistlib.dumps(plist_data).decode()
+            if plist_data.get("user"):
+                self.upns.add(plist_data["user"])
+
+    def record_groups(self, names: list) -> None:
+        """Names of group and safe manifests, other manifests are named by serial number and are anonymized."""
+        self.keep_manifests.update(names)
+
+    def recording_backend(self, storage: StorageBackend) -> StorageBackend:
+        return RecordingBackend(storage, self)
+
+    def replay_backend(self) -> StorageBackend:
+        return ReplayBackend(self)
+
+    def anonymize(self, data):
+        """Returns the data with recorded serial numbers, UPNs and object ids replaced by stable placeholders."""
+        replacements = {}
+        serial_numbers = self.serial_numbers | {name for name in self.manifest_list if name not in self.keep_manifests}
+        for i, serial_number in enumerate(sorted(serial_numbers)):
+            replacements[serial_number.lower()] = "SERIAL%06d" % i
+        for i, upn in enumerate(sorted(self.upns)):
+            replacements[upn.lower()] = "user%06d@example.com" % i
+        # Device and user object ids are also in group members and in request URLs, the empty id is kept
+        for i, object_id in enumerate(sorted(self.object_ids - {EMPTY_OBJECT_ID})):
+            replacements[object_id.lower()] = "00000000-0000-0000-0000-%012d" % (i + 1)
+        # UPNs are URL encoded in user lookups
+        for value, placeholder in list(replacements.items()):
+            replacements[urllib.parse.quote(value).lower()] = urllib.parse.quote(placeholder)
+
+        if not replacements:
+            return data
+
+        values = sorted(replacements, key=len, reverse=True)
+        pattern = re.compile(
+            r"(?<![A-Za-z0-9])(%s)(?![A-Za-z0-9])" % "|".join(re.escape(value) for value in values), re.IGNORECASE
+        )
+        text = pattern.sub(lambda match: replacements[match.group(0).lower()], json.dumps(data))
+
+        return json.loads(text)
+
+    def save(self) -> None:
+        """Anonymize and write the recorded traffic to the archive."""
+        data = self.anonymize(
+            {
+                "version": 1,
+                "recorded": time.time(),
+                "requests": self.requests,
+                "manifest_list": self.manifest_list,
+                "manifests": self.manifests,
+                "storage_times": self.storage_times,
+            }
+        )
+        with gzip.open(self.path, "wt") as f:
+            json.dump(data, f)
+        logger.info(f"Recorded {len(self.requests)} requests and {len(self.manifests)} manifests to {self.path}")
+
+
+class RecordingBackend(StorageBackend):
+    """Records the manifest listing and downloaded manifests of the wrapped storage."""
+
+    def __init__(self, storage: StorageBackend, archive: TrafficArchive):
+        self.storage = storage
+        self.archive = archive
+
+    def __repr__(self):
+        return repr(self.storage)
+
+    def list(self) -> list:
+        start = time.time()
+        names = self.storage.list()
+        self.archive.record_storage("list", "", time.time() - start)
+        self.archive.record_manifest_list(names)
+        return names
+
+    def get(self, name: str) -> tuple:
+        start = time.time()
+        data, etag = self.storage.get(name)
+        self.archive.record_storage("get", name, time.time() - start)
+        self.archive.record_manifest(name, data)
+        return data, etag
+
+    def put(self, name: str, data: bytes, etag: str = None, tags: dict = None) -> str:
+        start = time.time()
+        new_etag = self.storage.put(name, data, etag, tags)
+        self.archive.record_storage("put", name, time.time() - start)
+        return new_etag
+
+    def find(self, tags: dict) -> list:
+        return self.storage.find(tags)
+
+    def delete(self, name: str, etag: str = None) -> None:
+        start = time.time()
+        self.storage.delete(name, etag)
+        self.archive.record_storage("delete", name, time.time() - start)
+
+    def close(self) -> None:
+        self.storage.close()
+
+
+class ReplayBackend(MemoryBackend):
+    """In-memory storage with the recorded manifests, listed manifests that were not downloaded are empty."""
+
+    def __init__(self, archive: TrafficArchive):
+        self.archive = archive
+        self.seeded = False
+        manifests = {name: plistlib.dumps({}) for name in archive.manifest_list}
+        manifests.update({name: data.encode() for name, data in archive.manifests.items()})
+        super().__init__(manifests)
+        self.seeded = True
+
+    def __repr__(self):
+        return "replay:" + self.archive.path
+
+    def wait(self, operation: str, name: str = "") -> None:
+        # Seeding the store on start is not delayed
+        if self.seeded:
+            self.archive.wait(self.archive.storage_time(operation, name))
+
+    def list(self) -> list:
+        self.wait("list")
+        return super().list()
+
+    def get(self, name: str) -> tuple:
+        self.wait("get", name)
+        return super().get(name)
+
+    def put(self, name: str, data: bytes, etag: str = None, tags: dict = None) -> str:
+        self.wait("put", name)
+        return super().put(name, data, etag, tags)
+
+    def delete(self, name: str, etag: str = None) -> None:
+        self.wait("delete", name)
+        super().delete(name, etag)
+
+
+def start_recording(path: str) -> TrafficArchive:
+    global ARCHIVE
+    ARCHIVE = TrafficArchive(path)
+    return ARCHIVE
+
+
+def start_replay(path: str, latency=None) -> TrafficArchive:
+    global ARCHIVE
+    ARCHIVE = TrafficArchive(path, replay=True, latency=latency)
+    return ARCHIVE
+
+
+def stop() -> None:
+    """Save the archive if recording and stop recording or replaying."""
+    global ARCHIVE
+    if ARCHIVE is not None and not ARCHIVE.replaying:
+        ARCHIVE.save()
+    ARCHIVE = None
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""
+This module keeps a progress journal for a run so an interrupted run can be resumed.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from munki_manifest_generator.logger import logger
+
+# Checkpoints older than this are discarded instead of resumed
+CHECKPOINT_MAX_AGE = 24 * 60 * 60
+
+
+def get_run_key(**config) -> str:
+    """Returns a hash of the run configuration, a checkpoint is only resumed by a run with the same key."""
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def compact_group_response(response: dict, key: str) -> dict:
+    """Returns the membership response with only the fields used to match groups."""
+    return {
+        key: response.get(key, ""),
+        "value": [{"id": val.get("id"), "displayName": val.get("displayName")} for val in response.get("value", [])],
+    }
+
+
+def compact_group_responses(responses: list, key: str) -> list:
+    """Returns the membership responses with only the fields used to match groups."""
+    return [compact_group_response(response, key) for response in responses]
+
+
+class Checkpoint:
+    """Progress journal stored as JSON lines, records completed stages and reconciled serial numbers."""
+
+    def __init__(self, path, run_key, time_budget=None):
+        self.path = path
+        self.run_key = run_key
+        self.deadline = time.time() + time_budget if time_budget else None
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.reconciled = set()
+        self._file = None
+
+        if self.path:
+            self.load()
+
+    def load(self) -> None:
+        """Load the journal if it belongs to this run configuration, else start a new one."""
+        entries = []
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # The last line can be incomplete if the run was killed while writing
+                        break
+
+        header = entries[0] if entries else {}
+        if header.get("run") == self.run_key and time.time() - header.get("started", 0) < CHECKPOINT_MAX_AGE:
+            for entry in entries[1:]:
+                if "stage" in entry:
+                    self.stages[entry["stage"]] = entry.get("data")
+                elif "serial" in entry:
+                    self.reconciled.add(entry["serial"])
+            self._file = open(self.path, "a")
+            logger.info(
+                f"Resuming from checkpoint {self.path}, {len(self.stages)} stages completed, "
+                f"{len(self.reconciled)} devices reconciled"
+            )
+        else:
+            if entries:
+                logger.info(f"Checkpoint {self.path} is stale or for another configuration, starting over")
+            self._file = open(self.path, "w")
+            self.write({"run": self.run_key, "started": time.time()})
+
+    def write(self, entry: dict) -> None:
+        if self._file is None:
+            return
+        with self.lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def stage(self, name: str):
+        """Returns the data of a completed stage, or None if the stage has not completed."""
+        return self.stages.get(name)
+
+    def complete_stage(self, name: str, data=True) -> None:
+        if self._file is None:
+            return
+        self.stages[name] = data
+        self.write({"stage": name, "data": data})
+
+    def is_reconciled(self, serial_number: str) -> bool:
+        return serial_number in self.reconciled
+
+    def mark_reconciled(self, serial_number: str) -> None:
+        if self._file is None:
+            return
+        with self.lock:
+            self.reconciled.add(serial_number)
+        self.write({"serial": serial_number})
+
+    def out_of_time(self) -> bool:
+        """Returns True if the time budget for the run is spent."""
+        return self.deadline is not None and time.time() > self.deadline
+
+    def finish(self) -> None:
+        """Remove the journal after a completed run."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.path)
+
+    def close(self) -> None:
+        """Close the journal and keep it so the next run can resume."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info(f"Checkpoint saved to {self.path}, rerun with the same options to resume")
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+"""
+This module keeps the group config of the last successful run and applies changes to it to the affected manifests only.
+"""
+
+import os
+import json
+import hashlib
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+from munki_manifest_generator.logger import logger
+from munki_manifest_generator.manifest_diff import diff_manifest, log_manifest_diff
+from munki_manifest_generator.manifest_tags import manifest_tags, find_tagged_manifests
+from munki_manifest_generator.manifest_encoding import dumps_manifest, loads_manifest
+from munki_manifest_generator.graph.get_group_members import get_member_serial_numbers
+from munki_manifest_generator.azstorage.az_storage_actions import get_manifest, put_manifest
+from munki_manifest_generator.stats import log_config_diff_stats
+
+
+def group_key(group: dict) -> str:
+    """Returns the key of a group config entry, a group can be in the config more than once with another name."""
+    return f'{group["type"]}:{group["id"]}:{group["name"]}'
+
+
+def group_hash(group: dict) -> str:
+    """Returns a hash of every field of a group config entry."""
+    return hashlib.sha256(json.dumps(group, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+class GroupConfigDiff:
+    """Group config entries added, removed, changed and renamed since the last successful run."""
+
+    def __init__(self, added: list, removed: list, changed: list, renamed: list, unchanged: int, tagged: bool = False):
+        # Added and changed are group config entries, removed are the names of the removed entries
+        # and renamed are (old name, new entry)
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.renamed = renamed
+        self.unchanged = unchanged
+        # If every manifest was tagged by an earlier full run, so the affected manifests can be found by tags
+        self.tagged = tagged
+
+    @property
+    def empty(self) -> bool:
+        return not (self.added or self.removed or self.changed or self.renamed)
+
+    def counts(self) -> dict:
+        return {
+            "added": len(self.added),
+            "removed": len(self.removed),
+            "changed": len(self.changed),
+            "renamed": len(self.renamed),
+            "unchanged": self.unchanged,
+        }
+
+
+class ConfigState:
+    """
+    Hashes of the group config entries and the default catalog of the last successful run, stored as JSON.
+
+    The state also records if a full run with --tag_manifests tagged every manifest, manifests written
+    before tags were added or by a run without tags have none and are not found by their tags.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict:
+        """Returns the saved state, or None if there is none."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning(f"Config state {self.path} can not be read, ignoring it")
+            return None
+
+    def save(self, groups: list, default_catalog: str, tagged: bool = None) -> None:
+        # tagged is None if the run wrote tags with the manifests it wrote, then every manifest stays tagged
+        # if it was before. A run that wrote manifests without tags passes False.
+        if tagged is None:
+            tagged = (self.load() or {}).get("tagged", False)
+        state = {
+            "default_catalog": default_catalog,
+            "groups": {group_key(g): group_hash(g) for g in groups},
+            "tagged": tagged,
+        }
+        # Write to a temporary file first so an interrupted save does not leave a partial state
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+    def diff(self, groups: list, default_catalog: str) -> GroupConfigDiff:
+        """
+        Returns the changes to the group config since the last successful run.
+
+        Returns None if there is no saved state or the default catalog changed, every manifest needs a full run then.
+        """
+        state = self.load()
+        if state is None:
+            logger.info(f"No group config from a previous run in {self.path}")
+            return None
+        if state.get("default_catalog") != default_catalog:
+            logger.info("Default catalog changed since the last run")
+            return None
+
+        previous = state.get("groups", {})
+        current = {group_key(g): g for g in groups}
+        added = [g for key, g in current.items() if key not in previous]
+        removed = [key for key in previous if key not in current]
+        changed = [g for key, g in current.items() if key in previous and previous[key] != group_hash(g)]
+        unchanged = len(current) - len(added) - len(changed)
+
+        # An entry removed and one added with the same group id and type is a renamed group manifest,
+        # the devices that include the old name are the members of the group
+        renamed = []
+        for key in list(removed):
+            group_type, group_id, name = key.split(":", 2)
+            matches = [g for g in added if g["type"] == group_type and g["id"] == group_id]
+            if len(matches) == 1 and len([k for k in removed if k.startswith(f"{group_type}:{group_id}:")]) == 1:
+                renamed.append((name, matches[0]))
+                added.remove(matches[0])
+                removed.remove(key)
+
+        removed = [key.split(":", 2)[2] for key in removed]
+        return GroupConfigDiff(added, removed, changed, renamed, unchanged, state.get("tagged", False))
+
+
+def apply_config_diff(
+    storage,
+    groups: list,
+    diff: GroupConfigDiff,
+    current_manifests: list,
+    default_catalog: str,
+    test: bool,
+    get_token,
+    safe_manifest: str = None,
+    write_tags: bool = False,
+) -> list:
+    """
+    Update only the manifests affected by the changes to the group config.
+
+    Manifests that include a changed, removed or renamed group manifest get their catalogs recomputed
+    and renamed group manifests replaced, found by their tags if every manifest was tagged, or else by
+    reading all manifests. Only the members of added groups are looked up in Graph and get the new group
+    manifest. Manifests of removed groups are kept, the next full run decides if the device is still a member.
+    Manifests are written with their tags if write_tags is True or every manifest was tagged.
+
+    Returns the names of the manifests that failed to update.
+    """
+    existing = set(current_manifests)
+    # Keep the tags of tagged manifests, so they are found by their tags in the next run
+    write_tags = write_tags or diff.tagged
+    renames = {old: new["name"] for old, new in diff.renamed}
+    affected = {g["name"] for g in diff.changed} | set(diff.removed) | set(renames)
+    group_catalogs = [(g["name"], g["catalog"]) for g in groups if g.get("catalog") is not None]
+
+    # Look up the members of added groups with an existing manifest, the other groups are not queried
+    additions = {}
+    queried = [g for g in diff.added if g["name"] in existing]
+    if queried:
+        token = get_token()
+        for group in queried:
+            for serial_number in get_member_serial_numbers([group], [], token):
+                additions.setdefault(serial_number, []).append(group["name"])
+
+    # Manifests that are not device manifests are never changed
+    not_devices = {g["name"] for g in groups} | set(diff.removed) | set(renames) | {"site_default"}
+    not_devices |= set((safe_manifest or "").split(","))
+    device_manifests = [name for name in current_manifests if name not in not_devices]
+
+    candidates = []
+    if affected and not diff.tagged:
+        logger.info("Manifests were not tagged by a full run with --tag_manifests, reading all manifests")
+        candidates = device_manifests
+    elif affected:
+        try:
+            candidates = find_tagged_manifests(storage, sorted(affected), [])
+            logger.info(f"Found {len(candidates)} of {len(device_manifests)} manifests by their tags")
+        except Exception as ex:
+            logger.info(f"{ex}, reading all manifests instead")
+            candidates = device_manifests
+    candidates = [name for name in dict.fromkeys(candidates + list(additions)) if name in existing]
+    candidates = [name for name in candidates if name not in not_devices]
+    missing = [serial_number for serial_number in additions if serial_number not in existing]
+
+    def update(name: str) -> bool:
+        data, etag = get_manifest(storage, name)
+        current = loads_manifest(data)
+        included = current.get("included_manifests") or []
+        if not affected.intersection(included) and name not in additions:
+            return False
+
+        desired = [renames.get(manifest, manifest) for manifest in included] + additions.get(name, [])
+        changes = diff_manifest(
+            current, desired, desired, existing, group_catalogs, default_catalog, current.get("user")
+        )
+        if not changes.changed:
+            return False
+
+        log_manifest_diff(name, changes)
+        if not test:
+            manifest_data = changes.apply(current)
+            # Only write if the manifest was not changed since it was read
+            tags = manifest_tags(manifest_data) if write_tags else None
+            put_manifest(storage, name, dumps_manifest(manifest_data), etag, tags)
+        return True
+
+    def safe_update(name: str) -> bool:
+        # Returns None if the manifest failed to update
+        try:
+            return update(name)
+        except Exception as ex:
+            logger.error("Error: " + str(ex))
+            return None
+
+    workers = min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(workers, thread_name_prefix="mmg-config") as executor:
+        # Run in a copy of the context so storage spans are children of the current span
+        updated = list(executor.map(lambda name: contextvars.copy_context().run(safe_update, name), candidates))
+
+    log_config_diff_stats(
+        diff.counts(),
+        len(queried),
+        len(groups),
+        len(candidates),
+        updated.count(True),
+        len(device_manifests),
+        len(missing),
+    )
+    return [name for name, result in zip(candidates, updated) if result is None]
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the compact record used for managed devices.
+"""
+
+
+class Device:
+    """Compact record of a managed device, holds only the fields used to create and update manifests."""
+
+    __slots__ = ("serial_number", "azure_ad_device_id", "user_principal_name", "enrolled_date_time", "user_id")
+
+    def __init__(self, serial_number, azure_ad_device_id, user_principal_name, enrolled_date_time, user_id=None):
+        self.serial_number = serial_number
+        self.azure_ad_device_id = azure_ad_device_id
+        self.user_principal_name = user_principal_name
+        self.enrolled_date_time = enrolled_date_time
+        # Azure AD object id of the user, used to query the memberships of the user without looking up the UPN
+        self.user_id = user_id
+
+    @classmethod
+    def from_graph(cls, device: dict) -> "Device":
+        """Create a device from a managed device returned by Graph."""
+        return cls(
+            device.get("serialNumber"),
+            device.get("azureADDeviceId"),
+            device.get("userPrincipalName"),
+            device.get("enrolledDateTime"),
+            device.get("userId"),
+        )
+
+    def to_dict(self) -> dict:
+        """Returns the device with the field names used by Graph."""
+        return {
+            "serialNumber": self.serial_number,
+            "azureADDeviceId": self.azure_ad_device_id,
+            "userPrincipalName": self.user_principal_name,
+            "enrolledDateTime": self.enrolled_date_time,
+            "userId": self.user_id,
+        }
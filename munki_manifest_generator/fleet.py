@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""
+This module evaluates group memberships, group manifests and catalogs for all devices at once.
+"""
+
+import logging
+
+from munki_manifest_generator.logger import logger
+
+
+def iter_bits(mask: int):
+    """Yields the positions of the set bits, lowest first."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class FleetMembership:
+    """
+    Configured group memberships of every device as bitsets.
+
+    Devices are numbered by their position in the device list and groups by their position in the
+    group config. Each device has a bitset of the groups it is in. The group manifests and catalogs
+    of a device come out of a few bit operations, computed once for every distinct set of groups and
+    shared by the devices that have it.
+    """
+
+    def __init__(
+        self,
+        devices: list,
+        groups: list,
+        current_manifests: list,
+        device_group_responses: list,
+        user_group_responses: list,
+        default_catalog: str = "Production",
+    ):
+        self.groups = groups
+        self.default_catalog = default_catalog
+        self.rows = {device.serial_number: row for row, device in enumerate(devices) if device.serial_number}
+
+        # Bits of the group config entries for each group id, a group can be in the config more than once
+        self.id_masks = {}
+        self.device_type_mask = 0
+        self.user_type_mask = 0
+        self.existing_mask = 0
+        # Set of the manifest names in storage and the catalogs of group manifests, used to diff device manifests
+        self.existing_manifests = current_manifests = set(current_manifests)
+        self.group_catalogs = [
+            (group["name"], group["catalog"]) for group in groups if group.get("catalog") is not None
+        ]
+        for i, group in enumerate(groups):
+            self.id_masks[group["id"]] = self.id_masks.get(group["id"], 0) | 1 << i
+            if group["type"] == "device":
+                self.device_type_mask |= 1 << i
+            elif group["type"] == "user":
+                self.user_type_mask |= 1 << i
+            if group["name"] in current_manifests:
+                self.existing_mask |= 1 << i
+
+        # Azure AD names of the configured groups as returned in the responses
+        self.display_names = {}
+        device_members = self.index_responses(device_group_responses, "deviceId")
+        user_members = self.index_responses(user_group_responses, "userPrincipalName")
+
+        # Groups found for each device and its user, None if nothing was found
+        self.device_groups = [device_members.get(device.azure_ad_device_id) for device in devices]
+        self.user_groups = [user_members.get(device.user_principal_name) for device in devices]
+
+        self._desired = {}
+
+    def index_responses(self, responses: list, key: str) -> dict:
+        """Returns a dict of Azure AD device id or UPN to the bitset of configured groups and names of other groups."""
+        members = {}
+        for response in responses:
+            values = response.get("value")
+            if not response.get(key) or not values:
+                continue
+            mask, other_names = members.get(response[key], (0, ()))
+            for val in values:
+                bits = self.id_masks.get(val.get("id"))
+                if bits:
+                    mask |= bits
+                    self.display_names.setdefault(val["id"], val.get("displayName"))
+                else:
+                    other_names += (val.get("displayName"),)
+            members[response[key]] = (mask, other_names)
+
+        return members
+
+    def effective_mask(self, row: int) -> int:
+        """Returns the bitset of groups that decide the manifests of the device, by group type."""
+        mask = 0
+        if self.device_groups[row] is not None:
+            mask |= self.device_groups[row][0] & self.device_type_mask
+        if self.user_groups[row] is not None:
+            mask |= self.user_groups[row][0] & self.user_type_mask
+        return mask
+
+    def desired(self, mask: int) -> tuple:
+        """Returns the group manifests to include and the catalogs for a bitset of groups."""
+        result = self._desired.get(mask)
+        if result is None:
+            included = [self.groups[i]["name"] for i in iter_bits(mask & self.existing_mask)]
+            catalogs = [self.default_catalog]
+            for i in iter_bits(mask & self.existing_mask):
+                catalog = self.groups[i].get("catalog")
+                if catalog is not None and catalog not in catalogs:
+                    catalogs.insert(0, catalog)
+            result = (included, catalogs)
+            self._desired[mask] = result
+
+        return result
+
+    def catalogs(self, device) -> list:
+        """Returns the catalogs of a device from its groups with existing manifests."""
+        return list(self.desired(self.effective_mask(self.rows[device.serial_number]))[1])
+
+    def group_manifests(self, device) -> list:
+        """Returns the existing manifests of the configured groups the device and its user are in."""
+        return self.desired(self.effective_mask(self.rows[device.serial_number]))[0]
+
+    def member_names(self, members: tuple) -> list:
+        mask, other_names = members
+        return [self.display_names.get(self.groups[i]["id"]) for i in iter_bits(mask)] + list(other_names)
+
+    def apply(self, device, device_manifest) -> list:
+        """
+        Adds the group manifests of the device to its included manifests.
+
+        Returns the names of the groups the device and its user are in.
+        """
+        row = self.rows[device.serial_number]
+        serial_number = device_manifest.serialnumber
+        group_membership = []
+
+        for members, type_mask, kind in (
+            (self.device_groups[row], self.device_type_mask, "Device"),
+            (self.user_groups[row], self.user_type_mask, "User"),
+        ):
+            # Only check the groups if groups of this type are in the JSON or list
+            if not type_mask:
+                continue
+
+            if members is None:
+                if kind == "User":
+                    logger.warning("[%s] User not found in any groups", serial_number)
+                continue
+
+            names = self.member_names(members)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[%s] %s found in groups: %s", serial_number, kind, ", ".join(map(str, names)))
+                logger.debug("[%s] Groups from JSON or list: %s", serial_number, str(self.groups))
+
+            for i in iter_bits(members[0] & type_mask):
+                name = self.groups[i]["name"]
+                if self.existing_mask >> i & 1:
+                    if name not in device_manifest.included_manifests:
+                        logger.info(
+                            "[%s] %s found in group for %s, adding included manifest for group",
+                            serial_number,
+                            kind,
+                            name,
+                        )
+                        device_manifest.included_manifests.append(name)
+                else:
+                    logger.info(
+                        "[%s] %s found in group for %s but manifest does not exist, skipping", serial_number, kind, name
+                    )
+
+            group_membership += names
+
+        return group_membership
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+"""
+This module is used to check membership of the configured groups with the checkMemberGroups action.
+"""
+
+from munki_manifest_generator.graph.concurrent_batch import iter_batch_request
+
+# checkMemberGroups accepts up to 20 group ids per request
+GROUP_IDS_PER_REQUEST = 20
+
+
+def check_member_groups(data: list, url: str, batch_type: str, groups: list, token: dict, extra_url: str = "") -> list:
+    """
+    Batch check which of the groups the devices or users are transitive members of.
+
+    :param data: Responses with the ids to address the devices or users by
+    :param url: Url of the objects before the id, "devices(deviceId='" or "users/"
+    :param batch_type: "device" or "user"
+    :param groups: Groups from the JSON or list to check
+    :param token: The access token
+    :param extra_url: Url after the id, "')" to close the deviceId alternate key
+    :return: Responses shaped like transitiveMemberOf responses, with only the matching groups
+    """
+
+    group_names = {group["id"]: group["name"] for group in groups}
+    group_ids = list(group_names)
+    object_type = "deviceId" if batch_type == "device" else "userPrincipalName"
+    members = {}
+
+    # Group configs with more than 20 groups are checked in chunks and merged per object
+    for i in range(0, len(group_ids), GROUP_IDS_PER_REQUEST):
+        body = {"groupIds": group_ids[i : i + GROUP_IDS_PER_REQUEST]}
+        responses = iter_batch_request(
+            data, url, extra_url + "/checkMemberGroups", batch_type, token, method="POST", body=body
+        )
+        # Merge the group ids of each response as its batch is done, the responses are not kept
+        for response in responses:
+            members.setdefault(response.get(object_type, ""), set()).update(response.get("value", []))
+
+    return [
+        {
+            object_type: key,
+            "value": [
+                {"id": group_id, "displayName": group_names[group_id]} for group_id in group_ids if group_id in ids
+            ],
+        }
+        for key, ids in members.items()
+    ]
@@ -5,32 +5,64 @@ import time
 import urllib.parse
 import logging
 import threading
+import contextvars
 
+from collections import Counter
 from munki_manifest_generator.graph.make_api_request import make_api_request_Post
 from munki_manifest_generator.logger import logger
+from munki_manifest_generator.tracing import span
 
 
-batches = []
+def odata_string(value: str) -> str:
+    """Escape a value for use in a quoted string of an OData filter."""
+    return value.replace("'", "''")
 
 
-def get_data(ids: list, url: str, extra_url: str, batch_type: str, token: dict, method: str) -> dict:
-    """Create a batch request to the Graph API"""
+def get_data(ids: list, url: str, extra_url: str, batch_type: str, token: dict, method: str, body=None) -> tuple:
+    """Create a batch request to the Graph API, returns the sub-requests and the response"""
 
     # Remove empty strings and the default GUID from the list of ids
     unique_ids = set(ids) - {"00000000-0000-0000-0000-000000000000"} - {""}
     # Create a list of dictionaries with the id, method and url of the request
     if batch_type == "deviceId":
-        requests = [{"id": i, "method": method, "url": f"{url}?$filter=deviceId eq '{i}'"} for i in unique_ids]
+        requests = [
+            {"id": i, "method": method, "url": f"{url}?$filter=deviceId eq '{odata_string(i)}'"} for i in unique_ids
+        ]
+    elif batch_type == "azureADDeviceId":
+        requests = [
+            {"id": i, "method": method, "url": f"{url}?$filter=azureADDeviceId eq '{odata_string(i)}'"}
+            for i in unique_ids
+        ]
+    elif batch_type == "serialNumber":
+        requests = [
+            {
+                "id": i,
+                "method": method,
+                "url": f"{url}?$filter=serialNumber eq '{odata_string(i)}' and operatingSystem eq 'macOS'",
+            }
+            for i in unique_ids
+        ]
     elif batch_type == "upn":
         requests = [
             {
                 "id": f"{i}_{int(time.time() * 1000)}",
                 "method": method,
-                "url": f"{url}?$filter=userPrincipalName eq '{urllib.parse.quote(i)}'",
+                "url": f"{url}?$filter=userPrincipalName eq '{urllib.parse.quote(odata_string(i))}'",
             }
             for i in unique_ids
             if i
         ]
+    elif (batch_type == "user" or batch_type == "device") and body is not None:
+        requests = [
+            {
+                "id": i,
+                "method": method,
+                "url": url + i + extra_url,
+                "body": body,
+                "headers": {"Content-Type": "application/json"},
+            }
+            for i in unique_ids
+        ]
     elif batch_type == "user" or batch_type == "device":
         requests = [
             {
@@ -46,10 +78,22 @@ def get_data(ids: list, url: str, extra_url: str, batch_type: str, token: dict,
         requests = [{"id": i, "method": method, "url": url + i + extra_url} for i in unique_ids]
 
     # Create a dictionary with the key "requests" and the value being the list of dictionaries
-    batches.append(requests)
     json_data = json.dumps({"requests": requests})
     # Make the request to the Graph API
-    return make_api_request_Post("https://graph.microsoft.com/beta/$batch", token, jdata=json_data)
+    with span("graph.batch", **{"graph.batch.type": batch_type or "", "graph.batch.requests": len(requests)}) as s:
+        response = make_api_request_Post("https://graph.microsoft.com/beta/$batch", token, jdata=json_data)
+
+        # Record the status of the sub-requests and the longest Retry-After of throttled sub-requests
+        sub_responses = response.get("responses", []) if isinstance(response, dict) else []
+        statuses = Counter(r.get("status") for r in sub_responses)
+        s.set_attributes({f"graph.batch.status.{status}": count for status, count in statuses.items()})
+        retry_after = [
+            int(r.get("headers", {}).get("Retry-After", 0)) for r in sub_responses if r.get("status") in (429, 503)
+        ]
+        if retry_after:
+            s.set_attribute("graph.batch.retry_after", max(retry_after))
+
+    return requests, response
 
 
 def batch_request(
@@ -60,8 +104,27 @@ def batch_request(
     token: dict,
     method="GET",
     retry_pool=None,
+    body=None,
 ) -> list:
     """Create concurrent batch requests to the Graph API"""
+    return list(iter_batch_request(data, url, extra_url, batch_type, token, method, body=body))
+
+
+def iter_batch_request(
+    data: list,
+    url: str,
+    extra_url: str,
+    batch_type: str,
+    token: dict,
+    method="GET",
+    body=None,
+):
+    """
+    Create concurrent batch requests to the Graph API and yield the body of each successful sub-request.
+
+    Bodies are yielded as soon as their batch is done, so they can be consumed while the other batches
+    are in flight. Throttled sub-requests are retried once all batches are done.
+    """
 
     # If the type is "device" or "user", get the ids from the data
     get_ids = False
@@ -103,7 +166,7 @@ def batch_request(
     batch_list = [ids[i : i + batch_count] for i in range(0, len(ids), batch_count)]
     batch_id = 0
 
-    def get_response_body(response) -> None:
+    def get_response_body(requests, response) -> None:
         """Get the response body from the batch request"""
 
         # Make the retry_pool variable
@@ -116,11 +179,12 @@ def batch_request(
 
             if r["body"].get("value") is not None:
                 for val in r["body"]["value"]:
-                    if val.get("accountEnabled") is False:
+                    # checkMemberGroups returns a list of group ids instead of objects
+                    if isinstance(val, dict) and val.get("accountEnabled") is False:
                         logger.info(f"Skipping disabled account: {val.get('userPrincipalName')}")
                         continue
 
-            # if the status code is 200, append the response body to the responses list
+            # if the status code is 200, append the response body to the responses of the batch
             if r["status"] == 200:
                 if get_ids:
                     r["body"][object_type] = id_to_object.get(r["id"], "")
@@ -134,19 +198,21 @@ def batch_request(
                     if retry_pool is not None:
                         retry_pool.append(batch)
                 else:
-                    # Append the id to the retry pool
-                    batch = {"value": [{"id": r["id"]}]}
+                    # Append the id to the retry pool, upn request ids are suffixed with a timestamp
+                    retry_id = r["id"].rsplit("_", 1)[0] if batch_type == "upn" else r["id"]
                     if retry_pool is not None:
-                        retry_pool.append(batch)
+                        retry_pool.append(retry_id)
                 # Get the wait time from the response headers
                 wait_time = int(r["headers"].get("Retry-After", 0))
+            # Devices are addressed by the deviceId alternate key, a device that is not in Azure AD is not found
+            # and is not a member of any group
+            elif r["status"] == 404 and batch_type == "device":
+                logger.debug(f'No Azure AD device for {r["id"]}')
+                responses.append({"value": [], object_type: id_to_object.get(r["id"], "")})
             # Else, log the error
             else:
                 if logger.isEnabledFor(logging.DEBUG):
-                    failed_batch_request = next(
-                        (i for i in batches for j in i if any(v == r["id"] for k, v in j.items())),
-                        None,
-                    )
+                    failed_batch_request = next((request for request in requests if request["id"] == r["id"]), None)
 
                     if failed_batch_request:
                         logger.debug("Failed batch request: %s" % failed_batch_request)
@@ -155,34 +221,41 @@ def batch_request(
     # Create a thread pool and submit the requests
     with concurrent.futures.ThreadPoolExecutor() as executor:
         future_to_id = {
-            executor.submit(get_data, batch, url, extra_url, batch_type, token, method): batch_id for batch in batch_list
+            # Run in a copy of the context so batch spans are children of the current span
+            executor.submit(
+                contextvars.copy_context().run, get_data, batch, url, extra_url, batch_type, token, method, body
+            ): batch_id
+            for batch in batch_list
         }
         # Get the responses from the requests
         for future in concurrent.futures.as_completed(future_to_id):
             # batch_id = future_to_id[future]
             try:
-                response = future.result()["responses"]
-                get_response_body(response)
+                requests, response = future.result()
+                get_response_body(requests, response["responses"])
 
             except Exception as exc:
                 logger.warning(f"Exception {exc} for batch {batch_id} from thread {threading.current_thread().name}")
 
             batch_id += 1
 
+            # Hand the bodies of the batch to the caller, neither they nor the future are kept here
+            del future_to_id[future]
+            yield from responses
+            responses.clear()
+
     # If the retry pool is not empty, make another batch request
     if retry_pool is not None and retry_pool:  # check if the "value" key of retry_pool is not empty
         retry_batch = retry_pool
         if wait_time > 0:
             logger.info(f"Waiting {wait_time} seconds before retrying batch request")
             time.sleep(wait_time)
-        responses += batch_request(
+        yield from iter_batch_request(
             retry_batch,
             url,
             extra_url,
             batch_type,
             token,
             method,
-            retry_pool=retry_pool,
+            body=body,
         )
-
-    return responses
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+This module is used to get managed devices from Intune.
+"""
+
+import re
+import time
+import calendar
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+from munki_manifest_generator.device import Device
+from munki_manifest_generator.logger import logger
+from munki_manifest_generator.graph.concurrent_batch import batch_request
+from munki_manifest_generator.graph.make_api_request import make_api_request
+
+# Devices enrolled before this are fetched with the first partition of a partitioned fetch
+PARTITION_START = "2015-01-01T00:00:00Z"
+
+# Serial numbers are looked up with an OData filter, anything else is rejected before it is sent to Graph
+SERIAL_NUMBER_PATTERN = re.compile(r"^[A-Za-z0-9]+$")
+
+
+def is_valid_serial_number(serial_number) -> bool:
+    """Returns True if the serial number only contains letters and digits."""
+    return isinstance(serial_number, str) and SERIAL_NUMBER_PATTERN.fullmatch(serial_number) is not None
+
+
+def latest_enrolled_devices(devices: list) -> list:
+    """Returns one device per serial number, keeping the latest enrolled device."""
+
+    latest = {}
+    for device in devices:
+        current = latest.get(device.serial_number)
+        if current is None or device.enrolled_date_time > current.enrolled_date_time:
+            latest[device.serial_number] = device
+
+    return list(latest.values())
+
+
+def get_devices_by_serial(serial_numbers: list, token: dict) -> list:
+    """Batch get managed devices by serial number, returns the latest enrolled device for each serial."""
+
+    responses = batch_request(serial_numbers, "deviceManagement/managedDevices", "", "serialNumber", token)
+    devices = [Device.from_graph(device) for response in responses for device in response.get("value", [])]
+
+    return latest_enrolled_devices(devices)
+
+
+def enrollment_windows(partitions: int, now: float = None) -> list:
+    """
+    Returns (start, end) enrollment times that split the time since PARTITION_START into equal windows.
+
+    The first window has no start and the last no end, so together they cover every enrollment time.
+    """
+    first = calendar.timegm(time.strptime(PARTITION_START, "%Y-%m-%dT%H:%M:%SZ"))
+    step = ((now or time.time()) - first) / partitions
+    bounds = [time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(first + step * i)) for i in range(1, partitions)]
+
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def get_devices_partitioned(endpoint: str, token: dict, device_filter: str, partitions: int) -> list:
+    """
+    Get managed devices by paging enrollment time windows concurrently, returns the devices as returned by Graph.
+
+    The number of devices is checked against the @odata.count of the filter. If the windows did not return
+    every device, for example because devices enrolled during the fetch, all devices are fetched in one query.
+    """
+    # Only the first page is needed for the count
+    count = make_api_request(
+        endpoint, token, {"$filter": device_filter, "$count": "true", "$top": "1"}, follow_next_link=False
+    ).get("@odata.count")
+
+    def get_window(window):
+        start, end = window
+        window_filter = device_filter
+        if start:
+            window_filter += f" and enrolledDateTime ge {start}"
+        if end:
+            window_filter += f" and enrolledDateTime lt {end}"
+        return make_api_request(endpoint, token, {"$filter": window_filter})["value"]
+
+    with ThreadPoolExecutor(partitions, thread_name_prefix="mmg-fetch") as executor:
+        # Run in a copy of the context so request spans are children of the current span
+        windows = [
+            executor.submit(contextvars.copy_context().run, get_window, window)
+            for window in enrollment_windows(partitions)
+        ]
+        devices = [device for window in windows for device in window.result()]
+
+    if count is None:
+        logger.warning("Graph did not return a device count, the partitioned fetch could not be checked")
+    elif len(devices) != count:
+        logger.warning(
+            f"Partitioned fetch returned {len(devices)} of {count} devices, fetching all devices in one query..."
+        )
+        devices = make_api_request(endpoint, token, {"$filter": device_filter})["value"]
+    else:
+        logger.info(f"Fetched {count} devices in {partitions} partitions")
+
+    return devices
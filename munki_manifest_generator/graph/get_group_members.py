@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+"""
+This module is used to get the managed devices of group members and users.
+"""
+
+from munki_manifest_generator.graph.make_api_request import make_api_request
+from munki_manifest_generator.graph.concurrent_batch import batch_request
+
+GROUPS_ENDPOINT = "https://graph.microsoft.com/v1.0/groups/"
+
+
+def get_member_serial_numbers(groups: list, upns: list, token: dict) -> list:
+    """
+    Returns the serial numbers of the macOS devices of the transitive members of the groups and of the users.
+
+    Members of device groups are matched to managed devices by Azure AD device id, members of user groups
+    by UPN.
+    """
+    device_ids = []
+    upns = list(upns)
+    for group in groups:
+        members = make_api_request(
+            GROUPS_ENDPOINT + group["id"] + "/transitiveMembers", token, {"$select": "id,deviceId,userPrincipalName"}
+        )
+        for member in members.get("value", []):
+            if group["type"] == "device" and member.get("deviceId"):
+                device_ids.append(member["deviceId"])
+            elif group["type"] == "user" and member.get("userPrincipalName"):
+                upns.append(member["userPrincipalName"])
+
+    responses = batch_request(device_ids, "deviceManagement/managedDevices", "", "azureADDeviceId", token)
+    responses += batch_request(upns, "deviceManagement/managedDevices", "", "upn", token)
+
+    return list(
+        dict.fromkeys(
+            device["serialNumber"]
+            for response in responses
+            for device in response.get("value", [])
+            if device.get("operatingSystem") == "macOS" and device.get("serialNumber")
+        )
+    )
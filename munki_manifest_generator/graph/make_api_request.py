@@ -4,18 +4,37 @@
 This module is used to make API requests to the Graph API.
 """
 
-import requests
 import json
+import time
+import functools
 
-from retrying import retry
 
-@retry(
-    wait_exponential_multiplier=1000,
-    wait_exponential_max=10000,
-    stop_max_attempt_number=5,
-)
-def make_api_request(endpoint, token, q_param=None):
-    """Makes a get request and returns the response."""
+def retry_request(func):
+    """Retry the request with exponential backoff, retrying is imported on the first call."""
+    retrying_func = None
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        nonlocal retrying_func
+        if retrying_func is None:
+            from retrying import retry
+
+            retrying_func = retry(
+                wait_exponential_multiplier=1000,
+                wait_exponential_max=10000,
+                stop_max_attempt_number=5,
+            )(func)
+        return retrying_func(*args, **kwargs)
+
+    return wrapper
+
+
+@retry_request
+def make_api_request(endpoint, token, q_param=None, follow_next_link=True):
+    """Makes a get request and returns the response, with the values of all pages unless follow_next_link is False."""
+    import requests
+    from munki_manifest_generator.capture import get_archive
+
     # Create a valid header using the provided access token
 
     headers = {
@@ -23,22 +42,34 @@ def make_api_request(endpoint, token, q_param=None):
         "Authorization": "Bearer {0}".format(token["access_token"]),
     }
 
+    # If replaying a recorded run, return the recorded response
+    archive = get_archive()
+    if archive is not None and archive.replaying:
+        response = None
+        json_data = archive.replay_get(endpoint, q_param)
+
     # This section handles a bug with the Python requests module which
     # encodes blank spaces to plus signs instead of %20.  This will cause
     # issues with OData filters
 
-    if q_param is not None:
+    elif q_param is not None:
+        start = time.time()
         response = requests.get(endpoint, headers=headers, params=q_param)
     else:
+        start = time.time()
         response = requests.get(endpoint, headers=headers)
-    if response.status_code == 200:
-        json_data = json.loads(response.text)
+
+    if response is None or response.status_code == 200:
+        if response is not None:
+            json_data = json.loads(response.text)
+            if archive is not None:
+                archive.record_get(endpoint, q_param, json_data, time.time() - start)
 
         # This section handles paged results and combines the results
         # into a single JSON response.  This may need to be modified
         # if results are too large
 
-        if "@odata.nextLink" in json_data.keys():
+        if follow_next_link and "@odata.nextLink" in json_data.keys():
             record = make_api_request(json_data["@odata.nextLink"], token)
             entries = len(record["value"])
             count = 0
@@ -51,11 +82,7 @@ def make_api_request(endpoint, token, q_param=None):
         raise Exception("Request failed with ", response.status_code, " - ", response.text)
 
 
-@retry(
-    wait_exponential_multiplier=1000,
-    wait_exponential_max=10000,
-    stop_max_attempt_number=5,
-)
+@retry_request
 def make_api_request_Post(endpoint, token, q_param=None, jdata=None, status_code=200):
     """
     This function makes a POST request to the Microsoft Graph API.
@@ -67,11 +94,20 @@ def make_api_request_Post(endpoint, token, q_param=None, jdata=None, status_code
     :param status_code: The status code to expect from the request.
     """
 
+    import requests
+    from munki_manifest_generator.capture import get_archive
+
     headers = {
         "Content-Type": "application/json",
         "Authorization": "Bearer {0}".format(token["access_token"]),
     }
 
+    # If replaying a recorded run, return the recorded response
+    archive = get_archive()
+    if archive is not None and archive.replaying:
+        return archive.replay_post(endpoint, jdata)
+
+    start = time.time()
     if q_param is not None:
         response = requests.post(endpoint, headers=headers, params=q_param, data=jdata)
     else:
@@ -79,6 +115,8 @@ def make_api_request_Post(endpoint, token, q_param=None, jdata=None, status_code
     if response.status_code == status_code:
         if response.text:
             json_data = json.loads(response.text)
+            if archive is not None:
+                archive.record_post(endpoint, jdata, json_data, time.time() - start)
             return json_data
         else:
             pass
@@ -4,9 +4,6 @@
 This module contains the functions used to get the access token for MS Graph.
 """
 
-
-from msal import ConfidentialClientApplication, PublicClientApplication
-
 AUTHORITY = "https://login.microsoftonline.com/"
 SCOPE = ["https://graph.microsoft.com/.default"]
 
@@ -21,6 +18,8 @@ def obtain_accesstoken_app(TENANT_NAME, CLIENT_ID, CLIENT_SECRET):
     :return: The access token
     """
 
+    from msal import ConfidentialClientApplication
+
     # Create app instance
     app = ConfidentialClientApplication(
         client_id=CLIENT_ID,
@@ -57,6 +56,8 @@ def obtain_accesstoken_cert(TENANT_NAME, CLIENT_ID, THUMBPRINT, KEY_FILE):
     :return: The access token
     """
 
+    from msal import ConfidentialClientApplication
+
     # Create app instance
     app = ConfidentialClientApplication(
         client_id=CLIENT_ID,
@@ -94,6 +95,8 @@ def obtain_accesstoken_interactive(TENANT_NAME, CLIENT_ID):
     :return: The access token
     """
 
+    from msal import PublicClientApplication
+
     # Create app instance
     app = PublicClientApplication(
         client_id=CLIENT_ID,
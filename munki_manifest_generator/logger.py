@@ -1,8 +1,11 @@
+import atexit
 import logging
+import queue
 import sys
 import threading
 
-from logging.handlers import RotatingFileHandler
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 
 class CustomFormatter(logging.Formatter):
@@ -26,38 +29,117 @@ class CustomFormatter(logging.Formatter):
             logging.ERROR: self.error_fmt,
             logging.CRITICAL: self.error_fmt,
         }
+        # Create the formatters once instead of for every record
+        self.FORMATTERS = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()}
 
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.FORMATTERS.get(record.levelno)
+        if formatter is None:
+            formatter = logging.Formatter(self.FORMATS.get(record.levelno))
         return formatter.format(record)
 
 
+class SummaryFilter(logging.Filter):
+    """Counts per device INFO records, "[serial] message", instead of emitting them"""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def filter(self, record):
+        msg = str(record.msg)
+        if record.levelno != logging.INFO or not msg.startswith("[") or "] " not in msg:
+            return True
+
+        message = msg.split("] ", 1)[1]
+        # Messages formatted before logging include the values, count them by the text before the values
+        if not record.args:
+            message = message.split(":", 1)[0]
+
+        with self.lock:
+            self.counts[message.replace("%s", "*")] += 1
+
+        return False
+
+
 class CustomLogger(logging.Logger):
-    """Custom logger class with multiple destinations"""
+    """Custom logger class with multiple destinations, records are written by a background listener"""
 
-    def __init__(self, name, log_file=None):
+    def __init__(self, name):
         super().__init__(name)
-        self.lock = threading.Lock()  # create a lock object
-        handler = logging.StreamHandler(sys.stdout)
+        self.handler = None
+        self.output_handlers = []
+        self.listener = None
+        self.summary_filter = None
+
+    def setup(self, log_file=None, summary=False):
+        """
+        Add the console and file handlers, called when main runs so importing has no side effects.
+
+        Calling it again replaces the handlers of the previous call, so its log file and summary mode apply.
+        """
+        self.remove_handlers()
         info_fmt = "%(asctime)s [%(levelname)s] %(message)s"
         error_fmt = "%(asctime)s [%(levelname)s] %(message)s (%(filename)s:%(lineno)d:%(funcName)s)"
-        handler.setFormatter(CustomFormatter(fmt=info_fmt, error_fmt=error_fmt))
-        handler.setLevel(logging.INFO)
-        self.addHandler(handler)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(CustomFormatter(fmt=info_fmt, error_fmt=error_fmt))
+        stream_handler.setLevel(logging.INFO)
+        self.output_handlers.append(stream_handler)
         if log_file:
             file_handler = RotatingFileHandler(
                 log_file, mode="a", maxBytes=5 * 1024 * 1024, backupCount=2, encoding=None, delay=0
             )
             file_handler.setLevel(logging.INFO)
             file_handler.setFormatter(CustomFormatter(fmt=info_fmt, error_fmt=error_fmt))
-            self.addHandler(file_handler)
+            self.output_handlers.append(file_handler)
+
+        # Workers only enqueue records, one listener thread formats and writes them
+        log_queue = queue.SimpleQueue()
+        handler = QueueHandler(log_queue)
+        handler.setLevel(logging.INFO)
+        if summary:
+            self.summary_filter = SummaryFilter()
+            handler.addFilter(self.summary_filter)
+        self.addHandler(handler)
         self.handler = handler
 
-    def handle(self, record):
-        with self.lock:  # acquire the lock
-            super().handle(record)
-            self.handler.flush()
+        self.listener = QueueListener(log_queue, *self.output_handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.unregister(self.stop)
+        atexit.register(self.stop)
+
+    def remove_handlers(self):
+        """Write the queued records and remove the handlers added by setup"""
+        self.stop()
+        if self.handler is not None:
+            self.removeHandler(self.handler)
+            self.handler = None
+        for output_handler in self.output_handlers:
+            output_handler.close()
+        self.output_handlers = []
+        self.summary_filter = None
+
+    def set_level(self, level):
+        """Set the level of the queue and output handlers"""
+        for handler in self.handlers + self.output_handlers:
+            handler.setLevel(level)
+
+    def log_summary(self):
+        """Log the number of per device records counted in summary mode"""
+        if self.summary_filter is None:
+            return
+        with self.summary_filter.lock:
+            counts = self.summary_filter.counts.most_common()
+            self.summary_filter.counts.clear()
+        for message, count in counts:
+            self.info("%d x %s", count, message)
+
+    def stop(self):
+        """Write the queued records and stop the listener"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
 
 
-logger = CustomLogger(__name__, log_file="mmg.log")
+logger = CustomLogger(__name__)
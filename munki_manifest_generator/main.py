@@ -5,429 +5,1369 @@ This module creates and updates manifests for macOS devices in Intune.
 """
 
 import os
+import re
 import json
 import time
 import argparse
-import threading
+import contextvars
 
 from operator import itemgetter
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from munki_manifest_generator.device import Device
 from munki_manifest_generator.manifest import Manifest
 from munki_manifest_generator.graph.get_authentication_token import getAuth
 from munki_manifest_generator.graph.make_api_request import make_api_request
-from munki_manifest_generator.graph.get_device_group_membership import (
-    get_device_group_membership,
+from munki_manifest_generator.fleet import FleetMembership
+from munki_manifest_generator.graph.concurrent_batch import batch_request, iter_batch_request
+from munki_manifest_generator.graph.check_member_groups import check_member_groups
+from munki_manifest_generator.graph.get_devices import (
+    get_devices_by_serial,
+    get_devices_partitioned,
+    is_valid_serial_number,
+    latest_enrolled_devices,
 )
-from munki_manifest_generator.graph.get_user_group_membership import (
-    get_user_group_membership,
+from munki_manifest_generator.membership_cache import MembershipCache
+from munki_manifest_generator.checkpoint import (
+    Checkpoint,
+    get_run_key,
+    compact_group_response,
+    compact_group_responses,
 )
-from munki_manifest_generator.get_device_catalogs import get_device_catalogs
-from munki_manifest_generator.graph.concurrent_batch import batch_request
+from munki_manifest_generator.config_diff import ConfigState, apply_config_diff
+from munki_manifest_generator.storage.storage_backend import StorageBackend, get_storage_backend
+from munki_manifest_generator.capture import get_archive, start_recording, start_replay, stop as stop_capture
 
 from munki_manifest_generator.logger import logger
+from munki_manifest_generator.stages import StageGraph
+from munki_manifest_generator.tracing import span, current_span, setup_tracing, stop_tracing
+from munki_manifest_generator.stats import (
+    count_manifest_stat,
+    log_manifest_stats,
+    log_peak_memory,
+    log_time_to_first_manifest,
+    log_stage_times,
+)
+from munki_manifest_generator.manifest_encoding import dumps_manifest, loads_manifest, set_manifest_format
+from munki_manifest_generator.manifest_diff import diff_manifest, log_manifest_diff
+from munki_manifest_generator.manifest_tags import manifest_tags, find_tagged_manifests
+from munki_manifest_generator.graph.get_group_members import get_member_serial_numbers
 from munki_manifest_generator.azstorage.az_storage_actions import (
     get_current_manifest_blobs,
+    get_stale_manifests,
+    log_deleted_manifests,
     delete_manifest_blob,
-    update_manifest_blob,
-    update_current_upn,
-    get_current_device_manifest,
-    create_manifest_blob,
+    get_manifest,
+    put_manifest,
 )
 
 
-def main(**kwargs):
-    # Start timer
-    startTime = time.time()
+ENDPOINT = "https://graph.microsoft.com/v1.0/deviceManagement/managedDevices"
 
-    # Set variables to None
-    j = None
-    g = None
-    s = None
-    t = None
-    d = None
-    c = None
-    i = None
-    l = None
 
-    # If no kwargs are passed, parse arguments
-    if not kwargs:
-        argparser = argparse.ArgumentParser()
-        argparser.add_argument(
-            "-s",
-            "--serial_number",
-            help="Serial number to create or update a manifest for",
-        )
-        argparser.add_argument(
-            "-j",
-            "--json",
-            help="Path to JSON file containing AzureAD groups specifying manifests devices should be in.",
-        )
-        argparser.add_argument(
-            "-g",
-            "--group_list",
-            help="List of dicts containing AzureAD groups specifying manifests devices should be in.",
-        )
-        argparser.add_argument(
-            "-sm",
-            "--safe_manifest",
-            help="Manifests specified here are safe from deletion, site_default does not have to be specified.",
-        )
-        argparser.add_argument(
-            "-t",
-            "--test",
-            help="Enable testing, no changes will be made to manifests on Azure Storage.",
-            action="store_true",
-        )
-        argparser.add_argument(
-            "-d",
-            "--default_catalog",
-            help="Default catalog for all devices. If not specified, the default catalog will be 'Production'.",
+def load_groups(json_file, group_list) -> list:
+    """Returns the list of group manifests from a JSON file or list."""
+    if json_file:
+        with open(json_file, "r") as f:
+            return json.load(f)
+    elif group_list:
+        return group_list
+    else:
+        raise Exception("No JSON file or list provided")
+
+
+def parse_serial_numbers(serial_number) -> list:
+    """
+    Returns a list of serial numbers from a serial, a comma separated list, a list or a file with one serial per line.
+
+    Serial numbers that are not only letters and digits are logged as invalid and left out.
+    """
+    if isinstance(serial_number, str):
+        serial_number = [serial_number]
+
+    serials = []
+    for value in serial_number:
+        if os.path.isfile(value):
+            with open(value, "r") as f:
+                for line_number, line in enumerate(f, 1):
+                    serial = line.strip()
+                    if not serial or serial.startswith("#"):
+                        continue
+                    if is_valid_serial_number(serial):
+                        serials.append(serial)
+                    else:
+                        logger.error(f"Invalid serial number {serial!r} on line {line_number} of {value}, skipping...")
+        else:
+            for serial in value.split(","):
+                serial = serial.strip()
+                if not serial:
+                    continue
+                if is_valid_serial_number(serial):
+                    serials.append(serial)
+                else:
+                    logger.error(f"Invalid serial number {serial!r}, skipping...")
+
+    # Remove duplicates and keep the order
+    return list(dict.fromkeys(serials))
+
+
+# Devices enrolled within this many hours are reconciled with new devices, before the rest of the fleet
+RECENT_ENROLLMENT_HOURS = 24
+# Workers for new and recently enrolled devices, as a share of the default number of reconcile workers
+FAST_LANE_SHARE = 0.25
+
+# Keyword arguments of main with another name on the command line
+KWARG_ARGUMENTS = {"json_file": "json"}
+
+# UPNs of devices enrolled without a user contain a random identifier of letters and digits
+RANDOM_UUID_PATTERN = re.compile(r"[A-Za-z]+([0-9]+([A-Za-z]+[0-9]+)+).*@.*", re.IGNORECASE)
+
+
+def contains_random_uuid(upn) -> bool:
+    """Returns True if the UPN contains a random UUID."""
+    return RANDOM_UUID_PATTERN.search(upn) is not None
+
+
+def resolve_memberships(
+    keys: list,
+    kind: str,
+    groups: list,
+    token: dict,
+    membership_mode: str,
+    group_search_query: str,
+    cache: MembershipCache = None,
+    user_ids: dict = None,
+) -> list:
+    """
+    Batch get memberships for Azure AD device ids or UPNs, cached entries that have not expired are not queried.
+
+    Devices are addressed by their Azure AD device id with the deviceId alternate key, and users by the userId
+    of their managed device, so memberships are queried without looking up the directory objects first.
+    """
+    kind_groups = [group for group in groups if group["type"] == kind]
+    responses = []
+    object_ids = {}
+    if cache is not None:
+        responses, keys, object_ids = cache.get(kind, keys, kind_groups)
+
+    if kind == "device":
+        id_responses = [{"value": [{"id": k, "deviceId": k}]} for k in dict.fromkeys(keys)]
+        url, extra_url = "devices(deviceId='", "')"
+    else:
+        # User ids of the managed devices are used first, then the object ids of expired cache entries
+        known_ids = {}
+        for k in dict.fromkeys(keys):
+            i = (user_ids or {}).get(k) or object_ids.get(k)
+            # Devices without a user have an empty or default GUID as user id
+            if i and i != "00000000-0000-0000-0000-000000000000":
+                known_ids[k] = i
+        # Only UPNs without a known id, such as devices from an older checkpoint, are looked up
+        id_responses = batch_request([k for k in keys if k not in known_ids], "users", "", "upn", token)
+        id_responses += [{"value": [{"id": i, "userPrincipalName": k}]} for k, i in known_ids.items()]
+        url, extra_url = "users/", ""
+
+    if not id_responses:
+        return responses
+
+    if membership_mode == "check":
+        group_responses = check_member_groups(id_responses, url, kind, kind_groups, token, extra_url)
+    else:
+        if kind == "device":
+            bodies = iter_batch_request(
+                id_responses, url, extra_url + "/transitiveMemberOf?$search=%s" % group_search_query, "device", token
+            )
+        else:
+            bodies = iter_batch_request(
+                id_responses,
+                url,
+                "/transitiveMemberOf?$select=id,displayName&$search=%s" % group_search_query,
+                "user",
+                token,
+            )
+        # Keep only the group ids and names of each response as its batch is done, the full group
+        # objects are not held until all batches are done
+        key = "deviceId" if kind == "device" else "userPrincipalName"
+        group_responses = [compact_group_response(response, key) for response in bodies]
+
+    if cache is not None:
+        cache.put(kind, group_responses, id_responses, kind_groups)
+
+    return responses + group_responses
+
+
+def get_group_memberships(
+    devices: list,
+    groups: list,
+    token: dict,
+    membership_mode: str = "search",
+    cache: MembershipCache = None,
+    kinds: tuple = ("device", "user"),
+) -> tuple:
+    """
+    Batch get group memberships for all devices and users, returns device and user responses.
+
+    With membership_mode "search", transitiveMemberOf is searched for the group names. With "check",
+    checkMemberGroups is used to test only the configured group ids. Only the memberships of the
+    kinds passed are resolved, the responses of the other kind are empty.
+    """
+    device_group_responses = []
+    user_group_responses = []
+
+    AAD_DEVICE_IDS = [d.azure_ad_device_id for d in devices if d.azure_ad_device_id is not None]
+
+    UPNs = [d.user_principal_name for d in devices if d.user_principal_name is not None]
+    USER_IDS = {d.user_principal_name: d.user_id for d in devices if d.user_principal_name and d.user_id}
+
+    group_search = []
+    for group in groups:
+        group_search.append('"displayName:%s"' % group["name"])
+
+    group_search_query = f'({" OR ".join(group_search)})'
+
+    if "device" in kinds and "device" in map(itemgetter("type"), groups):
+        device_group_responses = resolve_memberships(
+            AAD_DEVICE_IDS, "device", groups, token, membership_mode, group_search_query, cache
         )
-        argparser.add_argument(
-            "-c",
-            "--certauth",
-            help="When using certificate auth, the following ENV variables is required: TENANT_NAME, CLIENT_ID, THUMBPRINT, KEY_FILE",
-            action="store_true",
+
+    if "user" in kinds and "user" in map(itemgetter("type"), groups):
+        user_group_responses = resolve_memberships(
+            UPNs, "user", groups, token, membership_mode, group_search_query, cache, USER_IDS
         )
-        argparser.add_argument(
-            "-i",
-            "--interactiveauth",
-            help="When using interactive auth, the following ENV variables is required: TENANT_NAME, CLIENT_ID",
-            action="store_true",
+
+    return device_group_responses, user_group_responses
+
+
+def build_device_manifest(
+    device: Device,
+    fleet: FleetMembership,
+    default_catalog: str,
+    current_device_manifest: dict = None,
+) -> dict:
+    """Returns the manifest to write for the device, or None if its current manifest is up to date."""
+
+    # If a manifest exists for the device, update it.
+    if current_device_manifest is not None:
+        logger.debug("[%s] Manifest found, checking for updates..." % device.serial_number)
+        device_manifest = Manifest(
+            catalogs=list(current_device_manifest["catalogs"]),
+            included_manifests=list(current_device_manifest["included_manifests"]),
+            display_name=current_device_manifest["display_name"],
+            serialnumber=current_device_manifest["serialnumber"],
+            user=current_device_manifest["user"],
         )
-        argparser.add_argument(
-            "-v",
-            "--version",
-            action="version",
-            version="%(prog)s (version {version})".format(version="0.0.1"),
+
+        group_membership = fleet.apply(device, device_manifest)
+
+        diff = diff_manifest(
+            current_device_manifest,
+            fleet.group_manifests(device),
+            group_membership,
+            fleet.existing_manifests,
+            fleet.group_catalogs,
+            default_catalog,
+            device.user_principal_name,
         )
-        argparser.add_argument(
-            "-l",
-            "--log",
-            help="Log level, default is INFO",
-            default="INFO",
-            choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        log_manifest_diff(device.serial_number, diff)
+
+        if diff.changed:
+            return diff.apply(current_device_manifest)
+
+        return None
+
+    # If no manifest exists for the device, create one.
+    logger.info("[%s] No manifest found, creating..." % device.serial_number)
+    device_manifest = Manifest(
+        catalogs=[default_catalog],
+        included_manifests=["site_default"],
+        display_name=device.serial_number,
+        serialnumber=device.serial_number,
+        user=device.user_principal_name,
+    )
+
+    fleet.apply(device, device_manifest)
+
+    device_manifest.catalogs = fleet.catalogs(device)
+
+    return device_manifest.to_dict()
+
+
+def process_device(
+    device: Device,
+    current_manifests: list,
+    fleet: FleetMembership,
+    storage: StorageBackend,
+    default_catalog: str,
+    test: bool,
+    tag_manifests: bool = False,
+    write_tags: bool = False,
+) -> bool:
+    """
+    Process each device, returns True if its manifest was written, False if unchanged and None if it failed.
+
+    Manifests are written with their blob index tags if write_tags or tag_manifests is True.
+    """
+
+    try:
+        # If a manifest exists for the device, read it to update it
+        current_device_manifest = None
+        etag = None
+        if device.serial_number in current_manifests:
+            data, etag = get_manifest(storage, device.serial_number)
+            current_device_manifest = loads_manifest(data)
+
+        manifest_data = build_device_manifest(device, fleet, default_catalog, current_device_manifest)
+
+        if manifest_data is not None and not test:
+            # Only write if the manifest was not changed since it was read
+            tags = manifest_tags(manifest_data) if write_tags or tag_manifests else None
+            put_manifest(storage, device.serial_number, dumps_manifest(manifest_data), etag, tags)
+            return True
+        elif tag_manifests and current_device_manifest is not None and not test:
+            # Write the unchanged manifest to tag it
+            put_manifest(storage, device.serial_number, data, etag, manifest_tags(current_device_manifest))
+            return True
+
+    except Exception as ex:
+        logger.error("Error: " + str(ex))
+        return None
+
+    return False
+
+
+def split_fast_lane(devices: list, current_manifests: list, checkpoint: Checkpoint = None) -> tuple:
+    """
+    Returns the devices to reconcile first and the rest, in the order they were returned.
+
+    Devices without a manifest and devices enrolled within RECENT_ENROLLMENT_HOURS go first,
+    munki on those devices has nothing or little to install until their manifest is written.
+    """
+    cutoff = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(time.time() - RECENT_ENROLLMENT_HOURS * 3600))
+    fast_lane = []
+    bulk = []
+    for device in devices:
+        if not device.serial_number:
+            continue
+        if checkpoint is not None and checkpoint.is_reconciled(device.serial_number):
+            continue
+        # Graph returns enrollment times as UTC ISO 8601 strings, which sort like the times they represent
+        if device.serial_number not in current_manifests or (device.enrolled_date_time or "")[:19] >= cutoff:
+            fast_lane.append(device)
+        else:
+            bulk.append(device)
+
+    return fast_lane, bulk
+
+
+def reconcile_devices(
+    devices: list,
+    fleet: FleetMembership,
+    storage: StorageBackend,
+    default_catalog: str,
+    test: bool,
+    checkpoint: Checkpoint = None,
+    started: float = None,
+    tag_manifests: bool = False,
+    write_tags: bool = False,
+) -> list:
+    """
+    Create or update manifests for the devices concurrently, returns the serial numbers of the written manifests.
+
+    New and recently enrolled devices are reconciled in a lane with its own workers, so they do not
+    wait behind updates of every other device. The time from the start of the run until
+    the manifest of each new device is written is logged.
+    """
+    started = started or time.time()
+    # The manifests listed when the fleet was indexed
+    current_manifests = fleet.existing_manifests
+    fast_lane, bulk = split_fast_lane(devices, current_manifests, checkpoint)
+    first_manifest_seconds = []
+    written = []
+
+    def reconcile_device(device):
+        # If the time budget is spent, skip the device so it is picked up when the run is resumed
+        if checkpoint is not None and checkpoint.out_of_time():
+            return
+        with span("device", **{"device.serial_number": device.serial_number}):
+            new = device.serial_number not in current_manifests
+            result = process_device(
+                device,
+                current_manifests,
+                fleet,
+                storage,
+                default_catalog,
+                test,
+                tag_manifests,
+                write_tags,
+            )
+            if result:
+                written.append(device.serial_number)
+                if new:
+                    first_manifest_seconds.append(time.time() - started)
+        # A device that failed is reconciled again when the run is resumed
+        if checkpoint is not None and result is not None:
+            checkpoint.mark_reconciled(device.serial_number)
+
+    # The fast lane has its own workers on top of the default number of workers of ThreadPoolExecutor,
+    # so the rest of the fleet is not slowed down once the fast lane is done
+    workers = min(32, (os.cpu_count() or 1) + 4)
+    fast_workers = max(1, int(workers * FAST_LANE_SHARE))
+    if fast_lane:
+        logger.info(f"Reconciling {len(fast_lane)} new or recently enrolled devices first")
+
+    fast_queue = deque(fast_lane)
+    bulk_queue = deque(bulk)
+
+    def work(queues):
+        # Take the next device from the first queue that is not empty, until all queues are empty
+        while True:
+            for queue in queues:
+                try:
+                    device = queue.popleft()
+                    break
+                except IndexError:
+                    continue
+            else:
+                return
+            try:
+                reconcile_device(device)
+            except Exception as e:
+                logger.error(f"Exception: {e}")
+
+    # Workers for the rest of the fleet help with the fast lane first, so a run where most devices are
+    # new, such as the first run, uses all workers
+    with ThreadPoolExecutor(fast_workers + workers, thread_name_prefix="mmg-reconcile") as executor:
+        futures = [
+            # Run in a copy of the context so device spans are children of the current span
+            executor.submit(contextvars.copy_context().run, work, (fast_queue,))
+            for _ in range(fast_workers)
+        ] + [executor.submit(contextvars.copy_context().run, work, (fast_queue, bulk_queue)) for _ in range(workers)]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Exception: {e}")
+
+    log_time_to_first_manifest(first_manifest_seconds, time.time() - started)
+    return written
+
+
+async def reconcile_devices_async(
+    devices: list,
+    fleet: FleetMembership,
+    async_storage,
+    default_catalog: str,
+    test: bool,
+    checkpoint: Checkpoint = None,
+    started: float = None,
+    tag_manifests: bool = False,
+    write_tags: bool = False,
+) -> list:
+    """
+    Create or update manifests for the devices from one thread, blob operations in flight are bounded by the storage.
+    Returns the serial numbers of the written manifests.
+
+    New and recently enrolled devices are started first, so they are first in line for the storage.
+    """
+    import asyncio
+
+    started = started or time.time()
+    # The manifests listed when the fleet was indexed
+    current_manifests = fleet.existing_manifests
+    fast_lane, bulk = split_fast_lane(devices, current_manifests, checkpoint)
+    first_manifest_seconds = []
+    written = []
+    if fast_lane:
+        logger.info(f"Reconciling {len(fast_lane)} new or recently enrolled devices first")
+
+    async def reconcile_device(device):
+        # If the time budget is spent, skip the device so it is picked up when the run is resumed
+        if checkpoint is not None and checkpoint.out_of_time():
+            return
+
+        with span("device", **{"device.serial_number": device.serial_number}):
+            current_device_manifest = None
+            etag = None
+            if device.serial_number in current_manifests:
+                downloaded = await async_storage.download(device.serial_number)
+                if downloaded is None:
+                    return
+                data, etag = downloaded
+                current_device_manifest = loads_manifest(data)
+
+            manifest_data = build_device_manifest(device, fleet, default_catalog, current_device_manifest)
+
+            if manifest_data is not None and not test:
+                data = dumps_manifest(manifest_data)
+                tags = manifest_tags(manifest_data) if write_tags or tag_manifests else None
+                # Only write if the manifest was not changed since it was read
+                if not await async_storage.upload(device.serial_number, data, etag, tags):
+                    return
+                count_manifest_stat(uploaded=1, uploaded_bytes=len(data))
+                written.append(device.serial_number)
+                if current_device_manifest is None:
+                    first_manifest_seconds.append(time.time() - started)
+            elif tag_manifests and current_device_manifest is not None and not test:
+                # Write the unchanged manifest to tag it
+                tags = manifest_tags(current_device_manifest)
+                if not await async_storage.upload(device.serial_number, data, etag, tags):
+                    return
+                count_manifest_stat(uploaded=1, uploaded_bytes=len(data))
+                written.append(device.serial_number)
+
+        # A device that failed returned above and is reconciled again when the run is resumed
+        if checkpoint is not None:
+            checkpoint.mark_reconciled(device.serial_number)
+
+    # Coroutines are started in order, so the fast lane acquires the storage semaphore first
+    results = await asyncio.gather(
+        *[reconcile_device(device) for device in fast_lane + bulk],
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Exception: {result}")
+
+    log_time_to_first_manifest(first_manifest_seconds, time.time() - started)
+    return written
+
+
+def get_intune_devices(serial_number, token: dict, partitions: int = None) -> list:
+    """
+    Returns the macOS devices for the serial numbers, or all macOS devices if no serial numbers are passed.
+
+    If a serial number is enrolled more than once, the latest enrolled device is used. When getting all
+    devices, devices with a UPN that contains a random UUID are left out. With more than one partition,
+    all devices are fetched in enrollment time windows paged at the same time.
+    """
+    # If serial numbers are passed, batch get the devices
+    if serial_number:
+        serials = parse_serial_numbers(serial_number)
+        devices = get_devices_by_serial(serials, token)
+
+        found = {device.serial_number for device in devices}
+        for serial in serials:
+            if serial not in found:
+                logger.error(f"Device with serial {serial} not found")
+
+        return devices
+
+    Q_PARAM = {"$filter": "operatingSystem eq 'macOS'"}
+    if partitions and partitions > 1:
+        devices = get_devices_partitioned(ENDPOINT, token, Q_PARAM["$filter"], partitions)
+    else:
+        devices = make_api_request(ENDPOINT, token, Q_PARAM)["value"]
+    # Keep only the fields used from each device, if the device is enrolled more than once,
+    # get the latest enrolled device
+    devices = latest_enrolled_devices([Device.from_graph(d) for d in devices])
+
+    # Remove devices that have a UPN that contains a random UUID
+    return [
+        d for d in devices if d.user_principal_name is not None if not contains_random_uuid(d.user_principal_name)
+    ]
+
+
+def get_targeted_serial_numbers(storage, groups: list, group_names: list, upns: list, token: dict) -> list:
+    """
+    Returns the serial numbers of the devices to reconcile for changed groups and users.
+
+    Manifests that include a group manifest or belong to a user are found by their blob index tags,
+    and the current members of the groups and devices of the users are looked up in Graph so devices
+    that just joined a group are reconciled too.
+    """
+    group_names = group_names or []
+    upns = upns or []
+    tagged = find_tagged_manifests(storage, group_names, upns)
+
+    configured = [group for group in groups if group["name"] in group_names]
+    for name in group_names:
+        if name not in [group["name"] for group in configured]:
+            logger.warning(f"Group {name} is not in the group config, only manifests that include it are reconciled")
+    members = get_member_serial_numbers(configured, upns, token)
+
+    logger.info(f"Found {len(tagged)} tagged manifests and {len(members)} member devices to reconcile")
+    return list(dict.fromkeys(tagged + members))
+
+
+def load_targets(targets) -> list:
+    """
+    Returns the targets of a multi-target run from a JSON file or list.
+
+    Each target is a dict with the storage option, "json" or "group_list" for its group config and
+    optionally "default_catalog", "safe_manifest", "replicas" to mirror its manifests to and a "name" to
+    log it by. The storage of each target is opened and its groups are loaded.
+    """
+    if isinstance(targets, str):
+        with open(targets, "r") as f:
+            targets = json.load(f)
+
+    if not targets:
+        raise Exception("No targets provided")
+
+    loaded = []
+    for target in targets:
+        storage = target.get("storage", "azure")
+        loaded.append(
+            {
+                "name": target.get("name") or str(storage),
+                "storage": get_storage_backend(storage, target.get("replicas")),
+                "groups": load_groups(target.get("json"), target.get("group_list")),
+                "default_catalog": target.get("default_catalog") or "Production",
+                "safe_manifest": target.get("safe_manifest"),
+            }
         )
 
-        args = argparser.parse_args()
+    return loaded
+
+
+def merge_groups(targets: list) -> list:
+    """Returns the groups of all targets, a group in more than one target is only included once."""
+    groups = {}
+    for target in targets:
+        for group in target["groups"]:
+            groups.setdefault((group["id"], group["type"]), group)
+
+    return list(groups.values())
+
+
+def reconcile_target(
+    target: dict,
+    devices: list,
+    device_group_responses: list,
+    user_group_responses: list,
+    serial_number,
+    test: bool,
+    started: float = None,
+    write_tags: bool = False,
+):
+    """
+    List the manifests of a target, delete its stale manifests and create or update the device manifests.
+
+    The devices and group memberships are shared by all targets, the memberships are indexed against
+    the groups of the target.
+    """
+    storage = target["storage"]
+    groups = target["groups"]
+    with span("target", **{"target.name": target["name"]}):
+        try:
+            current_manifests = get_current_manifest_blobs(storage)
+            logger.info(f'[{target["name"]}] Found {len(current_manifests)} current manifests')
+
+            fleet = FleetMembership(
+                devices,
+                groups,
+                current_manifests,
+                device_group_responses,
+                user_group_responses,
+                target["default_catalog"],
+            )
+
+            # If not passing a serial number, delete manifest for device if it is not in Intune
+            if not serial_number:
+                serial_numbers = [d.serial_number for d in devices if d.serial_number is not None]
+                delete_manifest_blob(storage, groups, serial_numbers, target["safe_manifest"], test, current_manifests)
+
+            reconcile_devices(
+                devices,
+                fleet,
+                storage,
+                target["default_catalog"],
+                test,
+                started=started,
+                write_tags=write_tags,
+            )
+
+        except Exception as ex:
+            logger.error(f'[{target["name"]}] Error: ' + str(ex))
+
+        finally:
+            storage.close()
+
+
+def get_argparser() -> argparse.ArgumentParser:
+    """Returns the parser of the command line arguments, its defaults are also used for keyword arguments of main."""
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "-s",
+        "--serial_number",
+        help="Serial numbers to create or update manifests for, separated by spaces or commas, or a path to a file with one serial per line",
+        nargs="+",
+    )
+    argparser.add_argument(
+        "-j",
+        "--json",
+        help="Path to JSON file containing AzureAD groups specifying manifests devices should be in.",
+    )
+    argparser.add_argument(
+        "-g",
+        "--group_list",
+        help="List of dicts containing AzureAD groups specifying manifests devices should be in.",
+    )
+    argparser.add_argument(
+        "--targets",
+        help="Path to a JSON file with a list of targets, each with a storage, a group config and optionally a default catalog and safe manifests. Devices and group memberships are fetched once and shared by all targets.",
+    )
+    argparser.add_argument(
+        "-sm",
+        "--safe_manifest",
+        help="Manifests specified here are safe from deletion, site_default does not have to be specified.",
+    )
+    argparser.add_argument(
+        "-t",
+        "--test",
+        help="Enable testing, no changes will be made to manifests on Azure Storage.",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "-d",
+        "--default_catalog",
+        help="Default catalog for all devices. If not specified, the default catalog will be 'Production'.",
+    )
+    argparser.add_argument(
+        "-c",
+        "--certauth",
+        help="When using certificate auth, the following ENV variables is required: TENANT_NAME, CLIENT_ID, THUMBPRINT, KEY_FILE",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "-i",
+        "--interactiveauth",
+        help="When using interactive auth, the following ENV variables is required: TENANT_NAME, CLIENT_ID",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "-v",
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version="0.0.1"),
+    )
+    argparser.add_argument(
+        "-l",
+        "--log",
+        help="Log level, default is INFO",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+    )
+    argparser.add_argument(
+        "--log_summary",
+        help="Log a summary of per device changes at the end of the run instead of a line per device at INFO.",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--membership_mode",
+        help="How group memberships are resolved, 'search' searches transitiveMemberOf for the group names, 'check' uses checkMemberGroups to test only the configured group ids. Default is search.",
+        default="search",
+        choices=["search", "check"],
+    )
+    argparser.add_argument(
+        "--cache",
+        help="Path to a SQLite file caching group memberships, only expired entries are queried from Graph.",
+    )
+    argparser.add_argument(
+        "--cache_ttl",
+        help="Seconds a cached group membership is used before it is queried again, default is 3600.",
+        type=int,
+    )
+    argparser.add_argument(
+        "--cache_invalidate",
+        help="Expire all cached group memberships before the run.",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--storage",
+        help="Where manifests are stored, 'azure' uses the container in CONTAINER_NAME and AZURE_STORAGE_CONNECTION_STRING, 'local:<path>' the manifests folder of a munki repo on disk, 'memory' an empty in-memory store for test runs. Default is azure.",
+        default="azure",
+    )
+    argparser.add_argument(
+        "--replicas",
+        help="Storage options of replicas to mirror every manifest change to, such as repos in other regions. 'azure:<container>@<variable>' for a container in another storage account with its connection string in the environment variable.",
+        nargs="+",
+    )
+    argparser.add_argument(
+        "--async_storage",
+        help="Use the async Azure Storage client to keep many blob operations in flight from one thread, requires aiohttp.",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--fetch_partitions",
+        help="Fetch all devices in this many enrollment time windows at the same time instead of one page after the other, the number of devices is checked against the count from Graph.",
+        type=int,
+    )
+    argparser.add_argument(
+        "--reconcile_group",
+        help="Only reconcile the devices with manifests that include these group manifests and the current members of the groups, manifests are found by their blob index tags.",
+        nargs="+",
+    )
+    argparser.add_argument(
+        "--reconcile_user",
+        help="Only reconcile the devices of these UPNs, manifests are found by their blob index tags.",
+        nargs="+",
+    )
+    argparser.add_argument(
+        "--manifest_tags",
+        help="Write blob index tags with the manifests, requires a SAS with the tag permission and is not supported by accounts with a hierarchical namespace. Implied by --tag_manifests, --reconcile_group and --reconcile_user.",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--tag_manifests",
+        help="Also write manifests that did not change so every manifest gets its blob index tags.",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--config_state",
+        help="Path to save hashes of the group config entries to after each successful run, used by --config_diff.",
+    )
+    argparser.add_argument(
+        "--config_diff",
+        help="Only apply the changes to the group config since the last successful run: query the members of added groups and recompute catalogs of the manifests with changed groups. Needs --config_state.",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--storage_concurrency",
+        help="Blob operations in flight with --async_storage, default is 100.",
+        type=int,
+    )
+    argparser.add_argument(
+        "--manifest_format",
+        help="Plist format manifests are written in, 'binary' plists are smaller and faster to read and write. Manifests in either format are read. Default is xml.",
+        default="xml",
+        choices=["xml", "binary"],
+    )
+    argparser.add_argument(
+        "--record",
+        help="Path to a compressed archive to record Graph responses and manifests to, serial numbers and UPNs are anonymized.",
+    )
+    argparser.add_argument(
+        "--replay",
+        help="Path to a recorded archive to run against instead of Graph and storage, no changes are made.",
+    )
+    argparser.add_argument(
+        "--replay_latency",
+        help="Latency added to each replayed request, seconds or 'recorded' to wait as long as the recorded request took.",
+    )
+    argparser.add_argument(
+        "--trace",
+        help="Export OpenTelemetry spans for the run, stages, Graph batches and devices. 'otlp' to export to OTEL_EXPORTER_OTLP_ENDPOINT or a path to a file to write spans to as JSON lines.",
+    )
+    argparser.add_argument(
+        "--checkpoint",
+        help="Path to a progress journal, an interrupted run resumes from it when run again with the same options.",
+    )
+    argparser.add_argument(
+        "--time_budget",
+        help="Seconds the run may take, the run stops before reconciling more devices and saves a checkpoint when spent.",
+        type=float,
+    )
+    argparser.add_argument(
+        "--service",
+        help="Run as a service that accepts serial numbers on POST /serial and keeps caches warm between requests.",
+        action="store_true",
+    )
+    argparser.add_argument(
+        "--host",
+        help="Host the service listens on, default is 127.0.0.1",
+        default="127.0.0.1",
+    )
+    argparser.add_argument(
+        "--port",
+        help="Port the service listens on, default is 8080",
+        default=8080,
+        type=int,
+    )
+
+    return argparser
+
+
+def main(**kwargs):
+    # Start timer
+    startTime = time.time()
+
+    # If no kwargs are passed, parse arguments
+    if not kwargs:
+        args = get_argparser().parse_args()
+
+        # Set up logging to the console and log file after parsing, --version and --help exit before this
+        logger.setup(log_file="mmg.log", summary=args.log_summary)
 
         if args.log:
-            for handler in logger.handlers:
-                handler.setLevel(args.log.upper())
+            logger.set_level(args.log.upper())
 
         if args.test:
             logger.info("*****Testing mode enabled, no changes will be made to manifests on Azure Storage*****")
 
-    # Else, set variables to kwargs
+    # Else, set the arguments to kwargs, arguments that are not passed have their default
     else:
-        s = kwargs.get("serial_number")
-        j = kwargs.get("json_file")
-        g = kwargs.get("group_list")
-        sm = kwargs.get("safe_manifest")
-        t = kwargs.get("test")
-        d = kwargs.get("default_catalog")
-        c = kwargs.get("certauth")
-        i = kwargs.get("interactiveauth")
-        l = kwargs.get("log")
+        args = get_argparser().parse_args([])
+        for key, value in kwargs.items():
+            setattr(args, KWARG_ARGUMENTS.get(key, key), value)
+
+        # Set up logging to the console and log file
+        logger.setup(log_file="mmg.log", summary=args.log_summary)
 
         # If log level is passed, set it
+        l = kwargs.get("log")
         if l:
             choices = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
             if l in choices:
-                for handler in logger.handlers:
-                    handler.setLevel(l.upper())
+                logger.set_level(l.upper())
             else:
                 raise Exception("Invalid log level, choose from: DEBUG, INFO, WARNING, ERROR, CRITICAL")
 
         # If testing is enabled, log it
-        if t:
+        if args.test:
             logger.info("*****Testing mode enabled, no changes will be made to manifests on Azure Storage*****")
 
-    def run(
-        json_file,
-        group_list,
-        serial_number,
-        SAFE_MANIFEST,
-        TEST,
-        DEFAULT_CATALOG,
-        CERTAUTH,
-        INTERACTIVEAUTH,
-    ):
-        # Check if required environment variables are set
-        if not all(
-            [
-                os.environ.get("CONTAINER_NAME"),
-                os.environ.get("AZURE_STORAGE_CONNECTION_STRING"),
-            ]
-        ):
-            raise Exception("Missing required environment variables, stopping...")
-
-        # Set variables
-        CONTAINER_NAME = os.environ.get("CONTAINER_NAME")
-        CONNECTION_STRING = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
-        ENDPOINT = "https://graph.microsoft.com/v1.0/deviceManagement/managedDevices"
+    def run(args):
+        """Run for the parsed arguments."""
+        # A single group or user can be passed as a string
+        RECONCILE_GROUPS = args.reconcile_group
+        if isinstance(RECONCILE_GROUPS, str):
+            RECONCILE_GROUPS = [RECONCILE_GROUPS]
+        RECONCILE_USERS = args.reconcile_user
+        if isinstance(RECONCILE_USERS, str):
+            RECONCILE_USERS = [RECONCILE_USERS]
+        if (RECONCILE_GROUPS or RECONCILE_USERS) and args.serial_number:
+            raise Exception("Serial numbers can not be passed with groups or users to reconcile")
+        # Only some devices are reconciled if serial numbers, groups or users are passed
+        partial = args.serial_number or RECONCILE_GROUPS or RECONCILE_USERS
+        # Manifests found by their tags are written with their tags so they are found again
+        write_tags = bool(args.manifest_tags or args.tag_manifests or RECONCILE_GROUPS or RECONCILE_USERS)
+
+        if args.config_diff and not args.config_state:
+            raise Exception("A config diff run needs the config state of the last run, pass --config_state")
+        if args.config_diff and (partial or args.checkpoint or args.time_budget):
+            raise Exception(
+                "Serial numbers, groups, users, checkpoints and time budgets are not supported with config diff"
+            )
+        config_state = ConfigState(args.config_state) if args.config_state else None
+
+        archive = get_archive()
+        if archive is not None and archive.replaying:
+            # Run against the recorded manifests
+            storage = archive.replay_backend()
+        else:
+            # Get the storage backend, checks the required environment variables for Azure Storage
+            storage = get_storage_backend(args.storage, args.replicas)
+            if archive is not None:
+                storage = archive.recording_backend(storage)
 
         # If certificate or interactive auth is enabled, set APP to False
-        if CERTAUTH or INTERACTIVEAUTH:
+        if args.certauth or args.interactiveauth:
             APP = False
         else:
             APP = True
 
-        # Get authentication token
-        TOKEN = getAuth(APP, CERTAUTH, INTERACTIVEAUTH)
-        # Get current manifests from Azure Storage
-        CURRENT_MANIFESTS = get_current_manifest_blobs(CONNECTION_STRING, CONTAINER_NAME)
+        # Use one shared async client for all blob operations if async storage is enabled
+        async_storage = None
+        if args.async_storage:
+            if archive is not None:
+                raise Exception("Async storage can not be recorded or replayed")
+            if args.replicas:
+                raise Exception("Async storage is not supported with replicas")
+            from munki_manifest_generator.azstorage.az_storage_async import AsyncBlobStorage, MAX_CONCURRENCY
+            from munki_manifest_generator.storage.azure_blob_backend import AzureBlobBackend
+
+            if not isinstance(storage, AzureBlobBackend):
+                raise Exception("Async storage is only supported with Azure Storage")
+
+            async_storage = AsyncBlobStorage(
+                storage.connection_string, storage.container_name, args.storage_concurrency or MAX_CONCURRENCY
+            )
+
         # If custom default catalog is passed, set it
-        if DEFAULT_CATALOG:
-            DEFAULT_CATALOG = DEFAULT_CATALOG
-        else:
-            DEFAULT_CATALOG = "Production"
-        # If a serial number is passed, create or update a manifest for that device
-        if serial_number:
-            Q_PARAM = {"$filter": "serialNumber eq '%s'" % serial_number}
-            DEVICES = make_api_request(ENDPOINT, TOKEN, Q_PARAM)
-
-            # If two objects are found, get the latest enrolled device
-            if DEVICES["@odata.count"] > 1:
-                latest_enrolled = max(DEVICES["value"], key=lambda x: x["enrolledDateTime"])
-                DEVICES["value"] = [latest_enrolled]
-                DEVICES["@odata.count"] = 1
-
-            # If no device is returned, stop script
-            if DEVICES["@odata.count"] == 0:
-                logger.error(f"Device with serial {serial_number} not found, stopping...")
-                quit()
-
-        # Else, create or update manifests for all devices
-        else:
-            Q_PARAM = {"$filter": "operatingSystem eq 'macOS'"}
-            DEVICES = make_api_request(ENDPOINT, TOKEN, Q_PARAM)
-            # Check if there are duplicate entries for a device
-            for d in DEVICES["value"]:
-                for index, value in enumerate(DEVICES["value"]):
-                    if d["serialNumber"] == value["serialNumber"]:
-                        # If the device is enrolled more than once, get the latest enrolled device
-                        if d["enrolledDateTime"] > value["enrolledDateTime"]:
-                            # Remove the older device from the list
-                            DEVICES["value"].remove(DEVICES["value"][index])
-
-            import re
-            def contains_random_uuid(upn):
-                # Construct a regular expression pattern that matches the specified format
-                pattern = re.compile(r"[A-Za-z]+([0-9]+([A-Za-z]+[0-9]+)+).*@.*", re.IGNORECASE)
-
-                # Use the re module to search for the pattern in the input string
-                match = re.search(pattern, upn)
-
-                # If a match is found, return True; otherwise, return False
-                if match:
-                    return True
-                else:
-                    return False
+        DEFAULT_CATALOG = args.default_catalog or "Production"
+
+        # Get list of group manifests from json file or list
+        GROUPS = load_groups(args.json, args.group_list)
 
-            # Remove devices that have a UPN that contains a random UUID
-            DEVICES["value"] = [d for d in DEVICES["value"] for key, val in d.items() if "userPrincipalName" in key if val is not None if not contains_random_uuid(val)]
+        # Group and safe manifest names are not anonymized in a recording
+        if archive is not None and not archive.replaying:
+            archive.record_groups([group["name"] for group in GROUPS] + (args.safe_manifest or "").split(","))
 
-            logger.info("-" * 90)
-            logger.info(f"Found {len(CURRENT_MANIFESTS)} current manifests")
-            logger.info(f'Found {len(DEVICES["value"])} devices')
+        # Keep a progress journal if a checkpoint path or time budget is passed
+        CHECKPOINT = args.checkpoint
+        if args.time_budget and not CHECKPOINT:
+            CHECKPOINT = "mmg_checkpoint.jsonl"
+        run_key = get_run_key(
+            storage=repr(storage),
+            groups=GROUPS,
+            serial_number=args.serial_number,
+            reconcile_groups=RECONCILE_GROUPS,
+            reconcile_users=RECONCILE_USERS,
+            safe_manifest=args.safe_manifest,
+            default_catalog=DEFAULT_CATALOG,
+            test=args.test,
+        )
+        checkpoint = Checkpoint(CHECKPOINT, run_key, args.time_budget)
 
+        # Group memberships resolved before the run was interrupted, or the membership cache if a path is passed
+        memberships = checkpoint.stage("memberships")
+        cache = None
+        if memberships is None and args.cache:
+            cache = MembershipCache(args.cache, args.cache_ttl or 3600)
+            if args.cache_invalidate:
+                cache.invalidate()
 
+        def get_token():
+            # Get authentication token, not needed when replaying a recorded run
+            if archive is not None and archive.replaying:
+                return {"access_token": ""}
+            return getAuth(APP, args.certauth, args.interactiveauth)
 
+        # If only the changes to the group config are applied, skip the device inventory and memberships
+        diff = config_state.diff(GROUPS, DEFAULT_CATALOG) if args.config_diff else None
+        if diff is not None:
+            if cache is not None:
+                cache.close()
+            try:
+                with span("stage.config_diff"):
+                    failed = apply_config_diff(
+                        storage,
+                        GROUPS,
+                        diff,
+                        get_current_manifest_blobs(storage),
+                        DEFAULT_CATALOG,
+                        args.test,
+                        get_token,
+                        args.safe_manifest,
+                        write_tags,
+                    )
+            finally:
+                if async_storage is not None:
+                    async_storage.close()
+                storage.close()
 
-            logger.info("-" * 90)
+            if failed:
+                # The next config diff run applies the same changes again
+                logger.warning(f"{len(failed)} manifests failed to update, the group config is not saved")
+            elif not args.test:
+                config_state.save(GROUPS, DEFAULT_CATALOG)
+            log_manifest_stats(args.manifest_format)
+            return
+        if args.config_diff:
+            logger.info("Running a full run for the group config")
+
+        def get_manifests():
+            # Get current manifests
+            if async_storage is not None:
+                CURRENT_MANIFESTS = async_storage.run(async_storage.list_manifests())
+            else:
+                CURRENT_MANIFESTS = get_current_manifest_blobs(storage)
+            if not partial:
+                logger.info(f"Found {len(CURRENT_MANIFESTS)} current manifests")
+            current_span().set_attribute("manifests", len(CURRENT_MANIFESTS))
+            return CURRENT_MANIFESTS
 
-        # Get serial numbers, AAD device IDs, and UPNs for all devices
-        SERIAL_NUMBERS = [val for d in DEVICES["value"] for key, val in d.items() if "serialNumber" in key if val is not None]
+        def get_devices(TOKEN):
+            # If the devices were fetched before the run was interrupted, use them
+            if checkpoint.stage("devices") is not None:
+                DEVICES = {"value": [Device.from_graph(d) for d in checkpoint.stage("devices")]}
+                logger.info(f'Found {len(DEVICES["value"])} devices in checkpoint')
 
-        AAD_DEVICE_IDS = [
-            val for d in DEVICES["value"] for key, val in d.items() if "azureADDeviceId" in key if val is not None
-        ]
+            # If serial numbers are passed, create or update manifests for those devices
+            elif args.serial_number:
+                DEVICES = {"value": get_intune_devices(args.serial_number, TOKEN)}
+                DEVICES["@odata.count"] = len(DEVICES["value"])
 
-        UPNs = [val for d in DEVICES["value"] for key, val in d.items() if "userPrincipalName" in key if val is not None]
+                # If no device is returned, stop script, storage is closed once the running stages are done
+                if DEVICES["@odata.count"] == 0:
+                    logger.error("No devices found for the serial numbers, stopping...")
+                    quit()
 
-        # Get list of group manifests from json file or list
-        if json_file:
-            with open(json_file, "r") as f:
-                GROUPS = json.load(f)
-        elif group_list:
-            GROUPS = group_list
-        else:
-            raise Exception("No JSON file or list provided")
+            # If groups or users are passed, reconcile the devices found by manifest tags and group members
+            elif RECONCILE_GROUPS or RECONCILE_USERS:
+                serials = get_targeted_serial_numbers(storage, GROUPS, RECONCILE_GROUPS, RECONCILE_USERS, TOKEN)
+                DEVICES = {"value": get_intune_devices(serials, TOKEN) if serials else []}
 
-        # Batch get group memberships for all devices and users
-        group_search = []
-        for group in GROUPS:
-            group_search.append('"displayName:%s"' % group["name"])
+                logger.info("-" * 90)
+                logger.info(f'Found {len(DEVICES["value"])} devices to reconcile')
+                logger.info("-" * 90)
 
-        group_search_query = f'({" OR ".join(group_search)})'
+            # Else, create or update manifests for all devices
+            else:
+                DEVICES = {"value": get_intune_devices(None, TOKEN, args.fetch_partitions)}
 
-        if "device" in map(itemgetter("type"), GROUPS):
-            # Batch get ids for all devices and users
-            device_id_responses = batch_request(AAD_DEVICE_IDS, "devices", "", "deviceId", TOKEN)
-            device_group_responses = batch_request(
-                device_id_responses, "devices/", "/transitiveMemberOf?$search=%s" % group_search_query, "device", TOKEN
-            )
+                logger.info("-" * 90)
+                logger.info(f'Found {len(DEVICES["value"])} devices')
+                logger.info("-" * 90)
 
-        if "user" in map(itemgetter("type"), GROUPS):
-            device_upn_responses = batch_request(UPNs, "users", "", "upn", TOKEN)
-            user_group_responses = batch_request(
-                device_upn_responses,
-                "users/",
-                "/transitiveMemberOf?$select=id,displayName&$search=%s" % group_search_query,
-                "user",
-                TOKEN,
+            if checkpoint.path and checkpoint.stage("devices") is None:
+                checkpoint.complete_stage("devices", [device.to_dict() for device in DEVICES["value"]])
+            current_span().set_attribute("devices", len(DEVICES["value"]))
+            return DEVICES
+
+        def get_memberships(kind):
+            # Device and user memberships are resolved at the same time, unless resolved before the run was interrupted
+            def get_kind_memberships(TOKEN, DEVICES):
+                if memberships is not None:
+                    return memberships[kind]
+                device_group_responses, user_group_responses = get_group_memberships(
+                    DEVICES["value"], GROUPS, TOKEN, args.membership_mode, cache, kinds=(kind,)
+                )
+                return device_group_responses if kind == "device" else user_group_responses
+
+            return get_kind_memberships
+
+        def build_fleet(CURRENT_MANIFESTS, DEVICES, device_group_responses, user_group_responses):
+            if cache is not None:
+                cache.close()
+            if checkpoint.path and memberships is None:
+                checkpoint.complete_stage(
+                    "memberships",
+                    {
+                        "device": compact_group_responses(device_group_responses, "deviceId"),
+                        "user": compact_group_responses(user_group_responses, "userPrincipalName"),
+                    },
+                )
+
+            # Index the group memberships of all devices, reconcile workers only look up their device
+            fleet = FleetMembership(
+                DEVICES["value"],
+                GROUPS,
+                CURRENT_MANIFESTS,
+                device_group_responses,
+                user_group_responses,
+                DEFAULT_CATALOG,
             )
+            log_peak_memory("ingestion")
+            return fleet
 
-        # If not passing a serial number, delete manifest for device if it is not in Intune
-        if not serial_number:
+        def delete_stale(CURRENT_MANIFESTS, DEVICES):
+            # If not passing serial numbers, groups or users, delete manifest for device if it is not in Intune
+            if partial or checkpoint.stage("delete") is not None or checkpoint.out_of_time():
+                return
+            SERIAL_NUMBERS = [d.serial_number for d in DEVICES["value"] if d.serial_number is not None]
+            if async_storage is not None:
+                delete_manifests = get_stale_manifests(GROUPS, SERIAL_NUMBERS, args.safe_manifest, CURRENT_MANIFESTS)
+                log_deleted_manifests(delete_manifests)
+                checkpoint.complete_stage("delete")
+                # Deleted on the storage event loop by the reconcile stage
+                return delete_manifests
             delete_manifest_blob(
-                CONNECTION_STRING,
-                CONTAINER_NAME,
+                storage,
                 GROUPS,
                 SERIAL_NUMBERS,
-                SAFE_MANIFEST,
-                TEST,
+                args.safe_manifest,
+                args.test,
                 CURRENT_MANIFESTS,
             )
+            checkpoint.complete_stage("delete")
 
-        def process_device(device):
-            """Process each device"""
+        def reconcile(DEVICES, fleet, delete_manifests=None):
+            current_span().set_attribute("devices", len(DEVICES["value"]))
+            if checkpoint.out_of_time():
+                logger.warning("Time budget spent before reconciling devices, stopping...")
+                return
 
-            lock = threading.Lock()
-            group_membership = []
-            # If a manifest exists for the device, update it.
-            if device["serialNumber"] in CURRENT_MANIFESTS:
-                logger.debug("[%s] Manifest found, checking for updates..." % device["serialNumber"])
-                current_device_manifest = get_current_device_manifest(
-                    CONNECTION_STRING, CONTAINER_NAME, device["serialNumber"]
-                )
+            if async_storage is not None:
+                import asyncio
 
-                device_manifest = Manifest(
-                    catalogs=current_device_manifest["catalogs"],
-                    included_manifests=current_device_manifest["included_manifests"],
-                    display_name=current_device_manifest["display_name"],
-                    serialnumber=current_device_manifest["serialnumber"],
-                    user=current_device_manifest["user"],
-                )
+                if args.test or delete_manifests is None:
+                    delete_manifests = []
 
-                if device_manifest.user != device["userPrincipalName"]:
-                    update_current_upn(
-                        CONNECTION_STRING,
-                        CONTAINER_NAME,
-                        device_manifest.serialnumber,
-                        device["userPrincipalName"],
-                        device_manifest.user,
-                        TEST,
-                    )
-                    device_manifest.user = device["userPrincipalName"]
-
-                # If device groups are in the JSON or list, get the groups the device is in
-                if "device" in map(itemgetter("type"), GROUPS):
-                    device_groups = get_device_group_membership(
-                        device_group_responses,
-                        device["azureADDeviceId"],
-                        GROUPS,
-                        CURRENT_MANIFESTS,
-                        device_manifest,
+                async def delete_and_reconcile():
+                    # The event loop runs on one thread, so stale manifests are deleted next to the reconciliation
+                    await asyncio.gather(
+                        async_storage.delete_many(delete_manifests),
+                        reconcile_devices_async(
+                            DEVICES["value"],
+                            fleet,
+                            async_storage,
+                            DEFAULT_CATALOG,
+                            args.test,
+                            checkpoint,
+                            startTime,
+                            args.tag_manifests,
+                            write_tags,
+                        ),
                     )
-                    if device_groups:
-                        with lock:
-                            group_membership += device_groups
 
-                # If user groups are in the JSON or list, get the groups the device's user is in
-                if "user" in map(itemgetter("type"), GROUPS):
-                    user_groups = get_user_group_membership(
-                        user_group_responses,
-                        GROUPS,
-                        CURRENT_MANIFESTS,
-                        device_manifest,
-                    )
-                    if user_groups:
-                        with lock:
-                            group_membership += user_groups
-
-                update_manifest_blob(
-                    CONNECTION_STRING,
-                    CONTAINER_NAME,
-                    device["serialNumber"],
-                    device_manifest,
-                    group_membership,
-                    GROUPS,
-                    TEST,
+                async_storage.run(delete_and_reconcile())
+            else:
+                reconcile_devices(
+                    DEVICES["value"],
+                    fleet,
+                    storage,
                     DEFAULT_CATALOG,
-                    CURRENT_MANIFESTS,  # noqa: F821
+                    args.test,
+                    checkpoint,
+                    startTime,
+                    args.tag_manifests,
+                    write_tags,
                 )
 
-            # If no manifest exists for the device, create one.
-            else:
-                logger.info("[%s] No manifest found, creating..." % device["serialNumber"])
-                device_manifest = Manifest(
-                    catalogs=[DEFAULT_CATALOG],
-                    included_manifests=["site_default"],
-                    display_name=device["serialNumber"],
-                    serialnumber=device["serialNumber"],
-                    user=device["userPrincipalName"],
-                )
+        # Listing manifests, fetching devices and resolving device and user memberships overlap where they
+        # do not depend on each other, stale manifests are deleted while devices are reconciled
+        stages = StageGraph()
+        stages.add("token", get_token)
+        stages.add("manifests", get_manifests)
+        stages.add("devices", get_devices, ("token",))
+        stages.add("memberships.device", get_memberships("device"), ("token", "devices"))
+        stages.add("memberships.user", get_memberships("user"), ("token", "devices"))
+        stages.add("fleet", build_fleet, ("manifests", "devices", "memberships.device", "memberships.user"))
+        stages.add("delete", delete_stale, ("manifests", "devices"))
+        if async_storage is not None:
+            stages.add("reconcile", reconcile, ("devices", "fleet", "delete"))
+        else:
+            stages.add("reconcile", reconcile, ("devices", "fleet"))
 
-                # If device groups are in the JSON or list, get the groups the device is in
-                if "device" in map(itemgetter("type"), GROUPS):
-                    device_groups = get_device_group_membership(
-                        device_group_responses,
-                        device["azureADDeviceId"],
-                        GROUPS,
-                        CURRENT_MANIFESTS,
-                        device_manifest,
-                    )
-                    if device_groups:
-                        with lock:
-                            group_membership += device_groups
+        try:
+            results = stages.run()
+        except BaseException:
+            if async_storage is not None:
+                async_storage.close()
+            storage.close()
+            raise
+        finally:
+            log_stage_times(stages.times, stages.critical_path())
+
+        if async_storage is not None:
+            async_storage.close()
+        # Closing waits for the changes to replicas, they are counted in the manifest statistics
+        storage.close()
+        DEVICES = results["devices"]
+
+        log_peak_memory("reconciliation")
+        log_manifest_stats(args.manifest_format)
+
+        # If the time budget was spent before all devices were reconciled, keep the checkpoint so the next run resumes
+        remaining = 0
+        if checkpoint.out_of_time():
+            remaining = len(
+                [d for d in DEVICES["value"] if d.serial_number and not checkpoint.is_reconciled(d.serial_number)]
+            )
+        if remaining:
+            logger.warning(f"Time budget spent, {remaining} devices left to reconcile")
+            checkpoint.close()
+        else:
+            checkpoint.finish()
+            # The next config diff run applies the changes to the group config since this run
+            if config_state is not None and not partial and not args.test:
+                # Manifests written without tags are no longer found by their tags
+                tagged = True if args.tag_manifests else None if write_tags else False
+                config_state.save(GROUPS, DEFAULT_CATALOG, tagged)
+
+    def run_targets(args):
+        """Run for the targets in the parsed arguments."""
+        if args.checkpoint or args.time_budget:
+            raise Exception("Checkpoints and time budgets are not supported with targets")
+        if args.async_storage:
+            raise Exception("Async storage is not supported with targets")
+        if get_archive() is not None:
+            raise Exception("Runs with targets can not be recorded or replayed")
+
+        # Open the storage and load the group config of each target
+        TARGETS = load_targets(args.targets)
+
+        # If certificate or interactive auth is enabled, set APP to False
+        if args.certauth or args.interactiveauth:
+            APP = False
+        else:
+            APP = True
+
+        TOKEN = getAuth(APP, args.certauth, args.interactiveauth)
+
+        # Devices are fetched once for all targets
+        with span("stage.devices") as stage_span:
+            DEVICES = get_intune_devices(args.serial_number, TOKEN, args.fetch_partitions)
+            logger.info("-" * 90)
+            logger.info(f"Found {len(DEVICES)} devices for {len(TARGETS)} targets")
+            logger.info("-" * 90)
+            stage_span.set_attribute("devices", len(DEVICES))
+
+        if not DEVICES:
+            logger.error("No devices found, stopping...")
+            for target in TARGETS:
+                target["storage"].close()
+            return
+
+        # Memberships are resolved once for the groups of all targets
+        with span("stage.memberships"):
+            cache = MembershipCache(args.cache, args.cache_ttl or 3600) if args.cache else None
+            if cache is not None and args.cache_invalidate:
+                cache.invalidate()
+            device_group_responses, user_group_responses = get_group_memberships(
+                DEVICES, merge_groups(TARGETS), TOKEN, args.membership_mode, cache
+            )
+            if cache is not None:
+                cache.close()
+
+        log_peak_memory("ingestion")
 
-                # If user groups are in the JSON or list, get the groups the device's user is in
-                if "user" in map(itemgetter("type"), GROUPS):
-                    user_groups = get_user_group_membership(
+        # Reconcile all targets at the same time, each with its own reconcile workers
+        with span("stage.reconcile", **{"devices": len(DEVICES), "targets": len(TARGETS)}):
+            with ThreadPoolExecutor(len(TARGETS), thread_name_prefix="mmg-target") as executor:
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        reconcile_target,
+                        target,
+                        DEVICES,
+                        device_group_responses,
                         user_group_responses,
-                        GROUPS,
-                        CURRENT_MANIFESTS,
-                        device_manifest,
+                        args.serial_number,
+                        args.test,
+                        startTime,
+                        args.manifest_tags,
                     )
-                    if user_groups:
-                        with lock:
-                            group_membership += user_groups
-
-                device_manifest.catalogs = get_device_catalogs(GROUPS, device_manifest, DEFAULT_CATALOG, add_catalogs=True)
-
-                create_manifest_blob(
-                    CONNECTION_STRING,
-                    CONTAINER_NAME,
-                    device["serialNumber"],
-                    device_manifest,
-                    TEST,
-                )
+                    for target in TARGETS
+                ]
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Exception: {e}")
 
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(process_device, device) for device in DEVICES["value"] if device["serialNumber"]]
-            for future in as_completed(futures):
-                try:
-                    result = future.result()
-                except Exception as e:
-                    logger.error(f"Exception: {e}")
+        log_peak_memory("reconciliation")
+        log_manifest_stats(args.manifest_format)
 
-    if not kwargs:
-        run(
-            args.json,
-            args.group_list,
-            args.serial_number,
-            args.safe_manifest,
-            args.test,
-            args.default_catalog,
-            args.certauth,
-            args.interactiveauth,
+    def run_service(args):
+        """Run the service for the parsed arguments."""
+        from munki_manifest_generator.service import ManifestService, serve
+
+        service = ManifestService(
+            load_groups(args.json, args.group_list),
+            get_storage_backend(args.storage, args.replicas),
+            test=args.test,
+            default_catalog=args.default_catalog or "Production",
+            certauth=args.certauth,
+            interactiveauth=args.interactiveauth,
+            membership_mode=args.membership_mode,
+            cache=MembershipCache(args.cache, args.cache_ttl or 3600) if args.cache else None,
+            write_tags=args.manifest_tags,
         )
-    else:
-        run(j, g, s, sm, t, d, c, i)
+        serve(service, args.host, args.port)
+
+    # Set the format manifests are written in
+    set_manifest_format(args.manifest_format)
+
+    # Record or replay Graph and storage traffic
+    if args.record:
+        start_recording(args.record)
+    elif args.replay:
+        start_replay(args.replay, args.replay_latency)
+
+    # Export spans if tracing is enabled
+    if args.trace:
+        setup_tracing(args.trace)
+
+    try:
+        if args.service:
+            run_service(args)
+        elif args.targets:
+            with span("run"):
+                run_targets(args)
+        else:
+            with span("run"):
+                run(args)
+    finally:
+        # Save the recorded archive and export the remaining spans, also when the run failed
+        stop_capture()
+        stop_tracing()
 
+    logger.log_summary()
     logger.debug("Finished in {0} seconds.".format(time.time() - startTime))
+    # Stop the listener once the queued records are written, main can be called again with other options
+    logger.remove_handlers()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,33 @@
 class Manifest:
+    __slots__ = (
+        "catalogs",
+        "included_manifests",
+        "managed_installs",
+        "optional_installs",
+        "display_name",
+        "serialnumber",
+        "user",
+    )
+
     def __init__(self, catalogs, included_manifests, display_name, serialnumber, user):
         """Used to create a manifest object."""
         self.catalogs = catalogs
         self.included_manifests = included_manifests
-        self.managed_installs = []
-        self.optional_installs = []
+        # Shared empty tuples instead of two new lists per device, written as empty arrays
+        self.managed_installs = ()
+        self.optional_installs = ()
         self.display_name = display_name
         self.serialnumber = serialnumber
         self.user = user
+
+    def to_dict(self) -> dict:
+        """Returns the manifest as a dict to write as a plist."""
+        return {
+            "catalogs": self.catalogs,
+            "included_manifests": self.included_manifests,
+            "managed_installs": list(self.managed_installs),
+            "optional_installs": list(self.optional_installs),
+            "display_name": self.display_name,
+            "serialnumber": self.serialnumber,
+            "user": self.user,
+        }
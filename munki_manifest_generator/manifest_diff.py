@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+This module computes the changes to bring a device manifest in line with its group memberships.
+"""
+
+from munki_manifest_generator.logger import logger
+
+
+class ManifestDiff:
+    """Changes to the included manifests, catalogs and user of a device manifest."""
+
+    __slots__ = (
+        "included_manifests",
+        "catalogs",
+        "added_manifests",
+        "removed_manifests",
+        "missing_manifests",
+        "added_catalogs",
+        "removed_catalogs",
+        "user",
+        "old_user",
+    )
+
+    def __init__(
+        self,
+        included_manifests,
+        catalogs,
+        added_manifests,
+        removed_manifests,
+        missing_manifests,
+        added_catalogs,
+        removed_catalogs,
+        user,
+        old_user,
+    ):
+        self.included_manifests = included_manifests
+        self.catalogs = catalogs
+        self.added_manifests = added_manifests
+        self.removed_manifests = removed_manifests
+        self.missing_manifests = missing_manifests
+        self.added_catalogs = added_catalogs
+        self.removed_catalogs = removed_catalogs
+        self.user = user
+        self.old_user = old_user
+
+    @property
+    def manifests_changed(self) -> bool:
+        return bool(self.added_manifests or self.removed_manifests)
+
+    @property
+    def catalogs_changed(self) -> bool:
+        return bool(self.added_catalogs or self.removed_catalogs)
+
+    @property
+    def user_changed(self) -> bool:
+        return self.user != self.old_user
+
+    @property
+    def changed(self) -> bool:
+        return self.manifests_changed or self.catalogs_changed or self.user_changed
+
+    def apply(self, current: dict) -> dict:
+        """Returns a copy of the current manifest with the changes, other keys are kept as they are."""
+        return dict(current, included_manifests=self.included_manifests, catalogs=self.catalogs, user=self.user)
+
+
+def diff_manifest(
+    current: dict,
+    desired_manifests: list,
+    member_names,
+    existing_manifests,
+    group_catalogs: list,
+    default_catalog: str,
+    user: str,
+) -> ManifestDiff:
+    """
+    Returns the changes to the current manifest of a device, the inputs are not changed.
+
+    :param current: Current manifest of the device
+    :param desired_manifests: Manifests of the configured groups the device and its user are in
+    :param member_names: Names of the groups the device and its user are in, manifests of other groups are removed
+    :param existing_manifests: Set of the manifest names in storage, manifests that do not exist are removed
+    :param group_catalogs: (manifest name, catalog) of the groups in the config with a catalog, in config order
+    :param default_catalog: Catalog every device has
+    :param user: UPN of the device user
+    """
+    desired_set = set(desired_manifests)
+    member_names = set(member_names)
+    current_manifests = current.get("included_manifests") or []
+    current_catalogs = current.get("catalogs") or []
+
+    # Keep current manifests that exist and are site_default or a group manifest of a group the device is in
+    included = []
+    included_set = set()
+    removed = []
+    missing = []
+    for manifest in current_manifests:
+        if manifest in included_set:
+            continue
+        if manifest not in existing_manifests:
+            missing.append(manifest)
+            removed.append(manifest)
+        elif manifest != "site_default" and manifest not in desired_set and manifest not in member_names:
+            removed.append(manifest)
+        else:
+            included.append(manifest)
+            included_set.add(manifest)
+
+    added = []
+    for manifest in desired_manifests:
+        if manifest not in included_set and manifest in existing_manifests:
+            added.append(manifest)
+            included.append(manifest)
+            included_set.add(manifest)
+
+    # Catalogs of the included group manifests before the default catalog, the last group in the config first
+    catalogs = [default_catalog]
+    for manifest, catalog in group_catalogs:
+        if manifest in included_set and catalog not in catalogs:
+            catalogs.insert(0, catalog)
+
+    # The order of catalogs in the current manifest is kept if they are the same
+    catalog_set = set(catalogs)
+    current_catalog_set = set(current_catalogs)
+    added_catalogs = [catalog for catalog in catalogs if catalog not in current_catalog_set]
+    removed_catalogs = list(dict.fromkeys(catalog for catalog in current_catalogs if catalog not in catalog_set))
+    if not added_catalogs and not removed_catalogs:
+        catalogs = list(current_catalogs)
+
+    return ManifestDiff(
+        included,
+        catalogs,
+        added,
+        removed,
+        missing,
+        added_catalogs,
+        removed_catalogs,
+        user,
+        current.get("user"),
+    )
+
+
+def log_manifest_diff(serial_number: str, diff: ManifestDiff) -> None:
+    """Log the changes to a device manifest."""
+    if diff.user_changed:
+        logger.info("[%s] Updating user to %s from %s", serial_number, diff.user, diff.old_user)
+    for manifest in diff.missing_manifests:
+        logger.info("[%s] Manifest %s not found, skipping", serial_number, manifest)
+    if diff.added_manifests:
+        logger.info("[%s] " % serial_number + "New manifest list: " + ", ".join(diff.added_manifests))
+    if diff.catalogs_changed:
+        logger.info("[%s] " % serial_number + "New catalog list: " + ", ".join(diff.catalogs))
+    if diff.removed_manifests:
+        logger.info("[%s] " % serial_number + "Manifests removed: " + ", ".join(diff.removed_manifests))
+    if diff.removed_catalogs:
+        logger.info("[%s] " % serial_number + "Catalogs removed: " + ", ".join(diff.removed_catalogs))
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+"""
+This module encodes and decodes manifests as XML or binary plists.
+"""
+
+import time
+import plistlib
+
+from munki_manifest_generator.stats import count_manifest_stat
+
+FORMATS = {"xml": plistlib.FMT_XML, "binary": plistlib.FMT_BINARY}
+
+# Format manifests are written in, set with set_manifest_format
+MANIFEST_FORMAT = "xml"
+
+
+def set_manifest_format(manifest_format: str) -> None:
+    global MANIFEST_FORMAT
+    if manifest_format not in FORMATS:
+        raise Exception(f"Invalid manifest format {manifest_format}, choose from: xml, binary")
+    MANIFEST_FORMAT = manifest_format
+
+
+def dumps_manifest(data: dict) -> bytes:
+    """Returns the manifest encoded in the configured format."""
+    start = time.perf_counter()
+    encoded = plistlib.dumps(data, fmt=FORMATS[MANIFEST_FORMAT])
+    count_manifest_stat(serialized=1, serialize_seconds=time.perf_counter() - start, serialized_bytes=len(encoded))
+
+    return encoded
+
+
+def loads_manifest(data: bytes) -> dict:
+    """Returns the decoded manifest, XML and binary plists are detected so containers can hold both."""
+    start = time.perf_counter()
+    decoded = plistlib.loads(data)
+    count_manifest_stat(parsed=1, parse_seconds=time.perf_counter() - start)
+
+    return decoded
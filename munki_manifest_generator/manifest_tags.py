@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""
+This module computes the blob index tags written with device manifests and finds manifests by them.
+"""
+
+import re
+import json
+import hashlib
+
+# A blob has at most 10 tags: user, catalogs, fingerprint, one tag per included group manifest up to
+# MAX_GROUP_TAGS and overflow if the manifest includes more group manifests than that
+MAX_GROUP_TAGS = 6
+# Characters that are not allowed in tag keys and values
+INVALID_TAG_CHARACTERS = re.compile(r"[^A-Za-z0-9 +\-./:=_]")
+
+
+def tag_value(value: str, length: int = 256) -> str:
+    """Returns the value with characters not allowed in tags replaced by an underscore, cut to the max length."""
+    return INVALID_TAG_CHARACTERS.sub("_", value or "")[:length]
+
+
+def group_tag(name: str) -> str:
+    """Returns the tag key for an included group manifest."""
+    return "g." + tag_value(name, 126)
+
+
+def manifest_fingerprint(manifest: dict) -> str:
+    """Returns a hash of the included manifests, catalogs and user of a manifest."""
+    data = [manifest.get("included_manifests") or [], manifest.get("catalogs") or [], manifest.get("user") or ""]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()[:32]
+
+
+def manifest_tags(manifest: dict) -> dict:
+    """
+    Returns the blob index tags of a device manifest.
+
+    Group manifests are tagged with their own key so manifests that include a group can be found with an
+    equality filter. Manifests with more group manifests than fit are tagged with overflow and are found
+    for every group.
+    """
+    tags = {
+        "user": tag_value(manifest.get("user")),
+        "catalogs": tag_value(" ".join(manifest.get("catalogs") or [])),
+        "fingerprint": manifest_fingerprint(manifest),
+    }
+    group_manifests = [name for name in manifest.get("included_manifests") or [] if name != "site_default"]
+    for name in group_manifests[:MAX_GROUP_TAGS]:
+        tags[group_tag(name)] = "1"
+    if len(group_manifests) > MAX_GROUP_TAGS:
+        tags["overflow"] = "1"
+
+    return tags
+
+
+def find_tagged_manifests(storage, group_names: list, upns: list) -> list:
+    """Returns the names of the manifests that include any of the group manifests or belong to any of the users."""
+    names = []
+    for name in group_names:
+        names += storage.find({group_tag(name): "1"})
+    if group_names:
+        names += storage.find({"overflow": "1"})
+    for upn in upns:
+        names += storage.find({"user": tag_value(upn)})
+
+    return list(dict.fromkeys(names))
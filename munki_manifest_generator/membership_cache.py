@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+This module caches group memberships of devices and users in a local SQLite store.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from munki_manifest_generator.logger import logger
+
+
+def get_config_hash(groups: list) -> str:
+    """Returns a hash of the group ids, cached memberships for another set of groups are treated as expired."""
+    return hashlib.sha256(json.dumps(sorted(group["id"] for group in groups)).encode()).hexdigest()
+
+
+class MembershipCache:
+    """
+    Stores the configured groups a device or user is a member of, keyed by Azure AD device id or UPN.
+
+    Each entry also keeps the id the device or user was queried by, so expired users without a user id
+    on their managed device can be refreshed without looking up the object id again.
+    """
+
+    def __init__(self, path: str, ttl: int = 3600):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS memberships (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    object_id TEXT,
+                    group_ids TEXT NOT NULL,
+                    config_hash TEXT NOT NULL,
+                    fetched REAL NOT NULL,
+                    PRIMARY KEY (kind, key)
+                )"""
+            )
+
+    def get(self, kind: str, keys: list, groups: list) -> tuple:
+        """
+        Returns the cached responses, the keys to query and the known object ids of the keys to query.
+
+        :param kind: "device" or "user"
+        :param keys: Azure AD device ids or UPNs
+        :param groups: Groups from the JSON or list of the same kind
+        :return: Cached responses shaped like transitiveMemberOf responses, keys to query and a dict of
+                 key to object id for the keys to query that have been seen before
+        """
+        key_type = "deviceId" if kind == "device" else "userPrincipalName"
+        group_names = {group["id"]: group["name"] for group in groups}
+        config_hash = get_config_hash(groups)
+        oldest = time.time() - self.ttl
+
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, object_id, group_ids, config_hash, fetched FROM memberships WHERE kind = ?", (kind,)
+            ).fetchall()
+        entries = {row[0]: row[1:] for row in rows}
+
+        responses = []
+        missing = []
+        object_ids = {}
+        for key in dict.fromkeys(keys):
+            entry = entries.get(key)
+            if entry is not None and entry[2] == config_hash and entry[3] >= oldest:
+                group_ids = json.loads(entry[1])
+                responses.append(
+                    {
+                        key_type: key,
+                        "value": [{"id": i, "displayName": group_names[i]} for i in group_ids if i in group_names],
+                    }
+                )
+            else:
+                missing.append(key)
+                if entry is not None and entry[0]:
+                    object_ids[key] = entry[0]
+
+        logger.info(f"Membership cache: {len(responses)} {kind}s cached, {len(missing)} {kind}s to refresh")
+
+        return responses, missing, object_ids
+
+    def put(self, kind: str, responses: list, id_responses: list, groups: list) -> None:
+        """Store the configured groups found in the responses with the object ids from the lookup responses."""
+        key_type = "deviceId" if kind == "device" else "userPrincipalName"
+        group_ids = {group["id"] for group in groups}
+        config_hash = get_config_hash(groups)
+        fetched = time.time()
+
+        object_ids = {
+            val.get(key_type): val.get("id")
+            for response in id_responses
+            for val in response.get("value", [])
+            if val.get(key_type)
+        }
+
+        rows = [
+            (
+                kind,
+                response[key_type],
+                object_ids.get(response[key_type]),
+                json.dumps([val["id"] for val in response.get("value", []) if val.get("id") in group_ids]),
+                config_hash,
+                fetched,
+            )
+            for response in responses
+            if response.get(key_type)
+        ]
+
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO memberships VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def invalidate(self) -> None:
+        """Expire all cached memberships, the object ids are kept."""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE memberships SET fetched = 0")
+        logger.info("Membership cache invalidated")
+
+    def close(self) -> None:
+        self.conn.close()
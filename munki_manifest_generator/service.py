@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+"""
+This module runs the manifest generator as a long-running service that accepts serial numbers over HTTP.
+"""
+
+import json
+import time
+import queue
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from munki_manifest_generator.graph.get_authentication_token import getAuth
+from munki_manifest_generator.graph.get_devices import get_devices_by_serial, is_valid_serial_number
+from munki_manifest_generator.logger import logger
+from munki_manifest_generator.tracing import span
+from munki_manifest_generator.stats import log_manifest_stats
+from munki_manifest_generator import manifest_encoding
+from munki_manifest_generator.storage.storage_backend import StorageBackend
+from munki_manifest_generator.azstorage.az_storage_actions import get_current_manifest_blobs
+
+
+class ManifestService:
+    """Keeps the token, manifest listing and group config warm and processes queued serial numbers."""
+
+    def __init__(
+        self,
+        groups,
+        storage: StorageBackend,
+        test=False,
+        default_catalog="Production",
+        certauth=False,
+        interactiveauth=False,
+        coalesce_window=2.0,
+        manifest_refresh=300,
+        membership_mode="search",
+        cache=None,
+        write_tags=False,
+    ):
+        self.groups = groups
+        self.storage = storage
+        self.test = test
+        self.default_catalog = default_catalog
+        self.certauth = certauth
+        self.interactiveauth = interactiveauth
+        self.coalesce_window = coalesce_window
+        self.manifest_refresh = manifest_refresh
+        self.membership_mode = membership_mode
+        self.cache = cache
+        self.write_tags = write_tags
+        self.queue = queue.Queue()
+        self._token = None
+        self._token_expires = 0
+        self._current_manifests = None
+        self._manifests_fetched = 0
+
+    def token(self) -> dict:
+        """Returns the cached token, re-authenticating when it is about to expire."""
+        if self._token is None or time.time() > self._token_expires:
+            app = not (self.certauth or self.interactiveauth)
+            self._token = getAuth(app, self.certauth, self.interactiveauth)
+            # Refresh five minutes before the token expires
+            self._token_expires = time.time() + int(self._token.get("expires_in", 3600)) - 300
+
+        return self._token
+
+    def current_manifests(self) -> set:
+        """Returns the cached manifest listing, refreshing it when older than manifest_refresh seconds."""
+        if self._current_manifests is None or time.time() - self._manifests_fetched > self.manifest_refresh:
+            self._current_manifests = set(get_current_manifest_blobs(self.storage))
+            self._manifests_fetched = time.time()
+            logger.debug(f"Refreshed manifest listing, found {len(self._current_manifests)} manifests")
+
+        return self._current_manifests
+
+    def submit(self, serial_numbers: list) -> None:
+        """Queue serial numbers for processing."""
+        for serial_number in serial_numbers:
+            self.queue.put(serial_number)
+
+    def next_batch(self) -> list:
+        """Block until a serial number is queued, then coalesce the serials queued within the window."""
+        serial_numbers = [self.queue.get()]
+        deadline = time.time() + self.coalesce_window
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                serial_numbers.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Keep the order the serials were received in, without duplicates
+        return list(dict.fromkeys(serial_numbers))
+
+    def process(self, serial_numbers: list) -> None:
+        """Create or update manifests for the serial numbers."""
+        # Imported here as main imports this module for the command line
+        from munki_manifest_generator.main import get_group_memberships, reconcile_devices
+        from munki_manifest_generator.fleet import FleetMembership
+
+        # One trace for each batch of serial numbers
+        with span("service.process", **{"serial_numbers": len(serial_numbers)}):
+            logger.info(f"Processing {len(serial_numbers)} queued serial numbers")
+            token = self.token()
+            current_manifests = self.current_manifests()
+
+            devices = get_devices_by_serial(serial_numbers, token)
+            found = {device.serial_number for device in devices}
+            for serial_number in serial_numbers:
+                if serial_number not in found:
+                    logger.error(f"Device with serial {serial_number} not found, skipping...")
+
+            if not devices:
+                return
+
+            device_group_responses, user_group_responses = get_group_memberships(
+                devices, self.groups, token, self.membership_mode, self.cache
+            )
+
+            fleet = FleetMembership(
+                devices,
+                self.groups,
+                current_manifests,
+                device_group_responses,
+                user_group_responses,
+                self.default_catalog,
+            )
+
+            written = reconcile_devices(
+                devices,
+                fleet,
+                self.storage,
+                self.default_catalog,
+                self.test,
+                write_tags=self.write_tags,
+            )
+
+            # Created manifests are updated on the next request instead of created again, manifests that
+            # failed to be written are created on the next request
+            current_manifests.update(written)
+
+            log_manifest_stats(manifest_encoding.MANIFEST_FORMAT)
+            logger.log_summary()
+
+    def worker(self) -> None:
+        """Process queued serial numbers until the service is stopped."""
+        while True:
+            serial_numbers = self.next_batch()
+            try:
+                self.process(serial_numbers)
+            except Exception as e:
+                logger.error(f"Exception: {e}")
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """Accepts serial numbers on POST /serial and reports the queue size on GET /health."""
+
+    service = None
+
+    def send_json(self, status: int, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "queued": self.service.queue.qsize()})
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/serial":
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length) or b"{}")
+            serial_numbers = data.get("serials") or [data.get("serial")]
+            serial_numbers = [s for s in serial_numbers if isinstance(s, str) and s]
+        except (ValueError, AttributeError):
+            self.send_json(400, {"error": "Invalid JSON body"})
+            return
+
+        if not serial_numbers:
+            self.send_json(400, {"error": "Body must contain 'serial' or 'serials'"})
+            return
+
+        invalid = [s for s in serial_numbers if not is_valid_serial_number(s)]
+        if invalid:
+            self.send_json(400, {"error": "Serial numbers may only contain letters and digits", "invalid": invalid})
+            return
+
+        self.service.submit(serial_numbers)
+        self.send_json(202, {"queued": len(serial_numbers)})
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def serve(service: ManifestService, host: str = "127.0.0.1", port: int = 8080) -> None:
+    """Start the worker and serve HTTP requests until interrupted."""
+
+    # Warm the token and manifest listing before accepting requests
+    service.token()
+    service.current_manifests()
+
+    threading.Thread(target=service.worker, name="mmg-worker", daemon=True).start()
+
+    handler = type("Handler", (ServiceRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    logger.info(f"Service listening on http://{host}:{port}, POST serial numbers to /serial")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Service stopped")
+    finally:
+        server.server_close()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+This module runs the stages of a run as a dependency graph, so stages that do not depend on each other overlap.
+"""
+
+import time
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from munki_manifest_generator.tracing import span
+
+
+class StageGraph:
+    """
+    Stages of a run and the stages each of them depends on.
+
+    A stage is started in its own thread as soon as the stages it depends on are done, and is called
+    with their results in the order they are listed. The start and end of every stage are kept to
+    report the critical path of the run.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.results = {}
+        self.times = {}
+
+    def add(self, name: str, func, depends_on: tuple = ()) -> None:
+        """Add a stage, the stages it depends on must be added first."""
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise Exception(f"Stage {name} depends on unknown stage {dependency}")
+        self.stages[name] = (func, tuple(depends_on))
+
+    def run_stage(self, name: str, started: float):
+        func, depends_on = self.stages[name]
+        start = time.perf_counter()
+        try:
+            with span("stage." + name):
+                return func(*[self.results[dependency] for dependency in depends_on])
+        finally:
+            self.times[name] = (start - started, time.perf_counter() - started)
+
+    def run(self) -> dict:
+        """
+        Run the stages and return their results by name.
+
+        If a stage raises, no more stages are started and the exception is raised once the running stages are done.
+        """
+        started = time.perf_counter()
+        pending = list(self.stages)
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max(1, len(self.stages)), thread_name_prefix="mmg-stage") as executor:
+            while True:
+                if error is None:
+                    for name in [n for n in pending if all(d in self.results for d in self.stages[n][1])]:
+                        pending.remove(name)
+                        # Run in a copy of the context so stage spans are children of the current span
+                        future = executor.submit(contextvars.copy_context().run, self.run_stage, name, started)
+                        running[future] = name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except BaseException as ex:
+                        error = error or ex
+
+        if error is not None:
+            raise error
+
+        return self.results
+
+    def critical_path(self) -> list:
+        """Returns the stages that decided the run time, from the first stage to the one that finished last."""
+        if not self.times:
+            return []
+
+        name = max(self.times, key=lambda n: self.times[n][1])
+        path = [name]
+        while True:
+            # A stage waited for the stage it depends on that finished last
+            depends_on = [d for d in self.stages[name][1] if d in self.times]
+            if not depends_on:
+                break
+            name = max(depends_on, key=lambda d: self.times[d][1])
+            path.insert(0, name)
+
+        return path
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+This module is used to measure and report statistics for a run.
+"""
+
+import sys
+import threading
+import statistics
+
+from collections import Counter
+from munki_manifest_generator.logger import logger
+
+# Counts and timings of manifest encoding and uploads for the run
+manifest_stats = Counter()
+manifest_stats_lock = threading.Lock()
+
+
+def peak_memory_mb() -> float:
+    """Returns the peak resident memory of the process in MB, or None where it can not be measured."""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def log_peak_memory(stage: str) -> None:
+    """Log the peak memory of the process after a stage."""
+    peak = peak_memory_mb()
+    if peak is not None:
+        logger.info(f"Peak memory after {stage}: {peak:.1f} MB")
+
+
+def count_manifest_stat(**values) -> None:
+    """Add to the manifest statistics, for example count_manifest_stat(uploaded=1, uploaded_bytes=512)."""
+    with manifest_stats_lock:
+        manifest_stats.update(values)
+
+
+def log_manifest_stats(manifest_format: str = "xml") -> None:
+    """Log and reset the manifest statistics."""
+    with manifest_stats_lock:
+        stats = dict(manifest_stats)
+        manifest_stats.clear()
+
+    if stats.get("parsed"):
+        logger.info(f'Parsed {stats["parsed"]} manifests in {stats["parse_seconds"] * 1000:.1f} ms')
+    if stats.get("serialized"):
+        logger.info(
+            f'Serialized {stats["serialized"]} manifests as {manifest_format} plists in '
+            f'{stats["serialize_seconds"] * 1000:.1f} ms, {stats["serialized_bytes"] / 1024:.1f} KB'
+        )
+    if stats.get("uploaded"):
+        logger.info(f'Uploaded {stats["uploaded"]} manifests, {stats["uploaded_bytes"] / 1024:.1f} KB')
+    if stats.get("replicated"):
+        logger.info(f'Replicated {stats["replicated"]} changes')
+    if stats.get("replica_failed"):
+        logger.warning(f'{stats["replica_failed"]} changes failed on replicas and are behind the primary')
+
+
+def log_time_to_first_manifest(seconds: list, run_seconds: float) -> None:
+    """Log how long new devices waited for their first manifest, next to how long the run has taken."""
+    if seconds:
+        logger.info(
+            f"Time to first manifest for {len(seconds)} new devices: first {min(seconds):.1f} s, "
+            f"median {statistics.median(seconds):.1f} s, last {max(seconds):.1f} s, run time {run_seconds:.1f} s"
+        )
+
+
+def log_stage_times(times: dict, critical_path: list) -> None:
+    """Log when each stage of the run started and how long it took, and the time of each stage on the critical path."""
+    for name, (start, end) in sorted(times.items(), key=lambda item: item[1][0]):
+        logger.info(f"Stage {name}: {end - start:.1f} s, from {start:.1f} s to {end:.1f} s")
+    if critical_path:
+        logger.info(
+            "Critical path: "
+            + ", ".join(f"{name} {times[name][1] - times[name][0]:.1f} s" for name in critical_path)
+            + f", total {times[critical_path[-1]][1]:.1f} s"
+        )
+
+
+def log_config_diff_stats(
+    changes: dict, queried_groups: int, groups: int, read: int, updated: int, manifests: int, missing: int
+) -> None:
+    """Log the changes to the group config and the work a partial run skipped because of them."""
+    logger.info("Group config changes: " + ", ".join(f"{count} {change}" for change, count in changes.items()))
+    logger.info(
+        f"Queried the members of {queried_groups} of {groups} groups, "
+        f"skipped the device inventory and the memberships of {groups - queried_groups} groups"
+    )
+    logger.info(f"Read {read} of {manifests} manifests, updated {updated}, skipped {manifests - read}")
+    if missing:
+        logger.info(f"{missing} members of added groups have no manifest yet and are left to the next full run")
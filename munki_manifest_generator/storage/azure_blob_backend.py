@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+This module stores manifests in the manifests folder of an Azure Storage container.
+"""
+
+from munki_manifest_generator.azstorage.az_storage_clients import az_container_client
+from munki_manifest_generator.storage.storage_backend import ManifestNotFound, PreconditionFailed, StorageBackend
+
+
+class AzureBlobBackend(StorageBackend):
+    """Manifests stored as blobs, ETags are the blob ETags and conditional writes use If-Match."""
+
+    def __init__(self, connection_string: str, container_name: str, connection_variable: str = None):
+        self.connection_string = connection_string
+        self.container_name = container_name
+        # Environment variable with the connection string if it is not AZURE_STORAGE_CONNECTION_STRING
+        self.connection_variable = connection_variable
+        self.container_client = az_container_client(connection_string, container_name)
+
+    def __repr__(self):
+        if self.connection_variable:
+            return f"azure:{self.container_name}@{self.connection_variable}"
+        return f"azure:{self.container_name}"
+
+    def blob_client(self, name: str):
+        return self.container_client.get_blob_client("manifests/" + name)
+
+    @staticmethod
+    def conditions(etag: str) -> dict:
+        if etag is None:
+            return {}
+        from azure.core import MatchConditions
+
+        return {"etag": etag, "match_condition": MatchConditions.IfNotModified}
+
+    def list(self) -> list:
+        # Get the name of each blob
+        return [blob.name.rsplit("/", 1)[1] for blob in self.container_client.list_blobs(name_starts_with="manifests/")]
+
+    def get(self, name: str) -> tuple:
+        blob_data = self.blob_client(name).download_blob()
+        return blob_data.readall(), blob_data.properties.etag
+
+    def put(self, name: str, data: bytes, etag: str = None, tags: dict = None) -> str:
+        from azure.core.exceptions import ResourceModifiedError
+
+        try:
+            result = self.blob_client(name).upload_blob(data, overwrite=True, tags=tags, **self.conditions(etag))
+        except ResourceModifiedError:
+            raise PreconditionFailed(f"Manifest {name} was changed after it was read")
+
+        return result.get("etag")
+
+    def find(self, tags: dict) -> list:
+        # Blob index tags are indexed for the storage account, the query is limited to the container
+        expression = " AND ".join(f"\"{key}\" = '{value}'" for key, value in tags.items())
+        return [
+            blob.name.rsplit("/", 1)[1]
+            for blob in self.container_client.find_blobs_by_tags(expression)
+            if blob.name.startswith("manifests/")
+        ]
+
+    def delete(self, name: str, etag: str = None) -> None:
+        from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+
+        try:
+            self.blob_client(name).delete_blob(**self.conditions(etag))
+        except ResourceModifiedError:
+            raise PreconditionFailed(f"Manifest {name} was changed after it was read")
+        except ResourceNotFoundError:
+            raise ManifestNotFound(f"Manifest {name} does not exist")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+This module stores manifests in the manifests folder of a munki repo on disk, such as a local or NFS mounted repo.
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+
+from munki_manifest_generator.storage.storage_backend import ManifestNotFound, PreconditionFailed, StorageBackend
+
+
+def get_etag(data: bytes) -> str:
+    """Returns the ETag of a manifest, a hash of its content."""
+    return hashlib.md5(data).hexdigest()
+
+
+class LocalBackend(StorageBackend):
+    """Manifests stored as files, writes are atomic so munki clients served from the repo never read a partial file."""
+
+    def __init__(self, path: str):
+        self.path = os.path.join(path, "manifests")
+        if not os.path.isdir(self.path):
+            raise Exception(f"Manifests folder {self.path} does not exist")
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"local:{os.path.dirname(self.path)}"
+
+    def list(self) -> list:
+        # Skip hidden files such as .DS_Store and files being written
+        return [
+            name
+            for name in os.listdir(self.path)
+            if not name.startswith(".") and os.path.isfile(os.path.join(self.path, name))
+        ]
+
+    def read(self, name: str) -> bytes:
+        with open(os.path.join(self.path, name), "rb") as f:
+            return f.read()
+
+    def get(self, name: str) -> tuple:
+        data = self.read(name)
+        return data, get_etag(data)
+
+    def put(self, name: str, data: bytes, etag: str = None, tags: dict = None) -> str:
+        # Files have no tags, finding manifests by tags is not supported
+        with self.lock:
+            if etag is not None and get_etag(self.read(name)) != etag:
+                raise PreconditionFailed(f"Manifest {name} was changed after it was read")
+
+            # Write to a hidden file in the same folder and move it in place
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=".")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, os.path.join(self.path, name))
+            except Exception:
+                os.remove(tmp_path)
+                raise
+
+        return get_etag(data)
+
+    def delete(self, name: str, etag: str = None) -> None:
+        with self.lock:
+            if not os.path.isfile(os.path.join(self.path, name)):
+                raise ManifestNotFound(f"Manifest {name} does not exist")
+            if etag is not None and get_etag(self.read(name)) != etag:
+                raise PreconditionFailed(f"Manifest {name} was changed after it was read")
+            os.remove(os.path.join(self.path, name))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+"""
+This module stores manifests in memory, used for test and benchmark runs.
+"""
+
+import itertools
+import threading
+
+from munki_manifest_generator.storage.storage_backend import ManifestNotFound, PreconditionFailed, StorageBackend
+
+
+class MemoryBackend(StorageBackend):
+    """Manifests stored in a dict, ETags are version numbers."""
+
+    def __init__(self, manifests: dict = None):
+        self.lock = threading.Lock()
+        self.versions = itertools.count(1)
+        self.manifests = {}
+        self.tags = {}
+        for name, data in (manifests or {}).items():
+            self.put(name, data)
+
+    def __repr__(self):
+        return "memory"
+
+    def list(self) -> list:
+        with self.lock:
+            return list(self.manifests)
+
+    def get(self, name: str) -> tuple:
+        with self.lock:
+            return self.manifests[name]
+
+    def put(self, name: str, data: bytes, etag: str = None, tags: dict = None) -> str:
+        with self.lock:
+            if etag is not None and self.manifests.get(name, (None, None))[1] != etag:
+                raise PreconditionFailed(f"Manifest {name} was changed after it was read")
+            new_etag = str(next(self.versions))
+            self.manifests[name] = (data, new_etag)
+            self.tags[name] = dict(tags or {})
+
+        return new_etag
+
+    def find(self, tags: dict) -> list:
+        with self.lock:
+            return [name for name, blob_tags in self.tags.items() if tags.items() <= blob_tags.items()]
+
+    def delete(self, name: str, etag: str = None) -> None:
+        with self.lock:
+            if name not in self.manifests:
+                raise ManifestNotFound(f"Manifest {name} does not exist")
+            if etag is not None and self.manifests.get(name, (None, None))[1] != etag:
+                raise PreconditionFailed(f"Manifest {name} was changed after it was read")
+            del self.manifests[name]
+            self.tags.pop(name, None)
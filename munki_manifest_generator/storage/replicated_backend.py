@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+This module writes manifests to a primary storage and mirrors every change to replicas, such as repos in other regions.
+"""
+
+import zlib
+import time
+import functools
+import threading
+import statistics
+
+from concurrent.futures import ThreadPoolExecutor
+from munki_manifest_generator.logger import logger
+from munki_manifest_generator.stats import count_manifest_stat
+from munki_manifest_generator.storage.storage_backend import ManifestNotFound, StorageBackend
+
+# Attempts to apply a change to a replica before it is reported as failed, waiting 1, 2 and 4 seconds in between
+REPLICA_ATTEMPTS = 4
+# Changes in flight for each replica
+REPLICA_WORKERS = 8
+
+
+class Replica:
+    """
+    A replica with its own writers, the retries and failures of the changes applied to it and their lag.
+
+    Every manifest name is assigned to one of REPLICA_WORKERS single-thread writers, so changes to a
+    manifest are applied in the order they were made on the primary, also when one of them is retried.
+    """
+
+    def __init__(self, storage: StorageBackend):
+        self.storage = storage
+        self.writers = [
+            ThreadPoolExecutor(1, thread_name_prefix=f"mmg-replica-{i}") for i in range(REPLICA_WORKERS)
+        ]
+        self.lock = threading.Lock()
+        self.lag = []
+        self.retries = 0
+        self.failed = []
+
+    def submit(self, change: str, name: str, func, written: float) -> None:
+        """Queue a change on the writer of the manifest."""
+        self.writers[zlib.crc32(name.encode()) % REPLICA_WORKERS].submit(self.apply, change, name, func, written)
+
+    def shutdown(self) -> None:
+        """Wait for the queued changes to be applied."""
+        for writer in self.writers:
+            writer.shutdown(wait=True)
+
+    def apply(self, change: str, name: str, func, written: float) -> None:
+        """Apply a change written to the primary at the written time, retrying with backoff."""
+        for attempt in range(REPLICA_ATTEMPTS):
+            try:
+                func(self.storage)
+                break
+            except ManifestNotFound:
+                # The replica does not have the deleted manifest either
+                break
+            except Exception as ex:
+                if attempt == REPLICA_ATTEMPTS - 1:
+                    logger.error(f"Error: {change} of {name} on replica {self.storage!r} failed: " + str(ex))
+                    with self.lock:
+                        self.failed.append(name)
+                    count_manifest_stat(replica_failed=1)
+                    return
+                with self.lock:
+                    self.retries += 1
+                time.sleep(2**attempt)
+
+        with self.lock:
+            self.lag.append(time.perf_counter() - written)
+        count_manifest_stat(replicated=1)
+
+    def log_lag(self) -> None:
+        """Log the changes applied to the replica and how long after the primary they were applied."""
+        if self.lag:
+            logger.info(
+                f"Replica {self.storage!r}: {len(self.lag)} changes applied, {self.retries} retries, "
+                f"lag median {statistics.median(self.lag):.1f} s, max {max(self.lag):.1f} s"
+            )
+        if self.failed:
+            logger.warning(
+                f"Replica {self.storage!r}: {len(self.failed)} changes failed and are behind the primary: "
+                + ", ".join(self.failed[:10])
+                + (", ..." if len(self.failed) > 10 else "")
+            )
+
+
+class ReplicatedBackend(StorageBackend):
+    """
+    Manifests read from a primary storage, changes are written to the primary and then to every replica.
+
+    ETags are the ETags of the primary and conditional writes only apply to the primary, a change that
+    fails on the primary is not replicated. Each replica is written in the background by its own workers
+    with its own retries, so a slow or unavailable replica does not hold up the run or the other replicas.
+    close() waits for the replicas to catch up and logs their lag, close the storage before logging the
+    manifest statistics to include the replicated and failed changes.
+    """
+
+    def __init__(self, primary: StorageBackend, replicas: list):
+        self.primary = primary
+        self.replicas = [Replica(replica) for replica in replicas]
+        self.closed = False
+
+    def __repr__(self):
+        return f"{self.primary!r} replicated to " + ", ".join(repr(replica.storage) for replica in self.replicas)
+
+    def replicate(self, change: str, name: str, func) -> None:
+        written = time.perf_counter()
+        for replica in self.replicas:
+            replica.submit(change, name, func, written)
+
+    def list(self) -> list:
+        return self.primary.list()
+
+    def get(self, name: str) -> tuple:
+        return self.primary.get(name)
+
+    def put(self, name: str, data: bytes, etag: str = None, tags: dict = None) -> str:
+        new_etag = self.primary.put(name, data, etag, tags)
+        self.replicate("put", name, functools.partial(put_replica, name=name, data=data, tags=tags))
+        return new_etag
+
+    def find(self, tags: dict) -> list:
+        return self.primary.find(tags)
+
+    def delete(self, name: str, etag: str = None) -> None:
+        self.primary.delete(name, etag)
+        self.replicate("delete", name, functools.partial(delete_replica, name=name))
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.primary.close()
+        for replica in self.replicas:
+            replica.shutdown()
+            replica.log_lag()
+            replica.storage.close()
+
+
+def put_replica(storage: StorageBackend, name: str, data: bytes, tags: dict) -> None:
+    # Replicas are overwritten, they follow the primary
+    storage.put(name, data, None, tags)
+
+
+def delete_replica(storage: StorageBackend, name: str) -> None:
+    storage.delete(name)
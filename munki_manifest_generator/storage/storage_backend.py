@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the interface for where manifests are stored.
+"""
+
+import os
+
+
+class PreconditionFailed(Exception):
+    """Raised when a manifest was changed after it was read."""
+
+
+class ManifestNotFound(Exception):
+    """Raised when a manifest to delete does not exist."""
+
+
+class StorageBackend:
+    """
+    Stores manifests by name.
+
+    Every version of a manifest has an ETag. Passing the ETag from get() to put() or delete()
+    only changes the manifest if it has not been changed since it was read. Backends that support
+    tags store them with the manifest and can find manifests by them.
+    """
+
+    def list(self) -> list:
+        """Returns the names of the manifests."""
+        raise NotImplementedError
+
+    def get(self, name: str) -> tuple:
+        """Returns the content and ETag of the manifest."""
+        raise NotImplementedError
+
+    def put(self, name: str, data: bytes, etag: str = None, tags: dict = None) -> str:
+        """Writes the manifest and returns its new ETag, raises PreconditionFailed if the ETag does not match."""
+        raise NotImplementedError
+
+    def find(self, tags: dict) -> list:
+        """Returns the names of the manifests that have all of the tags."""
+        raise Exception(f"Finding manifests by tags is not supported for {self!r} storage")
+
+    def delete(self, name: str, etag: str = None) -> None:
+        """Deletes the manifest, raises PreconditionFailed if the ETag does not match, ManifestNotFound if missing."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+def get_storage_backend(storage=None, replicas=None) -> StorageBackend:
+    """
+    Returns the storage backend for the storage option.
+
+    :param storage: "azure" (default) for the container in CONTAINER_NAME and AZURE_STORAGE_CONNECTION_STRING,
+                    "azure:<container>" for another container in the same storage account, "local:<path>" for the
+                    manifests folder of a munki repo on disk, "memory" for an empty in-memory store, or a StorageBackend
+    :param replicas: Storage options of replicas every change is mirrored to, "azure:<container>@<variable>" for a
+                     container in the storage account with the connection string in the environment variable
+    """
+    # Backends are imported when used so the Azure SDK is only loaded for Azure storage
+    if replicas:
+        from munki_manifest_generator.storage.replicated_backend import ReplicatedBackend
+
+        if isinstance(replicas, (str, StorageBackend)):
+            replicas = [replicas]
+        return ReplicatedBackend(get_storage_backend(storage), [get_storage_backend(replica) for replica in replicas])
+
+    if isinstance(storage, StorageBackend):
+        return storage
+
+    if not storage or storage == "azure" or storage.startswith("azure:"):
+        from munki_manifest_generator.storage.azure_blob_backend import AzureBlobBackend
+
+        # The container in the storage option takes precedence over CONTAINER_NAME
+        container_name = storage.split(":", 1)[1] if storage and ":" in storage else os.environ.get("CONTAINER_NAME")
+        # A container in another storage account names the environment variable with its connection string
+        connection_variable = "AZURE_STORAGE_CONNECTION_STRING"
+        if container_name and "@" in container_name:
+            container_name, connection_variable = container_name.split("@", 1)
+
+        # Check if required environment variables are set
+        if not all(
+            [
+                container_name,
+                os.environ.get(connection_variable),
+            ]
+        ):
+            raise Exception("Missing required environment variables, stopping...")
+
+        if connection_variable != "AZURE_STORAGE_CONNECTION_STRING":
+            return AzureBlobBackend(os.environ.get(connection_variable), container_name, connection_variable)
+        return AzureBlobBackend(os.environ.get(connection_variable), container_name)
+
+    if storage.startswith("local:"):
+        from munki_manifest_generator.storage.local_backend import LocalBackend
+
+        return LocalBackend(storage.split(":", 1)[1])
+
+    if storage == "memory":
+        from munki_manifest_generator.storage.memory_backend import MemoryBackend
+
+        return MemoryBackend()
+
+    raise Exception(f"Unknown storage {storage}, choose from: azure, azure:<container>, local:<path>, memory")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""
+This module adds optional OpenTelemetry spans to a run, exported to OTLP or a local JSON file.
+"""
+
+import os
+import json
+import threading
+
+from munki_manifest_generator.logger import logger
+
+# Tracer and provider set by setup_tracing, spans are no-ops while tracing is not set up
+TRACER = None
+PROVIDER = None
+
+
+class NoSpan:
+    """Stands in for a span when tracing is not set up."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set_attribute(self, key, value) -> None:
+        pass
+
+    def set_attributes(self, attributes: dict) -> None:
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class JsonFileExporter:
+    """Writes finished spans to a file, one JSON object per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans) -> "SpanExportResult":
+        from opentelemetry.sdk.trace.export import SpanExportResult
+
+        with self.lock, open(self.path, "a") as f:
+            for span in spans:
+                f.write(json.dumps(json.loads(span.to_json())) + "\n")
+
+        return SpanExportResult.SUCCESS
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return True
+
+    def shutdown(self) -> None:
+        pass
+
+
+def setup_tracing(exporter: str) -> None:
+    """
+    Export spans of the run.
+
+    :param exporter: "otlp" to export to the endpoint in OTEL_EXPORTER_OTLP_ENDPOINT, or a path to a file to write
+                     spans to
+    """
+    global TRACER, PROVIDER
+
+    # Imported on first use, OpenTelemetry is only required when tracing
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        raise Exception(
+            "Tracing requires opentelemetry-sdk, install it with: pip install munki-manifest-generator[tracing]"
+        )
+
+    if exporter == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            raise Exception(
+                "Exporting to OTLP requires opentelemetry-exporter-otlp-proto-http, "
+                "install it with: pip install munki-manifest-generator[tracing]"
+            )
+        span_exporter = OTLPSpanExporter()
+        logger.info(f'Exporting spans to {os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")}')
+    else:
+        span_exporter = JsonFileExporter(exporter)
+        logger.info(f"Writing spans to {exporter}")
+
+    PROVIDER = TracerProvider(resource=Resource.create({"service.name": "munki-manifest-generator"}))
+    PROVIDER.add_span_processor(BatchSpanProcessor(span_exporter))
+    TRACER = PROVIDER.get_tracer("munki_manifest_generator")
+
+
+def span(name: str, **attributes):
+    """Returns a context manager for a span that is a child of the current span, or a no-op if tracing is not set up."""
+    if TRACER is None:
+        return NO_SPAN
+    return TRACER.start_as_current_span(name, attributes=attributes)
+
+
+def current_span():
+    """Returns the current span to add attributes to, or a no-op if tracing is not set up."""
+    if TRACER is None:
+        return NO_SPAN
+    from opentelemetry import trace
+
+    return trace.get_current_span()
+
+
+def stop_tracing() -> None:
+    """Export the remaining spans and stop tracing."""
+    global TRACER, PROVIDER
+    if PROVIDER is not None:
+        PROVIDER.shutdown()
+    TRACER = None
+    PROVIDER = None
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Tests for the async Azure Storage client, run against a fake container client.
+"""
+
+import asyncio
+
+import pytest
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError
+
+from munki_manifest_generator.device import Device
+from munki_manifest_generator.fleet import FleetMembership
+from munki_manifest_generator.checkpoint import Checkpoint, get_run_key
+from munki_manifest_generator.main import reconcile_devices_async
+from munki_manifest_generator.manifest_encoding import dumps_manifest, loads_manifest
+from munki_manifest_generator.azstorage.az_storage_async import AsyncBlobStorage
+
+
+class Properties:
+    def __init__(self, etag):
+        self.etag = etag
+
+
+class Download:
+    def __init__(self, data, etag):
+        self.data = data
+        self.properties = Properties(etag)
+
+    async def readall(self):
+        return self.data
+
+
+class FakeContainerClient:
+    """Blobs in memory with an etag that changes on every write, like the aio ContainerClient."""
+
+    def __init__(self, blobs):
+        self.blobs = {}
+        self.version = 0
+        for name, data in blobs.items():
+            self.write(name, data)
+        # Called after a blob is downloaded, to change it before it is written back
+        self.on_download = None
+
+    def write(self, name, data):
+        self.version += 1
+        self.blobs[name] = (data, '"0x%d"' % self.version)
+
+    async def download_blob(self, name):
+        data, etag = self.blobs[name]
+        if self.on_download is not None:
+            self.on_download(name)
+        return Download(data, etag)
+
+    async def upload_blob(self, name, data, overwrite=False, tags=None, etag=None, match_condition=None):
+        if match_condition == MatchConditions.IfNotModified and self.blobs[name][1] != etag:
+            raise ResourceModifiedError("The condition specified using HTTP conditional header(s) is not met.")
+        self.write(name, data)
+
+
+@pytest.fixture
+def storage():
+    storage = AsyncBlobStorage("", "munki")
+    storage._container_client = FakeContainerClient(
+        {
+            "manifests/site_default": dumps_manifest({}),
+            "manifests/SER1": dumps_manifest(
+                {"catalogs": ["Production"], "included_manifests": ["site_default"], "user": "old@example.com"}
+            ),
+        }
+    )
+    storage._semaphore = asyncio.Semaphore(storage.max_concurrency)
+    yield storage
+    storage.close()
+
+
+def test_download_returns_data_and_etag(storage):
+    data, etag = storage.run(storage.download("SER1"))
+
+    assert loads_manifest(data)["user"] == "old@example.com"
+    assert etag == storage._container_client.blobs["manifests/SER1"][1]
+
+
+def test_upload_with_current_etag_is_written(storage):
+    _, etag = storage.run(storage.download("SER1"))
+
+    assert storage.run(storage.upload("SER1", b"new", etag))
+    assert storage._container_client.blobs["manifests/SER1"][0] == b"new"
+
+
+def test_upload_of_changed_manifest_fails(storage):
+    _, etag = storage.run(storage.download("SER1"))
+    storage._container_client.write("manifests/SER1", b"changed")
+
+    assert not storage.run(storage.upload("SER1", b"new", etag))
+    assert storage._container_client.blobs["manifests/SER1"][0] == b"changed"
+
+
+def test_device_with_manifest_changed_during_run_is_not_reconciled(storage, tmp_path):
+    container = storage._container_client
+    container.on_download = lambda name: container.write(name, container.blobs[name][0])
+    devices = [
+        Device("SER1", "aad1", "user1@example.com", "2023-01-01T00:00:00Z"),
+        Device("SER2", "aad2", "user2@example.com", "2023-01-01T00:00:00Z"),
+    ]
+    fleet = FleetMembership(devices, [], ["site_default", "SER1"], [], [])
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.jsonl"), get_run_key(storage="azure"))
+
+    written = storage.run(reconcile_devices_async(devices, fleet, storage, "Production", False, checkpoint))
+
+    assert written == ["SER2"]
+    assert loads_manifest(container.blobs["manifests/SER1"][0])["user"] == "old@example.com"
+    assert not checkpoint.is_reconciled("SER1")
+    assert checkpoint.is_reconciled("SER2")
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Tests for recording the Graph and storage traffic of a run and replaying it.
+"""
+
+import json
+
+import pytest
+
+from munki_manifest_generator import capture
+from munki_manifest_generator.capture import TrafficArchive
+from munki_manifest_generator.manifest_encoding import dumps_manifest
+from munki_manifest_generator.storage.memory_backend import MemoryBackend
+
+USER = {
+    "id": "11111111-2222-3333-4444-555555555555",
+    "userPrincipalName": "alice@example.org",
+    "displayName": "Alice Example",
+    "mail": "alice@example.org",
+    "mobilePhone": "+1 555 0100",
+    "accountEnabled": True,
+}
+DEVICE = {
+    "serialNumber": "C02ABC123",
+    "azureADDeviceId": "66666666-7777-8888-9999-000000000000",
+    "userPrincipalName": "alice@example.org",
+    "enrolledDateTime": "2023-01-01T00:00:00Z",
+    "userId": USER["id"],
+    "deviceName": "Alice's MacBook",
+    "operatingSystem": "macOS",
+}
+
+
+class Clock:
+    """Replaces time.time and time.sleep, sleeping moves the clock forward."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(capture.time, "time", clock.time)
+    monkeypatch.setattr(capture.time, "sleep", clock.sleep)
+    return clock
+
+
+class SlowBackend(MemoryBackend):
+    """Memory storage where every operation takes a fixed time on the clock."""
+
+    def __init__(self, manifests, clock, seconds):
+        self.clock = clock
+        self.seconds = seconds
+        super().__init__(manifests)
+
+    def get(self, name):
+        self.clock.now += self.seconds
+        return super().get(name)
+
+    def put(self, name, data, etag=None, tags=None):
+        self.clock.now += self.seconds
+        return super().put(name, data, etag, tags)
+
+
+def test_users_and_devices_are_recorded_with_used_fields_only(tmp_path):
+    archive = TrafficArchive(str(tmp_path / "run.json.gz"))
+    archive.record("GET users", {"status": 200, "body": {"value": [dict(USER)]}}, 0.1)
+    archive.record("GET devices", {"value": [dict(DEVICE)]}, 0.1)
+    archive.save()
+
+    replay = TrafficArchive(archive.path, replay=True)
+    user = replay.requests["GET users"][0]["response"]["body"]["value"][0]
+    device = replay.requests["GET devices"][0]["response"]["value"][0]
+    text = json.dumps(replay.requests)
+
+    assert sorted(user) == ["accountEnabled", "id", "userPrincipalName"]
+    assert user["accountEnabled"] is True
+    assert "deviceName" not in device
+    assert device["operatingSystem"] == "macOS"
+    # The user id is the same placeholder in the user and in the device
+    assert device["userId"] == user["id"] != USER["id"]
+    for value in ["Alice", "alice@example.org", "555", USER["id"], DEVICE["serialNumber"]]:
+        assert value not in text
+
+
+def test_recorded_storage_latency_is_replayed(tmp_path, clock):
+    archive = TrafficArchive(str(tmp_path / "run.json.gz"))
+    storage = archive.recording_backend(SlowBackend({"C02ABC123": dumps_manifest({})}, clock, 0.25))
+    storage.list()
+    storage.get("C02ABC123")
+    storage.put("C02ABC123", dumps_manifest({"catalogs": ["Production"]}))
+    archive.save()
+
+    replay = TrafficArchive(archive.path, replay=True, latency="recorded")
+    replay_storage = replay.replay_backend()
+    name = replay_storage.list()[0]
+    replay_storage.get(name)
+    replay_storage.put(name, b"")
+    # A write that was not recorded takes the mean time of the recorded writes
+    replay_storage.put("SERIAL999999", b"")
+
+    assert name != "C02ABC123"
+    assert clock.sleeps == [0, 0.25, 0.25, 0.25]
+
+
+def test_fixed_latency_is_replayed_for_storage(tmp_path, clock):
+    archive = TrafficArchive(str(tmp_path / "run.json.gz"))
+    archive.recording_backend(MemoryBackend({"C02ABC123": dumps_manifest({})})).list()
+    archive.save()
+
+    replay_storage = TrafficArchive(archive.path, replay=True, latency="0.5").replay_backend()
+    replay_storage.get(replay_storage.list()[0])
+
+    assert clock.sleeps == [0.5, 0.5]
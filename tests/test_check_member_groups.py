@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Tests for checking the membership of the configured groups with checkMemberGroups.
+"""
+
+from munki_manifest_generator import main
+from munki_manifest_generator.graph import check_member_groups as check
+from munki_manifest_generator.graph.check_member_groups import GROUP_IDS_PER_REQUEST, check_member_groups
+
+GROUPS = [{"name": "Group%d" % i, "id": "g%d" % i, "type": "device"} for i in range(GROUP_IDS_PER_REQUEST + 5)]
+MEMBERS = {"aad1": {"g0", "g21"}, "aad2": {"g3"}, "aad3": set()}
+
+
+def fake_check(requests):
+    """Answers checkMemberGroups requests with the groups of MEMBERS that are in the request body."""
+
+    def iter_batch_request(data, url, extra_url, batch_type, token, method="GET", body=None):
+        requests.append((extra_url, method, body["groupIds"]))
+        for response in data:
+            key = response["value"][0]["deviceId"]
+            yield {"deviceId": key, "value": [i for i in body["groupIds"] if i in MEMBERS[key]]}
+
+    return iter_batch_request
+
+
+def id_responses(keys):
+    return [{"value": [{"id": key, "deviceId": key}]} for key in keys]
+
+
+def test_groups_are_checked_in_chunks_and_merged(monkeypatch):
+    requests = []
+    monkeypatch.setattr(check, "iter_batch_request", fake_check(requests))
+
+    responses = check_member_groups(id_responses(MEMBERS), "devices(deviceId='", "device", GROUPS, {}, "')")
+
+    assert [len(group_ids) for _, _, group_ids in requests] == [GROUP_IDS_PER_REQUEST, 5]
+    assert {extra_url for extra_url, _, _ in requests} == {"')/checkMemberGroups"}
+    assert {method for _, method, _ in requests} == {"POST"}
+    assert responses == [
+        {"deviceId": "aad1", "value": [{"id": "g0", "displayName": "Group0"}, {"id": "g21", "displayName": "Group21"}]},
+        {"deviceId": "aad2", "value": [{"id": "g3", "displayName": "Group3"}]},
+        {"deviceId": "aad3", "value": []},
+    ]
+
+
+def test_check_mode_resolves_the_same_memberships_as_search(monkeypatch):
+    requests = []
+    monkeypatch.setattr(check, "iter_batch_request", fake_check(requests))
+
+    def search(data, url, extra_url, batch_type, token, method="GET", body=None):
+        for response in data:
+            key = response["value"][0]["deviceId"]
+            groups = [group for group in GROUPS if group["id"] in MEMBERS[key]]
+            yield {"deviceId": key, "value": [{"id": g["id"], "displayName": g["name"]} for g in groups]}
+
+    monkeypatch.setattr(main, "iter_batch_request", search)
+
+    checked = main.resolve_memberships(list(MEMBERS), "device", GROUPS, {}, "check", "")
+    searched = main.resolve_memberships(list(MEMBERS), "device", GROUPS, {}, "search", "")
+
+    assert checked == searched
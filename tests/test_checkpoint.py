@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+Tests for resuming an interrupted run from its progress journal.
+"""
+
+import json
+
+from munki_manifest_generator.device import Device
+from munki_manifest_generator.fleet import FleetMembership
+from munki_manifest_generator.main import reconcile_devices, split_fast_lane
+from munki_manifest_generator.checkpoint import Checkpoint, get_run_key
+from munki_manifest_generator.manifest_encoding import dumps_manifest
+from munki_manifest_generator.storage.memory_backend import MemoryBackend
+
+
+def interrupted_run(path, run_key):
+    checkpoint = Checkpoint(str(path), run_key)
+    checkpoint.complete_stage("devices", [{"serialNumber": "SER1"}, {"serialNumber": "SER2"}])
+    checkpoint.mark_reconciled("SER1")
+    checkpoint.close()
+
+
+def test_resume_with_same_run_key(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    run_key = get_run_key(storage="memory", groups=[], test=False)
+    interrupted_run(path, run_key)
+
+    checkpoint = Checkpoint(str(path), get_run_key(storage="memory", groups=[], test=False))
+
+    assert checkpoint.stage("devices") == [{"serialNumber": "SER1"}, {"serialNumber": "SER2"}]
+    assert checkpoint.is_reconciled("SER1")
+    assert not checkpoint.is_reconciled("SER2")
+    assert checkpoint.stage("memberships") is None
+
+
+def test_other_configuration_starts_over(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    interrupted_run(path, get_run_key(storage="memory", test=False))
+
+    checkpoint = Checkpoint(str(path), get_run_key(storage="memory", test=True))
+
+    assert checkpoint.stage("devices") is None
+    assert not checkpoint.is_reconciled("SER1")
+
+
+def test_incomplete_last_line_is_ignored(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    run_key = get_run_key(storage="memory")
+    interrupted_run(path, run_key)
+    with open(path, "a") as f:
+        f.write('{"serial": "SER')
+
+    checkpoint = Checkpoint(str(path), run_key)
+
+    assert checkpoint.is_reconciled("SER1")
+    assert not checkpoint.is_reconciled("SER2")
+
+
+def test_resumed_progress_is_kept(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    run_key = get_run_key(storage="memory")
+    interrupted_run(path, run_key)
+
+    checkpoint = Checkpoint(str(path), run_key)
+    checkpoint.mark_reconciled("SER2")
+    checkpoint.close()
+
+    with open(path) as f:
+        serials = [json.loads(line).get("serial") for line in f]
+    assert [serial for serial in serials if serial] == ["SER1", "SER2"]
+
+
+def test_finish_removes_journal(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    checkpoint = Checkpoint(str(path), get_run_key(storage="memory"))
+    checkpoint.mark_reconciled("SER1")
+    checkpoint.finish()
+
+    assert not path.exists()
+
+
+def test_reconciled_devices_are_skipped_on_resume(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    run_key = get_run_key(storage="memory")
+    interrupted_run(path, run_key)
+    devices = [
+        Device("SER1", "aad1", "user1@example.com", "2023-01-01T00:00:00Z"),
+        Device("SER2", "aad2", "user2@example.com", "2023-01-01T00:00:00Z"),
+        Device("SER3", "aad3", "user3@example.com", "2023-01-01T00:00:00Z"),
+    ]
+
+    fast_lane, bulk = split_fast_lane(devices, {"SER1", "SER2"}, Checkpoint(str(path), run_key))
+
+    assert [device.serial_number for device in fast_lane] == ["SER3"]
+    assert [device.serial_number for device in bulk] == ["SER2"]
+
+
+class FailingBackend(MemoryBackend):
+    """Memory storage where writes of some manifests fail."""
+
+    def __init__(self, manifests, fail_puts):
+        self.fail_puts = set(fail_puts)
+        super().__init__(manifests)
+
+    def put(self, name, data, etag=None, tags=None):
+        if name in self.fail_puts:
+            raise Exception("write failed")
+        return super().put(name, data, etag, tags)
+
+
+def test_failed_devices_are_not_marked_reconciled(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    unchanged = {
+        "catalogs": ["Production"],
+        "included_manifests": ["site_default"],
+        "display_name": "SER1",
+        "serialnumber": "SER1",
+        "user": "user1@example.com",
+    }
+    storage = FailingBackend({"site_default": dumps_manifest({}), "SER1": dumps_manifest(unchanged)}, ["SER3"])
+    devices = [
+        Device("SER1", "aad1", "user1@example.com", "2023-01-01T00:00:00Z"),
+        Device("SER2", "aad2", "user2@example.com", "2023-01-01T00:00:00Z"),
+        Device("SER3", "aad3", "user3@example.com", "2023-01-01T00:00:00Z"),
+    ]
+    fleet = FleetMembership(devices, [], storage.list(), [], [])
+    checkpoint = Checkpoint(str(path), get_run_key(storage="memory"))
+
+    written = reconcile_devices(devices, fleet, storage, "Production", False, checkpoint)
+
+    assert written == ["SER2"]
+    assert checkpoint.is_reconciled("SER1")
+    assert checkpoint.is_reconciled("SER2")
+    assert not checkpoint.is_reconciled("SER3")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Tests for the handling of the sub-responses of Graph batch requests.
+"""
+
+import json
+import logging
+
+import pytest
+
+from munki_manifest_generator.logger import logger
+from munki_manifest_generator.graph import concurrent_batch
+from munki_manifest_generator.graph.concurrent_batch import batch_request
+
+GROUP = {"id": "g1", "displayName": "Beta"}
+
+
+class FakeGraph:
+    """Answers sub-requests with the status set for their id, 200 with a group membership by default."""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def post(self, endpoint, token, jdata):
+        responses = []
+        for request in json.loads(jdata)["requests"]:
+            status = self.statuses.get(request["id"], [200]).pop(0)
+            body = {"value": [GROUP]} if status == 200 else {"error": {"code": "Request_ResourceNotFound"}}
+            headers = {"Retry-After": "1"} if status == 429 else {}
+            responses.append({"id": request["id"], "status": status, "headers": headers, "body": body})
+        return {"responses": responses}
+
+
+@pytest.fixture
+def log(caplog, monkeypatch):
+    # Retries wait for Retry-After with time.sleep, the tests do not wait for them
+    monkeypatch.setattr(concurrent_batch.time, "sleep", lambda seconds: None)
+    # The logger is not a child of the root logger that caplog captures
+    logger.addHandler(caplog.handler)
+    yield caplog
+    logger.removeHandler(caplog.handler)
+
+
+def lookups(kind, ids):
+    key = "deviceId" if kind == "device" else "userPrincipalName"
+    return [{"value": [{"id": i, key: "key-" + i}]} for i in ids]
+
+
+def test_device_not_in_azure_ad_has_no_memberships(log, monkeypatch):
+    monkeypatch.setattr(concurrent_batch, "make_api_request_Post", FakeGraph({"d2": [404]}).post)
+
+    responses = batch_request(lookups("device", ["d1", "d2"]), "devices(deviceId='", "')", "device", {})
+
+    by_key = {response["deviceId"]: response["value"] for response in responses}
+    assert by_key == {"key-d1": [GROUP], "key-d2": []}
+    assert not [record for record in log.records if record.levelno >= logging.WARNING]
+    assert "No Azure AD device for d2" in log.text
+
+
+def test_user_not_found_is_logged_as_error(log, monkeypatch):
+    monkeypatch.setattr(concurrent_batch, "make_api_request_Post", FakeGraph({"u2": [404]}).post)
+
+    responses = batch_request(lookups("user", ["u1", "u2"]), "users/", "", "user", {})
+
+    assert [response["userPrincipalName"] for response in responses] == ["key-u1"]
+    assert [record.levelno for record in log.records if record.levelno >= logging.WARNING] == [logging.ERROR]
+
+
+def test_throttled_requests_are_retried(log, monkeypatch):
+    monkeypatch.setattr(concurrent_batch, "make_api_request_Post", FakeGraph({"d1": [429, 200]}).post)
+
+    responses = batch_request(lookups("device", ["d1"]), "devices(deviceId='", "')", "device", {})
+
+    assert responses == [{"value": [GROUP], "deviceId": "key-d1"}]
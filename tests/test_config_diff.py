@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""
+Tests for applying changes to the group config to the affected manifests only.
+"""
+
+import pytest
+
+from munki_manifest_generator.manifest_tags import manifest_tags
+from munki_manifest_generator.config_diff import ConfigState, apply_config_diff
+from munki_manifest_generator.storage.memory_backend import MemoryBackend
+from munki_manifest_generator.manifest_encoding import dumps_manifest, loads_manifest
+
+GROUPS = [
+    {"name": "Beta", "id": "g1", "type": "device", "catalog": "beta"},
+    {"name": "Testing", "id": "g2", "type": "user", "catalog": "testing"},
+]
+CHANGED_GROUPS = [
+    {"name": "Beta", "id": "g1", "type": "device", "catalog": "beta2"},
+    {"name": "Testing", "id": "g2", "type": "user", "catalog": "testing"},
+]
+DEVICE_MANIFESTS = {
+    "SER1": {"included_manifests": ["site_default", "Beta"], "catalogs": ["beta", "Production"], "user": "u1"},
+    "SER2": {"included_manifests": ["site_default", "Testing"], "catalogs": ["testing", "Production"], "user": "u2"},
+    "SER3": {"included_manifests": ["site_default"], "catalogs": ["Production"], "user": "u3"},
+}
+
+
+class ReadCountingBackend(MemoryBackend):
+    """Memory storage that records which manifests were read and can fail writes."""
+
+    def __init__(self, fail_puts=()):
+        super().__init__()
+        self.reads = []
+        self.fail_puts = set(fail_puts)
+
+    def get(self, name):
+        self.reads.append(name)
+        return super().get(name)
+
+    def put(self, name, data, etag=None, tags=None):
+        if name in self.fail_puts:
+            raise Exception("write failed")
+        return super().put(name, data, etag, tags)
+
+
+def make_storage(tagged: bool, fail_puts=()) -> ReadCountingBackend:
+    storage = ReadCountingBackend()
+    for name in ["site_default", "Beta", "Testing"]:
+        storage.put(name, dumps_manifest({}))
+    for name, manifest in DEVICE_MANIFESTS.items():
+        # Manifests written before tags were added have none
+        storage.put(name, dumps_manifest(manifest), tags=manifest_tags(manifest) if tagged else None)
+    storage.fail_puts = set(fail_puts)
+    return storage
+
+
+def no_token():
+    raise AssertionError("Graph is not queried if no groups were added")
+
+
+def changed_catalog_diff(tmp_path, tagged: bool):
+    state = ConfigState(str(tmp_path / "state.json"))
+    state.save(GROUPS, "Production", tagged)
+    return state.diff(CHANGED_GROUPS, "Production")
+
+
+def catalogs(storage, name):
+    return loads_manifest(storage.get(name)[0])["catalogs"]
+
+
+def test_untagged_manifests_are_read(tmp_path):
+    storage = make_storage(tagged=False)
+    diff = changed_catalog_diff(tmp_path, tagged=False)
+
+    failed = apply_config_diff(storage, CHANGED_GROUPS, diff, storage.list(), "Production", False, no_token)
+
+    assert failed == []
+    assert catalogs(storage, "SER1") == ["beta2", "Production"]
+    assert catalogs(storage, "SER2") == ["testing", "Production"]
+    assert set(storage.reads) >= {"SER1", "SER2", "SER3"}
+
+
+def test_tagged_manifests_are_found_by_tags(tmp_path):
+    storage = make_storage(tagged=True)
+    diff = changed_catalog_diff(tmp_path, tagged=True)
+
+    failed = apply_config_diff(storage, CHANGED_GROUPS, diff, storage.list(), "Production", False, no_token)
+
+    assert failed == []
+    assert catalogs(storage, "SER1") == ["beta2", "Production"]
+    assert "SER1" in storage.reads
+    assert "SER2" not in storage.reads
+    assert "SER3" not in storage.reads
+
+
+def test_failed_manifests_are_returned(tmp_path):
+    storage = make_storage(tagged=False, fail_puts=["SER1"])
+    diff = changed_catalog_diff(tmp_path, tagged=False)
+
+    failed = apply_config_diff(storage, CHANGED_GROUPS, diff, storage.list(), "Production", False, no_token)
+
+    assert failed == ["SER1"]
+    assert catalogs(storage, "SER1") == ["beta", "Production"]
+
+
+def test_test_run_does_not_write(tmp_path):
+    storage = make_storage(tagged=False)
+    diff = changed_catalog_diff(tmp_path, tagged=False)
+
+    apply_config_diff(storage, CHANGED_GROUPS, diff, storage.list(), "Production", True, no_token)
+
+    assert catalogs(storage, "SER1") == ["beta", "Production"]
+
+
+def test_tagged_state_is_kept_by_later_saves(tmp_path):
+    state = ConfigState(str(tmp_path / "state.json"))
+    state.save(GROUPS, "Production")
+    assert not state.diff(GROUPS, "Production").tagged
+
+    state.save(GROUPS, "Production", True)
+    state.save(GROUPS, "Production")
+    assert state.diff(GROUPS, "Production").tagged
+
+
+@pytest.mark.parametrize("default_catalog", ["Production", "Other"])
+def test_diff_needs_state_and_same_default_catalog(tmp_path, default_catalog):
+    state = ConfigState(str(tmp_path / "state.json"))
+    assert state.diff(GROUPS, "Production") is None
+
+    state.save(GROUPS, "Production")
+    diff = state.diff(CHANGED_GROUPS, default_catalog)
+
+    if default_catalog == "Production":
+        assert [group["name"] for group in diff.changed] == ["Beta"]
+        assert diff.unchanged == 1
+    else:
+        assert diff is None
+
+
+def test_renamed_group_manifest_is_replaced(tmp_path):
+    storage = make_storage(tagged=False)
+    storage.put("Beta-new", dumps_manifest({}))
+    renamed = [dict(GROUPS[0], name="Beta-new"), GROUPS[1]]
+    state = ConfigState(str(tmp_path / "state.json"))
+    state.save(GROUPS, "Production")
+    diff = state.diff(renamed, "Production")
+
+    assert diff.renamed == [("Beta", renamed[0])]
+    apply_config_diff(storage, renamed, diff, storage.list(), "Production", False, no_token)
+
+    manifest = loads_manifest(storage.get("SER1")[0])
+    assert manifest["included_manifests"] == ["site_default", "Beta-new"]
+    assert manifest["catalogs"] == ["beta", "Production"]
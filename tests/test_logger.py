@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+"""
+Tests for setting up the logger and writing its queued records.
+"""
+
+import pytest
+
+from munki_manifest_generator.logger import logger
+
+
+@pytest.fixture(autouse=True)
+def remove_handlers():
+    yield
+    logger.remove_handlers()
+
+
+def test_records_are_written_when_stopped(tmp_path):
+    log_file = tmp_path / "mmg.log"
+    logger.setup(log_file=str(log_file))
+    logger.info("[SER1] Manifest written")
+    logger.stop()
+
+    assert "[SER1] Manifest written" in log_file.read_text()
+
+
+def test_setup_again_applies_its_options(tmp_path):
+    first, second = tmp_path / "first.log", tmp_path / "second.log"
+    logger.setup(log_file=str(first))
+    logger.setup(log_file=str(second), summary=True)
+    logger.info("[SER1] Manifest written")
+    logger.info("[SER2] Manifest written")
+    logger.log_summary()
+    logger.stop()
+
+    assert first.read_text() == ""
+    assert "[SER1]" not in second.read_text()
+    assert "2 x Manifest written" in second.read_text()
+    assert len(logger.handlers) == 1
+
+
+def test_setup_after_stop_writes_records(tmp_path):
+    log_file = tmp_path / "mmg.log"
+    logger.setup(log_file=str(log_file))
+    logger.stop()
+    logger.setup(log_file=str(log_file))
+    logger.info("[SER1] Manifest written")
+    logger.stop()
+
+    assert "[SER1] Manifest written" in log_file.read_text()
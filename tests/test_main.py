@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+"""
+Tests for reading the serial numbers to process from the command line.
+"""
+
+from munki_manifest_generator.logger import logger
+from munki_manifest_generator.main import parse_serial_numbers
+
+
+def test_comma_separated_serials_without_duplicates():
+    assert parse_serial_numbers("SER1, SER2,,SER1") == ["SER1", "SER2"]
+
+
+def test_serials_from_file_and_list(tmp_path):
+    path = tmp_path / "serials.txt"
+    path.write_text("# Lab devices\nSER1\n\nSER2\n")
+
+    assert parse_serial_numbers([str(path), "SER3"]) == ["SER1", "SER2", "SER3"]
+
+
+def test_invalid_serials_are_reported_and_skipped(tmp_path, caplog):
+    path = tmp_path / "serials.txt"
+    path.write_text("SER1\nSER2' or serialNumber ne '\nSER 3\n")
+
+    # The logger is not a child of the root logger that caplog captures
+    logger.addHandler(caplog.handler)
+    try:
+        serials = parse_serial_numbers([str(path), "SER4,SER-5"])
+    finally:
+        logger.removeHandler(caplog.handler)
+
+    assert serials == ["SER1", "SER4"]
+    assert "line 2 of" in caplog.text
+    assert "line 3 of" in caplog.text
+    assert "'SER-5'" in caplog.text
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+Tests for the changes computed to bring a device manifest in line with its group memberships.
+"""
+
+from munki_manifest_generator.manifest_diff import diff_manifest
+
+EXISTING = {"site_default", "Beta", "Testing", "Other", "SER1"}
+GROUP_CATALOGS = [("Beta", "beta"), ("Testing", "testing")]
+
+
+def diff(current, desired, member_names=None, user="user@example.com"):
+    return diff_manifest(
+        current,
+        desired,
+        desired if member_names is None else member_names,
+        EXISTING,
+        GROUP_CATALOGS,
+        "Production",
+        user,
+    )
+
+
+def test_unchanged_manifest():
+    current = {
+        "included_manifests": ["site_default", "Beta"],
+        "catalogs": ["beta", "Production"],
+        "user": "user@example.com",
+    }
+    changes = diff(current, ["Beta"])
+
+    assert not changes.changed
+    assert changes.included_manifests == ["site_default", "Beta"]
+
+
+def test_added_group_adds_manifest_and_catalog():
+    current = {"included_manifests": ["site_default"], "catalogs": ["Production"], "user": "user@example.com"}
+    changes = diff(current, ["Beta"])
+
+    assert changes.added_manifests == ["Beta"]
+    assert changes.added_catalogs == ["beta"]
+    assert changes.included_manifests == ["site_default", "Beta"]
+    assert changes.catalogs == ["beta", "Production"]
+    assert not changes.user_changed
+
+
+def test_left_group_removes_manifest_and_catalog():
+    current = {
+        "included_manifests": ["site_default", "Beta", "Testing"],
+        "catalogs": ["testing", "beta", "Production"],
+        "user": "user@example.com",
+    }
+    changes = diff(current, ["Testing"])
+
+    assert changes.removed_manifests == ["Beta"]
+    assert changes.removed_catalogs == ["beta"]
+    assert changes.included_manifests == ["site_default", "Testing"]
+    assert changes.catalogs == ["testing", "Production"]
+
+
+def test_manifest_of_other_group_the_device_is_in_is_kept():
+    current = {"included_manifests": ["site_default", "Other"], "catalogs": ["Production"], "user": "user@example.com"}
+    changes = diff(current, [], member_names=["Other"])
+
+    assert not changes.changed
+    assert changes.included_manifests == ["site_default", "Other"]
+
+
+def test_missing_manifest_is_removed():
+    current = {"included_manifests": ["site_default", "Gone"], "catalogs": ["Production"], "user": "user@example.com"}
+    changes = diff(current, [])
+
+    assert changes.missing_manifests == ["Gone"]
+    assert changes.removed_manifests == ["Gone"]
+    assert changes.included_manifests == ["site_default"]
+
+
+def test_desired_manifest_that_does_not_exist_is_not_added():
+    current = {"included_manifests": ["site_default"], "catalogs": ["Production"], "user": "user@example.com"}
+    changes = diff(current, ["Missing"])
+
+    assert not changes.changed
+
+
+def test_catalog_order_of_current_manifest_is_kept():
+    current = {
+        "included_manifests": ["site_default", "Beta", "Testing"],
+        "catalogs": ["Production", "beta", "testing"],
+        "user": "user@example.com",
+    }
+    changes = diff(current, ["Beta", "Testing"])
+
+    assert not changes.catalogs_changed
+    assert changes.catalogs == ["Production", "beta", "testing"]
+
+
+def test_duplicate_included_manifests_are_dropped():
+    current = {
+        "included_manifests": ["site_default", "Beta", "Beta"],
+        "catalogs": ["beta", "Production"],
+        "user": "user@example.com",
+    }
+    changes = diff(current, ["Beta"])
+
+    assert changes.included_manifests == ["site_default", "Beta"]
+
+
+def test_user_change():
+    current = {"included_manifests": ["site_default"], "catalogs": ["Production"], "user": "old@example.com"}
+    changes = diff(current, [], user="new@example.com")
+
+    assert changes.user_changed
+    assert changes.changed
+    assert changes.old_user == "old@example.com"
+
+
+def test_apply_keeps_other_keys_and_does_not_change_current():
+    current = {
+        "included_manifests": ["site_default"],
+        "catalogs": ["Production"],
+        "user": "user@example.com",
+        "managed_installs": ["Firefox"],
+    }
+    changes = diff(current, ["Beta"])
+    manifest = changes.apply(current)
+
+    assert manifest["managed_installs"] == ["Firefox"]
+    assert manifest["included_manifests"] == ["site_default", "Beta"]
+    assert manifest["catalogs"] == ["beta", "Production"]
+    assert current["included_manifests"] == ["site_default"]
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""
+Tests for the blob index tags written with device manifests and finding manifests by them.
+"""
+
+import pytest
+
+from munki_manifest_generator.device import Device
+from munki_manifest_generator.fleet import FleetMembership
+from munki_manifest_generator.main import process_device
+from munki_manifest_generator.config_diff import ConfigState
+from munki_manifest_generator.manifest_encoding import dumps_manifest
+from munki_manifest_generator.storage.memory_backend import MemoryBackend
+from munki_manifest_generator.manifest_tags import MAX_GROUP_TAGS, manifest_tags, find_tagged_manifests
+
+GROUPS = [{"name": "Beta", "id": "g1", "type": "device", "catalog": "beta"}]
+
+
+def test_tags_of_manifest():
+    manifest = {
+        "included_manifests": ["site_default", "Beta"],
+        "catalogs": ["beta", "Production"],
+        "user": "o'brien@example.com",
+    }
+    tags = manifest_tags(manifest)
+
+    assert tags["user"] == "o_brien_example.com"
+    assert tags["catalogs"] == "beta Production"
+    assert tags["g.Beta"] == "1"
+    assert "overflow" not in tags
+    assert len(tags) <= 10
+
+
+def test_manifest_with_more_groups_than_fit_is_found_for_every_group():
+    groups = ["Group%d" % i for i in range(MAX_GROUP_TAGS + 1)]
+    storage = MemoryBackend()
+    storage.put("SER1", b"", tags=manifest_tags({"included_manifests": groups}))
+    storage.put("SER2", b"", tags=manifest_tags({"included_manifests": ["Beta"], "user": "user@example.com"}))
+
+    assert len(manifest_tags({"included_manifests": groups})) <= 10
+    assert find_tagged_manifests(storage, [groups[-1]], []) == ["SER1"]
+    assert find_tagged_manifests(storage, ["Beta"], []) == ["SER2", "SER1"]
+    assert find_tagged_manifests(storage, [], ["user@example.com"]) == ["SER2"]
+
+
+def reconcile(storage, **kwargs):
+    device = Device("SER1", "aad1", "user1@example.com", "2023-01-01T00:00:00Z")
+    fleet = FleetMembership([device], GROUPS, storage.list(), [], [])
+    return process_device(device, storage.list(), fleet, storage, "Production", False, **kwargs)
+
+
+@pytest.mark.parametrize("write_tags", [False, True])
+def test_manifests_are_only_tagged_if_enabled(write_tags):
+    storage = MemoryBackend({"site_default": dumps_manifest({})})
+
+    assert reconcile(storage, write_tags=write_tags)
+    assert bool(storage.tags["SER1"]) == write_tags
+
+
+def test_unchanged_manifest_is_written_to_tag_it():
+    storage = MemoryBackend({"site_default": dumps_manifest({})})
+    reconcile(storage)
+
+    assert reconcile(storage) is False
+    assert reconcile(storage, tag_manifests=True)
+    assert storage.tags["SER1"]["user"] == "user1_example.com"
+
+
+@pytest.mark.parametrize("tagged, expected", [(True, True), (None, True), (False, False)])
+def test_run_without_tags_resets_tagged_state(tmp_path, tagged, expected):
+    state = ConfigState(str(tmp_path / "state.json"))
+    state.save(GROUPS, "Production", True)
+    state.save(GROUPS, "Production", tagged)
+
+    assert state.diff(GROUPS, "Production").tagged == expected
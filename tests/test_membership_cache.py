@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""
+Tests for caching the group memberships of devices and users in SQLite.
+"""
+
+import pytest
+
+from munki_manifest_generator import main
+from munki_manifest_generator.membership_cache import MembershipCache
+
+GROUPS = [
+    {"name": "Beta", "id": "g1", "type": "device", "catalog": "beta"},
+    {"name": "Pilot", "id": "g2", "type": "device", "catalog": "pilot"},
+]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "memberships.db")
+
+
+def put(cache, memberships, groups=GROUPS):
+    """Store transitiveMemberOf responses for device ids, looked up by the object id "o-<device id>"."""
+    responses = [
+        {"deviceId": key, "value": [{"id": i, "displayName": i} for i in group_ids]}
+        for key, group_ids in memberships.items()
+    ]
+    id_responses = [{"value": [{"id": "o-" + key, "deviceId": key}]} for key in memberships]
+    cache.put("device", responses, id_responses, groups)
+
+
+def test_cached_memberships_are_returned_with_configured_groups_only(path):
+    cache = MembershipCache(path)
+    put(cache, {"aad1": ["g1", "other"], "aad2": []})
+
+    responses, missing, object_ids = cache.get("device", ["aad1", "aad2", "aad3"], GROUPS)
+
+    assert responses == [
+        {"deviceId": "aad1", "value": [{"id": "g1", "displayName": "Beta"}]},
+        {"deviceId": "aad2", "value": []},
+    ]
+    assert missing == ["aad3"]
+    assert object_ids == {}
+
+
+def test_memberships_are_kept_between_runs(path):
+    cache = MembershipCache(path)
+    put(cache, {"aad1": ["g2"]})
+    cache.close()
+
+    responses, missing, _ = MembershipCache(path).get("device", ["aad1"], GROUPS)
+
+    assert responses == [{"deviceId": "aad1", "value": [{"id": "g2", "displayName": "Pilot"}]}]
+    assert missing == []
+
+
+def test_expired_memberships_are_refreshed_with_their_object_id(path):
+    put(MembershipCache(path), {"aad1": ["g1"]})
+
+    responses, missing, object_ids = MembershipCache(path, ttl=-1).get("device", ["aad1"], GROUPS)
+
+    assert responses == []
+    assert missing == ["aad1"]
+    assert object_ids == {"aad1": "o-aad1"}
+
+
+def test_memberships_for_other_groups_are_refreshed(path):
+    cache = MembershipCache(path)
+    put(cache, {"aad1": ["g1"]}, GROUPS[:1])
+
+    _, missing, _ = cache.get("device", ["aad1"], GROUPS)
+
+    assert missing == ["aad1"]
+
+
+def test_invalidate_expires_all_memberships(path):
+    cache = MembershipCache(path)
+    put(cache, {"aad1": ["g1"], "aad2": ["g2"]})
+    cache.invalidate()
+
+    responses, missing, object_ids = cache.get("device", ["aad1", "aad2"], GROUPS)
+
+    assert responses == []
+    assert missing == ["aad1", "aad2"]
+    assert object_ids == {"aad1": "o-aad1", "aad2": "o-aad2"}
+
+
+def test_only_devices_not_cached_are_queried(path, monkeypatch):
+    queried = []
+
+    def iter_batch_request(data, url, extra_url, batch_type, token, method="GET", body=None):
+        for response in data:
+            key = response["value"][0]["deviceId"]
+            queried.append(key)
+            yield {"deviceId": key, "value": [{"id": "g2", "displayName": "Pilot"}]}
+
+    monkeypatch.setattr(main, "iter_batch_request", iter_batch_request)
+    cache = MembershipCache(path)
+    put(cache, {"aad1": ["g1"]})
+
+    responses = main.resolve_memberships(["aad1", "aad2"], "device", GROUPS, {}, "search", "", cache)
+
+    assert queried == ["aad2"]
+    assert [(r["deviceId"], [g["id"] for g in r["value"]]) for r in responses] == [("aad1", ["g1"]), ("aad2", ["g2"])]
+    assert cache.get("device", ["aad2"], GROUPS)[0] == [responses[1]]
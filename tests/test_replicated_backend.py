@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+Tests for mirroring manifest changes to replicas.
+"""
+
+import time
+
+import pytest
+
+from munki_manifest_generator import stats
+from munki_manifest_generator.storage.memory_backend import MemoryBackend
+from munki_manifest_generator.storage.storage_backend import PreconditionFailed
+from munki_manifest_generator.storage.replicated_backend import ReplicatedBackend
+
+real_sleep = time.sleep
+
+
+class FlakyBackend(MemoryBackend):
+    """Memory storage where the first write of some data is slow and fails."""
+
+    def __init__(self, fail_data=(), always=False):
+        super().__init__()
+        self.fail_data = set(fail_data)
+        self.always = always
+        self.writes = []
+
+    def put(self, name, data, etag=None, tags=None):
+        if data in self.fail_data:
+            if not self.always:
+                self.fail_data.discard(data)
+            real_sleep(0.2)
+            raise Exception("replica unavailable")
+        self.writes.append((name, data))
+        return super().put(name, data, etag, tags)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # Retries back off with time.sleep, the tests do not wait for them
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    stats.manifest_stats.clear()
+    yield
+    stats.manifest_stats.clear()
+
+
+def test_retried_change_does_not_overwrite_newer_change():
+    replica = FlakyBackend(fail_data=[b"v1"])
+    storage = ReplicatedBackend(MemoryBackend(), [replica])
+
+    storage.put("SER1", b"v1")
+    storage.put("SER1", b"v2")
+    storage.close()
+
+    assert storage.get("SER1")[0] == b"v2"
+    assert replica.get("SER1")[0] == b"v2"
+    assert replica.writes == [("SER1", b"v1"), ("SER1", b"v2")]
+    assert stats.manifest_stats["replicated"] == 2
+
+
+def test_replica_catches_up_after_retries():
+    replica = FlakyBackend(fail_data=[b"retried"])
+    storage = ReplicatedBackend(MemoryBackend(), [replica])
+
+    storage.put("SER1", b"retried")
+    for i in range(2, 20):
+        storage.put(f"SER{i}", b"data")
+    storage.close()
+
+    assert sorted(replica.list()) == sorted(storage.list())
+    assert replica.get("SER1")[0] == b"retried"
+    assert storage.replicas[0].retries == 1
+
+
+def test_failed_change_is_counted():
+    replica = FlakyBackend(fail_data=[b"v1"], always=True)
+    storage = ReplicatedBackend(MemoryBackend(), [replica])
+
+    storage.put("SER1", b"v1")
+    storage.close()
+
+    assert storage.get("SER1")[0] == b"v1"
+    assert replica.list() == []
+    assert stats.manifest_stats["replica_failed"] == 1
+    assert storage.replicas[0].failed == ["SER1"]
+
+
+def test_delete_of_manifest_missing_on_replica_is_applied():
+    primary = MemoryBackend({"SER1": b"v1"})
+    storage = ReplicatedBackend(primary, [MemoryBackend()])
+
+    storage.delete("SER1")
+    storage.close()
+
+    assert primary.list() == []
+    assert stats.manifest_stats["replicated"] == 1
+    assert "replica_failed" not in stats.manifest_stats
+
+
+def test_change_that_fails_on_primary_is_not_replicated():
+    replica = MemoryBackend()
+    storage = ReplicatedBackend(MemoryBackend({"SER1": b"v1"}), [replica])
+
+    with pytest.raises(PreconditionFailed):
+        storage.put("SER1", b"v2", etag="stale")
+    storage.close()
+
+    assert replica.list() == []
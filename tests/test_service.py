@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Tests for the service that creates and updates manifests for serial numbers posted over HTTP.
+"""
+
+import json
+import threading
+import http.client
+
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from munki_manifest_generator.graph import concurrent_batch
+from munki_manifest_generator.graph.get_devices import get_devices_by_serial
+from munki_manifest_generator.manifest_encoding import dumps_manifest, loads_manifest
+from munki_manifest_generator.service import ManifestService, ServiceRequestHandler
+from munki_manifest_generator.storage.memory_backend import MemoryBackend
+
+
+class FakeGraph:
+    """Answers every sub-request of a batch with a managed device and records the sub-requests."""
+
+    def __init__(self):
+        self.requests = []
+
+    def post(self, endpoint, token, jdata):
+        requests = json.loads(jdata)["requests"]
+        self.requests.extend(requests)
+        return {
+            "responses": [
+                {
+                    "id": request["id"],
+                    "status": 200,
+                    "headers": {},
+                    "body": {
+                        "value": [
+                            {
+                                "serialNumber": request["id"],
+                                "azureADDeviceId": "aad-" + request["id"],
+                                "userPrincipalName": "user@example.com",
+                                "enrolledDateTime": "2023-01-01T00:00:00Z",
+                            }
+                        ]
+                    },
+                }
+                for request in requests
+            ]
+        }
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    fake = FakeGraph()
+    monkeypatch.setattr(concurrent_batch, "make_api_request_Post", fake.post)
+    return fake
+
+
+@pytest.fixture
+def service():
+    service = ManifestService([], MemoryBackend({"site_default": dumps_manifest({})}), coalesce_window=0)
+    # The token is not refreshed during the tests
+    service._token = {}
+    service._token_expires = float("inf")
+    return service
+
+
+@pytest.fixture
+def post(service):
+    handler = type("Handler", (ServiceRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def post(body):
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+        connection.request("POST", "/serial", json.dumps(body), {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        status, data = response.status, json.loads(response.read())
+        connection.close()
+        return status, data
+
+    yield post
+    server.shutdown()
+    server.server_close()
+
+
+def queued(service):
+    serial_numbers = []
+    while not service.queue.empty():
+        serial_numbers.append(service.queue.get())
+    return serial_numbers
+
+
+def test_posted_serials_are_queued(service, post):
+    status, data = post({"serials": ["SER1", "SER2"]})
+
+    assert status == 202
+    assert data == {"queued": 2}
+    assert queued(service) == ["SER1", "SER2"]
+
+
+@pytest.mark.parametrize("serial", ["SER1' or serialNumber ne '", "SER 1", "SER1\n", "SÉR1"])
+def test_invalid_serials_are_rejected(service, post, serial):
+    status, data = post({"serials": ["SER2", serial]})
+
+    assert status == 400
+    assert data["invalid"] == [serial]
+    assert queued(service) == []
+
+
+def test_body_without_serials_is_rejected(service, post):
+    status, _ = post({"device": "SER1"})
+
+    assert status == 400
+    assert queued(service) == []
+
+
+def test_queued_serials_are_coalesced_without_duplicates(service):
+    service.coalesce_window = 0.1
+    service.submit(["SER1", "SER2", "SER1"])
+
+    assert service.next_batch() == ["SER1", "SER2"]
+
+
+def test_processed_serials_get_manifests(service, graph):
+    service.process(["SER1", "SER2"])
+
+    for serial in ["SER1", "SER2"]:
+        manifest = loads_manifest(service.storage.get(serial)[0])
+        assert manifest["included_manifests"] == ["site_default"]
+        assert manifest["user"] == "user@example.com"
+    # Created manifests are updated on the next request
+    assert {"SER1", "SER2"} <= service.current_manifests()
+
+
+def test_serial_lookup_escapes_quotes_and_filters_macos(graph):
+    get_devices_by_serial(["SER'1"], {})
+
+    assert graph.requests[0]["url"] == (
+        "deviceManagement/managedDevices?$filter=serialNumber eq 'SER''1' and operatingSystem eq 'macOS'"
+    )
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""
+Tests for running the stages of a run as a dependency graph.
+"""
+
+import threading
+
+import pytest
+
+from munki_manifest_generator.stages import StageGraph
+
+
+def test_stages_are_called_with_the_results_of_their_dependencies():
+    stages = StageGraph()
+    stages.add("token", lambda: "token")
+    stages.add("devices", lambda token: [token + ":SER1"], ("token",))
+    stages.add("manifests", lambda: ["site_default"])
+    stages.add("fleet", lambda manifests, devices: manifests + devices, ("manifests", "devices"))
+
+    results = stages.run()
+
+    assert results["fleet"] == ["site_default", "token:SER1"]
+    assert set(stages.times) == {"token", "devices", "manifests", "fleet"}
+
+
+def test_independent_stages_overlap():
+    # Each stage waits for the other one to start, they only finish if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    stages = StageGraph()
+    stages.add("memberships.device", barrier.wait)
+    stages.add("memberships.user", barrier.wait)
+
+    assert set(stages.run()) == {"memberships.device", "memberships.user"}
+
+
+def test_unknown_dependency_is_rejected():
+    stages = StageGraph()
+
+    with pytest.raises(Exception, match="unknown stage token"):
+        stages.add("devices", lambda token: [], ("token",))
+
+
+def test_failed_stage_stops_the_stages_that_depend_on_it():
+    called = []
+    stages = StageGraph()
+    stages.add("devices", lambda: 1 / 0)
+    stages.add("fleet", lambda devices: called.append("fleet"), ("devices",))
+
+    with pytest.raises(ZeroDivisionError):
+        stages.run()
+    assert called == []
+
+
+def test_critical_path_follows_the_dependency_that_finished_last():
+    stages = StageGraph()
+    stages.add("token", lambda: None)
+    stages.add("manifests", lambda: None)
+    stages.add("devices", lambda token: None, ("token",))
+    stages.add("fleet", lambda manifests, devices: None, ("manifests", "devices"))
+    stages.run()
+    # Times are the start and end of every stage in seconds from the start of the run
+    stages.times = {"token": (0, 1), "manifests": (0, 3), "devices": (1, 2), "fleet": (3, 4)}
+
+    assert stages.critical_path() == ["manifests", "fleet"]